@@ -0,0 +1,212 @@
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from contextvars import ContextVar, copy_context
+from .metrics import Gauge, Histogram, LATENCY_BUCKETS
+
+# Controllo di ammissione per le rotte di calcolo prezzi: al piu' ADMISSION_MAX_CONCURRENT
+# richieste in esecuzione per processo, le altre attendono in una coda limitata per classe di
+# priorita' (header X-Priority: interactive | batch). Uno slot che si libera va alla prima richiesta
+# interactive in coda, poi alle batch. Con la coda della classe piena la risposta e' subito 429;
+# se l'attesa supera ADMISSION_MAX_WAIT_S (o la scadenza della richiesta) e' 503. Entrambe hanno
+# Retry-After, stimato dalla coda e dalla durata media delle richieste.
+#
+# Scadenza: X-Request-Timeout (secondi, al piu' ADMISSION_DEADLINE_S) fissa l'istante oltre il
+# quale la risposta non serve piu'. E' legata al contesto (ContextVar, segue la richiesta nel
+# threadpool e in run_sync): il calcolo la verifica con check_deadline() prima delle fasi costose
+# (lookup, esplosione BOM) e non le avvia se e' gia' passata (503). Un calcolo condiviso tra
+# richieste identiche (singleflight) gira senza scadenza: ciascuna richiesta la verifica solo
+# quando lo avvia o vi si aggancia.
+#
+# ADMISSION_MAX_CONCURRENT=0 (default) disattiva il controllo.
+
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "0"))
+ADMISSION_QUEUE_INTERACTIVE = int(os.getenv("ADMISSION_QUEUE_INTERACTIVE", "100"))
+ADMISSION_QUEUE_BATCH = int(os.getenv("ADMISSION_QUEUE_BATCH", "20"))
+ADMISSION_MAX_WAIT_S = float(os.getenv("ADMISSION_MAX_WAIT_S", "5"))
+ADMISSION_DEADLINE_S = float(os.getenv("ADMISSION_DEADLINE_S", "30"))
+ADMISSION_PATHS = {p.strip() for p in os.getenv(
+    "ADMISSION_PATHS", "/pricing/calculate,/pricing/calculate-batch"
+).split(",") if p.strip()}
+
+PRIORITY_HEADER = b"x-priority"
+TIMEOUT_HEADER = b"x-request-timeout"
+CLASSES = ("interactive", "batch")
+# Classe di default per rotta, senza header
+DEFAULT_CLASS = {"/pricing/calculate-batch": "batch"}
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "priceforge_admission_queue_wait_seconds", "Attesa in coda prima dell'esecuzione", LATENCY_BUCKETS,
+    labels=("class",))
+
+_request = ContextVar("priceforge_admitted_request", default=None)   # (scadenza monotonic, classe)
+
+class DeadlineExceeded(Exception):
+    pass
+
+def check_deadline(what):
+    # Da chiamare prima di una fase costosa: fuori da una richiesta ammessa non fa nulla
+    request = _request.get()
+    if request is not None and time.monotonic() > request[0]:
+        admission.shed_count(request[1], "deadline")
+        raise DeadlineExceeded(f"Scadenza della richiesta superata prima di: {what}")
+
+def shared_context():
+    # Contesto per un calcolo condiviso tra piu' richieste (singleflight): senza la scadenza di
+    # nessuna, che vale solo per decidere se avviarlo o attenderlo.
+    ctx = copy_context()
+    ctx.run(_request.set, None)
+    return ctx
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionController:
+    def __init__(self, max_concurrent=ADMISSION_MAX_CONCURRENT, queue_limits=None, max_wait_s=ADMISSION_MAX_WAIT_S):
+        self.max_concurrent = max_concurrent
+        self.queue_limits = queue_limits or {"interactive": ADMISSION_QUEUE_INTERACTIVE, "batch": ADMISSION_QUEUE_BATCH}
+        self.max_wait_s = max_wait_s
+        self.active = 0
+        self._queues = {c: deque() for c in CLASSES}
+        self.admitted = {c: 0 for c in CLASSES}
+        self.shed = {}              # (classe, motivo) -> conteggio
+        self._service_s = 0.1       # media mobile della durata delle richieste ammesse
+
+    @property
+    def enabled(self):
+        return self.max_concurrent > 0
+
+    def shed_count(self, cls, reason):
+        self.shed[(cls, reason)] = self.shed.get((cls, reason), 0) + 1
+
+    def retry_after(self):
+        waiting = sum(len(q) for q in self._queues.values())
+        return max(1, math.ceil((waiting / self.max_concurrent + 1) * self._service_s))
+
+    async def acquire(self, cls, deadline):
+        # Ritorna quando la richiesta puo' essere eseguita (slot occupato), oppure solleva Rejected
+        if self.active < self.max_concurrent and not any(self._queues.values()):
+            self.active += 1
+            self.admitted[cls] += 1
+            return
+        queue = self._queues[cls]
+        if len(queue) >= self.queue_limits[cls]:
+            self.shed_count(cls, "queue_full")
+            raise Rejected(429, "Troppe richieste in coda", self.retry_after())
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        timeout = min(self.max_wait_s, deadline - started)
+        try:
+            await asyncio.wait_for(waiter, max(timeout, 0))
+        except asyncio.TimeoutError:
+            self.shed_count(cls, "deadline" if deadline <= time.monotonic() else "queue_timeout")
+            raise Rejected(503, "Attesa in coda oltre il limite", self.retry_after())
+        except BaseException:
+            # Richiesta annullata (es. client disconnesso) dopo aver ricevuto lo slot: lo passa avanti
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter in queue:
+                queue.remove(waiter)
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - started, cls)
+        self.admitted[cls] += 1
+
+    def release(self, elapsed=None):
+        if elapsed is not None:
+            self._service_s = 0.9 * self._service_s + 0.1 * elapsed
+        for cls in CLASSES:
+            queue = self._queues[cls]
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    # Lo slot passa direttamente al primo in coda: active non cambia
+                    waiter.set_result(None)
+                    return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "max_concurrent": self.max_concurrent,
+            "active": self.active,
+            "queued": {c: len(q) for c, q in self._queues.items()},
+            "queue_limits": self.queue_limits,
+            "admitted": self.admitted,
+            "shed": {f"{c}:{r}": n for (c, r), n in sorted(self.shed.items())},
+            "avg_service_s": round(self._service_s, 4),
+        }
+
+admission = AdmissionController()
+
+async def _reject(send, status, detail, retry_after):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"retry-after", str(retry_after).encode())],
+    })
+    await send({"type": "http.response.body", "body": json.dumps({"detail": detail}).encode()})
+
+class AdmissionMiddleware:
+    # Middleware ASGI davanti alle rotte ADMISSION_PATHS: ammissione, scadenza nel contesto e
+    # risposta 503 se il calcolo si ferma su check_deadline prima di aver risposto.
+    def __init__(self, app, controller=admission, paths=ADMISSION_PATHS):
+        self.app = app
+        self.controller = controller
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.controller.enabled or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        cls = headers.get(PRIORITY_HEADER, b"").decode("latin-1").strip().lower()
+        if cls not in CLASSES:
+            cls = DEFAULT_CLASS.get(scope["path"], "interactive")
+        timeout = ADMISSION_DEADLINE_S
+        try:
+            timeout = min(float(headers[TIMEOUT_HEADER]), timeout)
+        except (KeyError, ValueError):
+            pass
+        deadline = time.monotonic() + timeout
+        try:
+            await self.controller.acquire(cls, deadline)
+        except Rejected as e:
+            await _reject(send, e.status, str(e), e.retry_after)
+            return
+        token = _request.set((deadline, cls))
+        started = time.monotonic()
+        response_started = False
+
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except DeadlineExceeded as e:
+            if response_started:
+                raise
+            await _reject(send, 503, str(e), self.controller.retry_after())
+        finally:
+            _request.reset(token)
+            self.controller.release(time.monotonic() - started)
+
+Gauge("priceforge_admission_in_flight", "Richieste di calcolo in esecuzione",
+      lambda: {(): admission.active})
+Gauge("priceforge_admission_queue_length", "Richieste di calcolo in coda per classe",
+      lambda: {(c,): len(q) for c, q in admission._queues.items()}, labels=("class",))
+Gauge("priceforge_admission_admitted_total", "Richieste di calcolo ammesse per classe",
+      lambda: {(c,): n for c, n in admission.admitted.items()}, labels=("class",), kind="counter")
+Gauge("priceforge_admission_shed_total", "Richieste di calcolo rifiutate per classe e motivo",
+      lambda: dict(admission.shed), labels=("class", "reason"), kind="counter")
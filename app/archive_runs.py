@@ -0,0 +1,16 @@
+import argparse
+import json
+from datetime import date
+from app.database import engine
+from app.retention import RUN_ARCHIVE_DIR, RUN_RETENTION_MONTHS, apply_retention
+
+# Retention delle run di calcolo (da schedulare, es. mensilmente):
+#   python app/archive_runs.py --keep-months 13 --archive-dir /data/archive
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archivia ed elimina le partizioni di run piu' vecchie")
+    parser.add_argument("--keep-months", type=int, default=RUN_RETENTION_MONTHS, help="mesi completi da mantenere")
+    parser.add_argument("--archive-dir", default=RUN_ARCHIVE_DIR, help="directory dei file .ndjson.gz")
+    parser.add_argument("--today", type=date.fromisoformat, default=None, help="data di riferimento (default: oggi)")
+    args = parser.parse_args()
+    print(json.dumps(apply_retention(engine, args.keep_months, args.archive_dir, args.today), indent=2))
@@ -0,0 +1,191 @@
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from fastapi.testclient import TestClient
+from sqlalchemy import event, func, select
+from app.database import engine, async_engine, SessionLocal
+from app.main import app
+from app.migrations import migrate
+from app.models import PriceCalculationRun, PriceCalculationDetail, PriceSnapshot, Product
+from app.persistence import run_writer
+from app.synthetic import generate_catalog
+
+# Benchmark delle rotte di pricing e delle liste di anagrafica, in-process (TestClient, nessuna
+# rete) contro il DB di DATABASE_URL. Per ogni scenario: latenza p50/p90/p99, statement SQL per
+# richiesta e righe salvate per richiesta. Il risultato e' JSON, da confrontare tra commit:
+#   python app/bench.py --generate --products 20000 --out bench-base.json
+#   python app/bench.py --out bench-new.json --baseline bench-base.json --max-regression 10
+#
+# Gli statement sono contati sugli engine del processo: con WRITE_BEHIND=1 includono anche quelli
+# del writer in background.
+
+FLAGS = ("DB_ASYNC", "COST_INDEX", "COMPILED_BOM_CACHE", "WRITE_BEHIND", "CATALOG_NOTIFY")
+COMPARED = ("p50_ms", "p99_ms", "sql_per_request", "rows_per_request")
+
+class SqlCounter:
+    def __init__(self, engines):
+        self._lock = threading.Lock()
+        self.count = 0
+        for eng in engines:
+            event.listen(eng, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        with self._lock:
+            self.count += 1
+
+def percentile(values, pct):
+    # nearest-rank su una lista ordinata
+    if not values:
+        return None
+    k = max(math.ceil(pct / 100.0 * len(values)) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+def persisted_rows():
+    # Svuota la coda del write-behind (se attivo) prima di contare
+    run_writer.stop()
+    with SessionLocal() as db:
+        return sum(db.execute(select(func.count()).select_from(model)).scalar()
+                   for model in (PriceCalculationRun, PriceCalculationDetail, PriceSnapshot))
+
+def run_scenario(client, counter, make_request, requests, warmup):
+    for _ in range(warmup):
+        make_request()
+    rows_before = persisted_rows()
+    latencies, statements, errors = [], [], 0
+    for _ in range(requests):
+        sql_before = counter.count
+        started = time.perf_counter()
+        response = make_request()
+        latencies.append((time.perf_counter() - started) * 1000.0)
+        statements.append(counter.count - sql_before)
+        if response.status_code != 200:
+            errors += 1
+    rows = persisted_rows() - rows_before
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p90_ms": round(percentile(latencies, 90), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(latencies[-1], 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "sql_per_request": round(sum(statements) / len(statements), 2),
+        "sql_max": max(statements),
+        "rows_per_request": round(rows / requests, 2),
+    }
+
+def pager(client, path, limit):
+    # Pagine successive di una lista seguendo X-Next-Cursor; ricomincia a fine lista
+    state = {"cursor": None}
+    def request():
+        params = {"limit": limit}
+        if state["cursor"]:
+            params["cursor"] = state["cursor"]
+        response = client.get(path, params=params)
+        state["cursor"] = response.headers.get("x-next-cursor")
+        return response
+    return request
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(result, baseline, max_regression):
+    # Stampa le variazioni rispetto al baseline -> lista di regressioni oltre la soglia
+    regressions = []
+    for name, cur in result["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if base is None:
+            continue
+        for metric in COMPARED:
+            old, new = base.get(metric), cur.get(metric)
+            if old is None or new is None:
+                continue
+            delta = (new - old) / old * 100.0 if old else 0.0
+            print(f"{name:18} {metric:17} {old:>10} -> {new:>10}  {delta:+7.1f}%")
+            if max_regression is not None and delta > max_regression and new - old > 0.5:
+                regressions.append(f"{name}.{metric} {delta:+.1f}%")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark di /pricing/calculate e delle liste di anagrafica")
+    parser.add_argument("--generate", action="store_true", help="genera prima un catalogo sintetico (DB vuoto!)")
+    parser.add_argument("--products", type=int, default=5000, help="prodotti del catalogo generato")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--cost-windows", type=int, default=12)
+    parser.add_argument("--requests", type=int, default=200, help="richieste misurate per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="richieste di riscaldamento per scenario")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=None, help="file JSON dei risultati (default: stdout)")
+    parser.add_argument("--baseline", default=None, help="JSON di un run precedente da confrontare")
+    parser.add_argument("--max-regression", type=float, default=None, help="exit 1 se una metrica peggiora oltre questa %%")
+    args = parser.parse_args()
+
+    migrate(engine)
+    catalog = None
+    if args.generate:
+        with engine.begin() as conn:
+            catalog = generate_catalog(conn, products=args.products, depth=args.depth, fanout=args.fanout,
+                                       cost_windows=args.cost_windows)
+        catalog.pop("sellable_skus")
+    with SessionLocal() as db:
+        skus = list(db.execute(select(Product.sku).where(Product.is_sellable == True)).scalars())
+    if not skus:
+        sys.exit("Nessun prodotto vendibile: usare --generate su un DB vuoto")
+
+    counter = SqlCounter([engine] + ([async_engine.sync_engine] if async_engine is not None else []))
+    rnd = random.Random(args.seed)
+    scenarios = {}
+    with TestClient(app) as client:
+        scenarios["calculate"] = run_scenario(client, counter, lambda: client.post("/pricing/calculate", json={
+            "product_sku": rnd.choice(skus), "requested_qty": rnd.randint(1, 100)
+        }), args.requests, args.warmup)
+        for path in ("products", "materials", "operations"):
+            scenarios[f"list_{path}"] = run_scenario(
+                client, counter, pager(client, f"/{path}/", args.page_size), args.requests, args.warmup
+            )
+        names = [f"prodotto {rnd.randint(1, len(skus))}" for _ in range(50)] + rnd.sample(skus, min(50, len(skus)))
+        scenarios["search_products"] = run_scenario(client, counter, lambda: client.get("/products/search", params={
+            "q": (lambda term: term[:rnd.randint(2, len(term))])(rnd.choice(names))
+        }), args.requests, args.warmup)
+        scenarios["stream_products"] = run_scenario(
+            client, counter, lambda: client.get("/products/", params={"stream": "true"}),
+            max(args.requests // 20, 1), 1
+        )
+
+    result = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+            "dialect": engine.dialect.name,
+            "flags": {flag: os.getenv(flag, "0") for flag in FLAGS},
+            "requests": args.requests,
+            "sellable_products": len(skus),
+        },
+        "catalog": catalog,
+        "scenarios": scenarios,
+    }
+    output = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        if regressions:
+            sys.exit("Regressioni: " + ", ".join(regressions))
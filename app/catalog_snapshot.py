@@ -0,0 +1,498 @@
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from uuid import UUID
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.engine import Engine
+from .changes import ChangeCursor, on_catalog_change
+from .metrics import Gauge
+from .models import (
+    BOM, BOMComponent, CatalogChange, Material, MaterialCost, Operation, OperationCost, Product, ProductCostOverride
+)
+
+# Snapshot binario del catalogo, in sola lettura, condiviso tra i worker via mmap.
+# L'export (app/export_catalog.py) scrive in un unico file prodotti, BOM con i componenti,
+# materiali e lavorazioni con le loro finestre di costo e gli override di prodotto; ogni worker
+# apre il file con mmap, quindi la memoria e' condivisa dalla page cache e all'avvio non si
+# carica nulla: le ricerche sono bisezioni sui record a dimensione fissa del file.
+#
+# Il file viene pubblicato con un rename atomico: i worker se ne accorgono al controllo
+# periodico e passano al nuovo, mentre le richieste in corso finiscono sul vecchio mapping.
+#
+# Freschezza: l'export registra l'ultimo change_id di catalog_changes letto nella stessa
+# transazione dei dati. Le chiavi modificate dopo (lette dal registro all'apertura e poi a ogni
+# controllo, e ricevute dai listener di changes.py) diventano "stale" e per quelle, come per
+# tutto cio' che nel file non c'e', si interroga il DB come senza snapshot.
+#
+# CATALOG_SNAPSHOT                   percorso del file; vuoto = snapshot disabilitato
+# CATALOG_SNAPSHOT_POLL_S            intervallo dei controlli (nuovo file, registro modifiche)
+# CATALOG_CHANGES_RETENTION_DAYS     l'export elimina le righe del registro piu' vecchie di cosi'
+
+log = logging.getLogger(__name__)
+
+CATALOG_SNAPSHOT = os.getenv("CATALOG_SNAPSHOT", "")
+CATALOG_SNAPSHOT_POLL_S = float(os.getenv("CATALOG_SNAPSHOT_POLL_S", "5"))
+CATALOG_CHANGES_RETENTION_DAYS = int(os.getenv("CATALOG_CHANGES_RETENTION_DAYS", "7"))
+
+MAGIC = b"PFCATSNP"
+FORMAT_VERSION = 1
+
+# Intestazione: magic, versione, numero di sezioni, change_id di riferimento, istante dell'export.
+_HEADER = struct.Struct("<8sIIqd")
+# Directory: nome della sezione, offset, numero di record, dimensione del record.
+_SECTION = struct.Struct("<8sQQI4x")
+
+# Record delle sezioni. Date come ordinale (0 = nessuna data), NaN = override di riga assente,
+# stringhe come (offset, lunghezza) nella sezione STRINGS.
+_RECORDS = {
+    b"PRODUCTS": struct.Struct("<16sIIII"),        # product_id, prima BOM, n. BOM, primo override, n. override
+    b"BOMS": struct.Struct("<16sIiBxxxiiII"),      # bom_id, indice prodotto, versione, attiva, valid_from, valid_to, primo comp., n. comp.
+    b"BOMINDEX": struct.Struct("<16sI"),           # bom_id -> indice in BOMS
+    b"COMPS": struct.Struct("<iII16sddd"),         # line_no, kind, ref_id, quantity, waste_pct, override_unit_cost
+    b"MATS": struct.Struct("<16sIIIIII"),          # material_id, prima finestra, n. finestre, name, uom
+    b"OPS": struct.Struct("<16sIIIIII"),           # operation_id, idem
+    b"OVERRIDE": struct.Struct("<II16sII"),        # kind, ref_id, prima finestra, n. finestre
+    b"WINDOWS": struct.Struct("<iid"),             # valid_from, valid_to, unit_cost
+}
+
+def _ordinal(d):
+    return d.toordinal() if d is not None else 0
+
+def _float(value):
+    return float(value) if value is not None else math.nan
+
+class SnapshotBom:
+    # Stessi attributi di BOM usati dall'esplosione
+    __slots__ = ("bom_id", "product_id", "version")
+
+    def __init__(self, bom_id, product_id, version):
+        self.bom_id = bom_id
+        self.product_id = product_id
+        self.version = version
+
+class SnapshotComponent:
+    # Stessi attributi di BOMComponent usati dall'esplosione (numeri gia' float)
+    __slots__ = ("bom_id", "line_no", "kind", "ref_id", "quantity", "waste_pct", "override_unit_cost")
+
+    def __init__(self, bom_id, line_no, kind, ref_id, quantity, waste_pct, override_unit_cost):
+        self.bom_id = bom_id
+        self.line_no = line_no
+        self.kind = kind
+        self.ref_id = ref_id
+        self.quantity = quantity
+        self.waste_pct = waste_pct
+        self.override_unit_cost = override_unit_cost
+
+# --- export ---
+
+class _Strings:
+    def __init__(self):
+        self.blob = bytearray()
+        self._offsets = {}
+
+    def add(self, value):
+        if value not in self._offsets:
+            data = value.encode()
+            self._offsets[value] = (len(self.blob), len(data))
+            self.blob += data
+        return self._offsets[value]
+
+def _windows_by_key(rows, windows):
+    # rows: (key, valid_from, valid_to, cost) -> {key: (prima finestra, n. finestre)}
+    grouped = {}
+    for key, valid_from, valid_to, cost in rows:
+        grouped.setdefault(key, []).append((_ordinal(valid_from), _ordinal(valid_to), float(cost)))
+    out = {}
+    for key, ws in grouped.items():
+        ws.sort(key=lambda w: w[0])
+        out[key] = (len(windows), len(ws))
+        windows.extend(ws)
+    return out
+
+def _read_catalog(conn):
+    strings = _Strings()
+    windows = []
+    sections = {}
+
+    for name, model, cost_model, id_field in (
+        (b"MATS", Material, MaterialCost, "material_id"),
+        (b"OPS", Operation, OperationCost, "operation_id"),
+    ):
+        id_col = getattr(cost_model, id_field)
+        ranges = _windows_by_key(conn.execute(
+            select(id_col, cost_model.valid_from, cost_model.valid_to, cost_model.unit_cost)
+        ), windows)
+        records = []
+        for ref_id, item_name, uom in conn.execute(select(getattr(model, id_field), model.name, model.uom)):
+            start, count = ranges.get(ref_id, (0, 0))
+            records.append((ref_id.bytes, start, count, *strings.add(item_name), *strings.add(uom)))
+        records.sort()
+        sections[name] = records
+
+    overrides = _windows_by_key(((
+        (pid, kind, ref_id), valid_from, valid_to, cost) for pid, kind, ref_id, valid_from, valid_to, cost in conn.execute(
+            select(ProductCostOverride.product_id, ProductCostOverride.kind, ProductCostOverride.ref_id,
+                   ProductCostOverride.valid_from, ProductCostOverride.valid_to, ProductCostOverride.override_unit_cost)
+        )
+    ), windows)
+    overrides_by_product = {}
+    for (pid, kind, ref_id), (start, count) in overrides.items():
+        overrides_by_product.setdefault(pid, []).append((*strings.add(kind), ref_id.bytes, start, count))
+
+    components = {}
+    for bom_id, line_no, kind, ref_id, quantity, waste_pct, override in conn.execute(select(
+        BOMComponent.bom_id, BOMComponent.line_no, BOMComponent.kind, BOMComponent.ref_id, BOMComponent.quantity,
+        BOMComponent.waste_pct, BOMComponent.override_unit_cost
+    )):
+        components.setdefault(bom_id, []).append(
+            (line_no, *strings.add(kind), ref_id.bytes, float(quantity), float(waste_pct or 0), _float(override))
+        )
+    boms_by_product = {}
+    for bom_id, pid, version, is_active, valid_from, valid_to in conn.execute(
+        select(BOM.bom_id, BOM.product_id, BOM.version, BOM.is_active, BOM.valid_from, BOM.valid_to)
+    ):
+        boms_by_product.setdefault(pid, []).append((bom_id, version, is_active, valid_from, valid_to))
+
+    product_ids = sorted(conn.execute(select(Product.product_id)).scalars(), key=lambda pid: pid.bytes)
+    products, boms, comps, override_records = [], [], [], []
+    for p_idx, pid in enumerate(product_ids):
+        product_boms = sorted(boms_by_product.get(pid, ()), key=lambda b: b[1])
+        product_overrides = sorted(overrides_by_product.get(pid, ()))
+        products.append((pid.bytes, len(boms), len(product_boms), len(override_records), len(product_overrides)))
+        override_records.extend(product_overrides)
+        for bom_id, version, is_active, valid_from, valid_to in product_boms:
+            lines = sorted(components.get(bom_id, ()), key=lambda c: c[0])
+            boms.append((bom_id.bytes, p_idx, version, bool(is_active), _ordinal(valid_from), _ordinal(valid_to),
+                         len(comps), len(lines)))
+            comps.extend(lines)
+    sections[b"PRODUCTS"] = products
+    sections[b"BOMS"] = boms
+    sections[b"BOMINDEX"] = sorted((b[0], i) for i, b in enumerate(boms))
+    sections[b"COMPS"] = comps
+    sections[b"OVERRIDE"] = override_records
+    sections[b"WINDOWS"] = windows
+    sections[b"STRINGS"] = strings.blob
+    return sections
+
+def _write(path, sections, watermark):
+    names = list(_RECORDS) + [b"STRINGS"]
+    offset = _HEADER.size + _SECTION.size * len(names)
+    directory, chunks = [], []
+    for name in names:
+        if name == b"STRINGS":
+            data, count, size = bytes(sections[name]), len(sections[name]), 1
+        else:
+            record = _RECORDS[name]
+            data = b"".join(record.pack(*r) for r in sections[name])
+            count, size = len(sections[name]), record.size
+        directory.append(_SECTION.pack(name, offset, count, size))
+        chunks.append(data)
+        offset += len(data)
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(names), watermark, time.time()))
+        for entry in directory:
+            f.write(entry)
+        for data in chunks:
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return offset
+
+def export_snapshot(engine: Engine, path, retention_days=CATALOG_CHANGES_RETENTION_DAYS):
+    # Scrive lo snapshot e lo pubblica con un rename atomico -> riepilogo
+    started = time.perf_counter()
+    postgres = engine.dialect.name == "postgresql"
+    with engine.connect() as lock_conn, engine.connect() as conn:
+        if postgres:
+            conn.execution_options(isolation_level="REPEATABLE READ")
+            # Con il lock SHARE non ci sono transazioni aperte che scrivono nel registro: il
+            # change_id letto qui sotto copre tutte le modifiche visibili nella transazione
+            # dell'export, e le successive avranno un id maggiore.
+            lock_conn.execute(text("LOCK TABLE catalog_changes IN SHARE MODE"))
+        watermark = conn.execute(select(func.coalesce(func.max(CatalogChange.change_id), 0))).scalar()
+        lock_conn.commit()
+        sections = _read_catalog(conn)
+    size = _write(path, sections, watermark)
+
+    pruned = 0
+    if retention_days is not None:
+        with engine.begin() as conn:
+            pruned = conn.execute(delete(CatalogChange).where(
+                CatalogChange.change_id <= watermark,
+                CatalogChange.changed_at < datetime.utcnow() - timedelta(days=retention_days)
+            )).rowcount
+    return {
+        "path": path,
+        "bytes": size,
+        "change_id": watermark,
+        "products": len(sections[b"PRODUCTS"]),
+        "boms": len(sections[b"BOMS"]),
+        "bom_components": len(sections[b"COMPS"]),
+        "materials": len(sections[b"MATS"]),
+        "operations": len(sections[b"OPS"]),
+        "cost_windows": len(sections[b"WINDOWS"]),
+        "changes_pruned": pruned,
+        "elapsed_s": round(time.perf_counter() - started, 3),
+    }
+
+# --- lettura ---
+
+class CatalogSnapshot:
+    # Un file di snapshot aperto con mmap. Le ricerche restituiscono (trovati, mancanti): i
+    # mancanti (chiavi stale o assenti dal file) vanno cercati nel DB.
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.identity = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_sections, self.change_id, self.created_at = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path}: non e' uno snapshot del catalogo (formato {version})")
+        self.path = path
+        self._sections = {}
+        for i in range(n_sections):
+            name, offset, count, size = _SECTION.unpack_from(self._mm, _HEADER.size + i * _SECTION.size)
+            self._sections[name.rstrip(b"\0")] = (offset, count, size)
+        self.stale = set()  # chiavi (tipo, id) di catalog_changes modificate dopo l'export
+
+    @property
+    def size(self):
+        return len(self._mm)
+
+    def _record(self, name, i):
+        offset, _, size = self._sections[name]
+        return _RECORDS[name].unpack_from(self._mm, offset + i * size)
+
+    def _find(self, name, key):
+        # Bisezione sulla chiave (UUID, 16 byte big-endian) in testa ai record -> indice o -1
+        offset, count, size = self._sections[name]
+        mm = self._mm
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = offset + mid * size
+            if mm[pos:pos + 16] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < count and mm[offset + lo * size:offset + lo * size + 16] == key:
+            return lo
+        return -1
+
+    def _string(self, off, length):
+        start = self._sections[b"STRINGS"][0] + off
+        return self._mm[start:start + length].decode()
+
+    def _window_cost(self, start, count, as_of):
+        # Come cost_index._Windows.at: la finestra valida alla data con valid_from piu' recente
+        day = as_of.toordinal()
+        offset, _, size = self._sections[b"WINDOWS"]
+        record = _RECORDS[b"WINDOWS"]
+        starts = [record.unpack_from(self._mm, offset + (start + k) * size)[0] for k in range(count)]
+        i = bisect_right(starts, day)
+        while i > 0:
+            i -= 1
+            _, valid_to, cost = record.unpack_from(self._mm, offset + (start + i) * size)
+            if valid_to == 0 or valid_to >= day:
+                return cost
+        return None
+
+    def boms(self, product_ids, as_of):
+        # Stessa regola di explosion.load_boms: l'attiva con versione piu' alta, altrimenti la
+        # valida alla data con versione piu' alta.
+        day = as_of.toordinal()
+        found, missing = {}, set()
+        for pid in product_ids:
+            p_idx = self._find(b"PRODUCTS", pid.bytes) if ("bom", pid) not in self.stale else -1
+            if p_idx < 0:
+                missing.add(pid)
+                continue
+            _, bom_start, bom_count, _, _ = self._record(b"PRODUCTS", p_idx)
+            active = valid = None
+            for i in range(bom_start, bom_start + bom_count):
+                bom_id, _, version, is_active, valid_from, valid_to, _, _ = self._record(b"BOMS", i)
+                if is_active and (active is None or version > active[1]):
+                    active = (bom_id, version)
+                if valid_from <= day and (valid_to == 0 or valid_to >= day) and (valid is None or version > valid[1]):
+                    valid = (bom_id, version)
+            best = active or valid
+            found[pid] = SnapshotBom(UUID(bytes=best[0]), pid, best[1]) if best else None
+        return found, missing
+
+    def components(self, bom_ids):
+        found, missing = {}, set()
+        for bom_id in bom_ids:
+            b_idx = self._find(b"BOMINDEX", bom_id.bytes) if ("bom_component", bom_id) not in self.stale else -1
+            if b_idx < 0:
+                missing.add(bom_id)
+                continue
+            _, bom_record = self._record(b"BOMINDEX", b_idx)
+            _, _, _, _, _, _, comp_start, comp_count = self._record(b"BOMS", bom_record)
+            comps = []
+            for i in range(comp_start, comp_start + comp_count):
+                line_no, kind_off, kind_len, ref_id, quantity, waste_pct, override = self._record(b"COMPS", i)
+                comps.append(SnapshotComponent(
+                    bom_id, line_no, self._string(kind_off, kind_len), UUID(bytes=ref_id), quantity, waste_pct,
+                    None if math.isnan(override) else override
+                ))
+            found[bom_id] = comps
+        return found, missing
+
+    def list_costs(self, kind, ref_ids, as_of):
+        # kind: "material" | "operation" -> ({ref_id: costo valido alla data}, mancanti)
+        section = b"MATS" if kind == "material" else b"OPS"
+        found, missing = {}, set()
+        for ref_id in ref_ids:
+            idx = self._find(section, ref_id.bytes) if (f"{kind}_cost", ref_id) not in self.stale else -1
+            if idx < 0:
+                missing.add(ref_id)
+                continue
+            _, start, count, _, _, _, _ = self._record(section, idx)
+            cost = self._window_cost(start, count, as_of) if count else None
+            if cost is not None:
+                found[ref_id] = cost
+        return found, missing
+
+    def product_overrides(self, keys, as_of):
+        # keys: (product_id, kind, ref_id) -> ({chiave: costo}, chiavi mancanti)
+        found, missing = {}, set()
+        for key in keys:
+            pid, kind, ref_id = key
+            p_idx = self._find(b"PRODUCTS", pid.bytes) if ("product_override", pid) not in self.stale else -1
+            if p_idx < 0:
+                missing.add(key)
+                continue
+            _, _, _, ovr_start, ovr_count = self._record(b"PRODUCTS", p_idx)
+            for i in range(ovr_start, ovr_start + ovr_count):
+                kind_off, kind_len, ovr_ref, start, count = self._record(b"OVERRIDE", i)
+                if ovr_ref == ref_id.bytes and self._string(kind_off, kind_len) == kind:
+                    cost = self._window_cost(start, count, as_of)
+                    if cost is not None:
+                        found[key] = cost
+                    break
+        return found, missing
+
+    def master_data(self, kind, ref_ids):
+        # -> ({ref_id: (name, uom)}, mancanti)
+        section = b"MATS" if kind == "material" else b"OPS"
+        found, missing = {}, set()
+        for ref_id in ref_ids:
+            idx = self._find(section, ref_id.bytes) if (kind, ref_id) not in self.stale else -1
+            if idx < 0:
+                missing.add(ref_id)
+                continue
+            _, _, _, name_off, name_len, uom_off, uom_len = self._record(section, idx)
+            found[ref_id] = (self._string(name_off, name_len), self._string(uom_off, uom_len))
+        return found, missing
+
+class CatalogSnapshotStore:
+    # Snapshot corrente del processo: apertura, cambio atomico quando l'export ne pubblica uno
+    # nuovo e chiavi stale lette da catalog_changes.
+
+    def __init__(self, path=CATALOG_SNAPSHOT, poll_s=CATALOG_SNAPSHOT_POLL_S):
+        self.path = path
+        self.poll_s = poll_s
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._changes = ChangeCursor()
+        self.swaps = 0
+        self.errors = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def current(self):
+        return self._snapshot
+
+    def refresh(self, engine: Engine):
+        # Passa a un file nuovo (se pubblicato) e legge le modifiche registrate dopo l'ultima lettura
+        if not self.enabled:
+            return
+        with self._lock:
+            try:
+                identity = os.stat(self.path)
+            except FileNotFoundError:
+                return
+            snapshot = self._snapshot
+            if snapshot is None or (identity.st_ino, identity.st_mtime_ns) != (
+                    snapshot.identity.st_ino, snapshot.identity.st_mtime_ns):
+                snapshot = CatalogSnapshot(self.path)
+                self._changes = ChangeCursor(snapshot.change_id)
+                self._read_changes(engine, snapshot)
+                self._snapshot = snapshot
+                self.swaps += 1
+                log.info("Snapshot del catalogo %s (change_id %s) in uso", self.path, snapshot.change_id)
+            else:
+                self._read_changes(engine, snapshot)
+
+    def _read_changes(self, engine, snapshot):
+        with engine.connect() as conn:
+            snapshot.stale.update(self._changes.read(conn))
+
+    def mark_stale(self, keys):
+        snapshot = self._snapshot
+        if snapshot is not None:
+            snapshot.stale.update(keys)
+
+    def start(self, engine: Engine):
+        if not self.enabled or self._thread is not None:
+            return
+        try:
+            self.refresh(engine)
+        except Exception:
+            self.errors += 1
+            log.exception("Snapshot del catalogo %s non utilizzabile, uso il DB", self.path)
+
+        def run():
+            while not self._stop.wait(self.poll_s):
+                try:
+                    self.refresh(engine)
+                except Exception:
+                    self.errors += 1
+                    log.exception("Aggiornamento dello snapshot del catalogo fallito")
+
+        self._thread = threading.Thread(target=run, name="catalog-snapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "loaded": snapshot is not None,
+            "change_id": snapshot.change_id if snapshot else None,
+            "created_at": datetime.utcfromtimestamp(snapshot.created_at).isoformat() if snapshot else None,
+            "bytes": snapshot.size if snapshot else None,
+            "stale_keys": len(snapshot.stale) if snapshot else 0,
+            "changes_seen": self._changes.seen,
+            "swaps": self.swaps,
+            "errors": self.errors,
+        }
+
+catalog_snapshot = CatalogSnapshotStore()
+
+@on_catalog_change
+def _stale_changes(keys):
+    catalog_snapshot.mark_stale(keys)
+
+def _snapshot_age():
+    snapshot = catalog_snapshot.current()
+    return {(): round(time.time() - snapshot.created_at, 1)} if snapshot is not None else {}
+
+Gauge("priceforge_catalog_snapshot_age_seconds", "Eta' dello snapshot del catalogo in uso", _snapshot_age)
+Gauge("priceforge_catalog_snapshot_stale_keys", "Chiavi dello snapshot del catalogo servite dal DB",
+      lambda: {(): catalog_snapshot.stats()["stale_keys"]})
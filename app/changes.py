@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from sqlalchemy import event, insert, select, text
+from sqlalchemy.orm import Session
+from .models import (
+    Product, Material, MaterialCost, Operation, OperationCost, BOM, BOMComponent,
+    ProductCostOverride, PricingSettings, CatalogChange
+)
+
+# Notifica delle modifiche al catalogo. Le scritture ORM su prodotti, BOM, costi e impostazioni
+# vengono raccolte al flush come chiavi (tipo, id) e, solo a commit avvenuto, incrementano
+# catalog_version e vengono passate ai listener registrati con on_catalog_change (cache e indici).
+# Le stesse chiavi sono registrate anche in catalog_changes, nella transazione della modifica,
+# cosi' chi legge una copia del catalogo (snapshot mmap) sa cosa e' cambiato dopo l'export.
+# Le funzioni registrate con on_changes_recorded girano in quella stessa transazione (per esempio
+# per marcare stale le righe del listino pubblicato toccate).
+# Le scritture fatte fuori dall'ORM (bulk insert/update) devono chiamare record_changes nella
+# propria transazione e publish_changes dopo il commit.
+#
+# CATALOG_NOTIFY=1   propaga le modifiche agli altri processi/worker via Postgres LISTEN/NOTIFY
+
+CATALOG_NOTIFY = os.getenv("CATALOG_NOTIFY", "0") == "1"
+NOTIFY_CHANNEL = "pf_catalog_changes"
+
+_KEYS = (
+    (MaterialCost, lambda o: ("material_cost", o.material_id)),
+    (OperationCost, lambda o: ("operation_cost", o.operation_id)),
+    (ProductCostOverride, lambda o: ("product_override", o.product_id)),
+    (BOMComponent, lambda o: ("bom_component", o.bom_id)),
+    (BOM, lambda o: ("bom", o.product_id)),
+    (Material, lambda o: ("material", o.material_id)),
+    (Operation, lambda o: ("operation", o.operation_id)),
+    (Product, lambda o: ("product", o.product_id)),
+    (PricingSettings, lambda o: ("settings", None)),
+)
+
+_listeners = []
+_recorders = []
+_lock = threading.Lock()
+catalog_version = 0
+
+def on_catalog_change(fn):
+    # fn(keys): keys e' un set di (tipo, id)
+    _listeners.append(fn)
+    return fn
+
+def on_changes_recorded(fn):
+    # fn(conn, keys): chiamata da record_changes nella transazione della modifica, prima del commit
+    _recorders.append(fn)
+    return fn
+
+def get_catalog_version():
+    return catalog_version
+
+def publish_changes(keys, notify=True):
+    global catalog_version
+    keys = set(keys)
+    if not keys:
+        return
+    with _lock:
+        catalog_version += 1
+    for fn in _listeners:
+        fn(keys)
+    if notify and CATALOG_NOTIFY:
+        _notify(keys)
+
+def record_changes(conn, keys):
+    # Registra le chiavi modificate in catalog_changes (nessun commit)
+    now = datetime.utcnow()
+    rows = [{"kind": kind, "ref_id": ref_id, "changed_at": now} for kind, ref_id in keys]
+    if rows:
+        conn.execute(insert(CatalogChange), rows)
+        for fn in _recorders:
+            fn(conn, keys)
+
+# Lettura incrementale del registro (snapshot mmap, listino pubblicato). Un change_id mancante
+# puo' essere una transazione ancora aperta: lo si riattende per al massimo GAP_TIMEOUT_S
+# secondi, poi lo si considera annullato.
+GAP_TIMEOUT_S = 600
+
+class ChangeCursor:
+    def __init__(self, seen=0):
+        self.seen = seen        # tutti i change_id <= seen sono stati letti (o scaduti)
+        self._pending = {}      # change_id mancanti sopra seen -> primo istante in cui mancavano
+        self._after = set()     # change_id gia' letti sopra seen
+
+    def read(self, conn):
+        # -> chiavi (tipo, id) registrate dopo l'ultima lettura
+        rows = conn.execute(
+            select(CatalogChange.change_id, CatalogChange.kind, CatalogChange.ref_id)
+            .where(CatalogChange.change_id > self.seen)
+        ).all()
+        keys = set()
+        for change_id, kind, ref_id in rows:
+            if change_id not in self._after:
+                keys.add((kind, ref_id))
+                self._after.add(change_id)
+        # Avanza seen sugli id contigui; i buchi restano in attesa fino a GAP_TIMEOUT_S.
+        now = time.monotonic()
+        top = max(self._after, default=self.seen)
+        for change_id in range(self.seen + 1, top + 1):
+            if change_id not in self._after:
+                self._pending.setdefault(change_id, now)
+        while self.seen < top:
+            nxt = self.seen + 1
+            if nxt in self._after:
+                self._after.discard(nxt)
+            elif now - self._pending.get(nxt, now) > GAP_TIMEOUT_S:
+                self._pending.pop(nxt, None)
+            else:
+                break
+            self._pending.pop(nxt, None)
+            self.seen = nxt
+        return keys
+
+def _change_key(obj):
+    for model, key in _KEYS:
+        if isinstance(obj, model):
+            return key(obj)
+    return None
+
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session, flush_context):
+    keys = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        key = _change_key(obj)
+        if key is not None:
+            keys.add(key)
+    if keys:
+        session.info.setdefault("pf_catalog_changes", set()).update(keys)
+        record_changes(session.connection(), keys)
+
+@event.listens_for(Session, "after_commit")
+def _publish_commit(session):
+    keys = session.info.pop("pf_catalog_changes", None)
+    if keys:
+        publish_changes(keys)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session):
+    session.info.pop("pf_catalog_changes", None)
+
+# Propagazione tra processi via LISTEN/NOTIFY (solo Postgres).
+
+def _notify(keys):
+    from .database import engine
+    # Un solo statement anche per le migliaia di chiavi di un import massivo
+    payloads = [f"{kind}:{ref_id or ''}" for kind, ref_id in keys]
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_notify(:c, p) FROM unnest(CAST(:ps AS text[])) AS p"),
+                     {"c": NOTIFY_CHANNEL, "ps": payloads})
+        conn.commit()
+
+def start_notify_listener(engine, poll_timeout=5.0):
+    import select as _select
+
+    def run():
+        raw = engine.raw_connection()
+        try:
+            dbapi_conn = raw.driver_connection
+            dbapi_conn.autocommit = True
+            dbapi_conn.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+            while True:
+                if _select.select([dbapi_conn], [], [], poll_timeout) == ([], [], []):
+                    continue
+                dbapi_conn.poll()
+                keys = set()
+                while dbapi_conn.notifies:
+                    kind, _, ref = dbapi_conn.notifies.pop(0).payload.partition(":")
+                    keys.add((kind, uuid.UUID(ref) if ref else None))
+                # Le nostre stesse notifiche tornano indietro: invalidare due volte e' innocuo.
+                publish_changes(keys, notify=False)
+        finally:
+            raw.close()
+
+    t = threading.Thread(target=run, name="catalog-notify-listener", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,131 @@
+import argparse
+import json
+import sys
+import uuid
+from datetime import date, datetime
+from sqlalchemy import func, select, text
+from app.database import engine
+from app.explosion import _valid_at
+from app.migrations import migrate
+from app.search import fuzzy_query, prefix_query
+from app.synthetic import generate_catalog
+from app.models import (
+    BOM, BOMComponent, Material, MaterialCost, Operation, OperationCost, Product,
+    ProductCostOverride, PriceCalculationRun, PriceCalculationDetail
+)
+
+# Controllo di regressione dei piani di esecuzione: esegue EXPLAIN sulle query calde del pricing
+# e fallisce (exit 1) se una di esse legge con Seq Scan una tabella grande. Va lanciato su un DB
+# Postgres di prova; --populate lo riempie prima con un catalogo sintetico di dimensione --products.
+#   DATABASE_URL=postgresql://.../priceforge_plans python app/check_plans.py --populate --products 20000
+# Lo stesso controllo gira con pytest (tests/test_query_plans.py), saltato se DATABASE_URL non e'
+# un Postgres.
+
+HOT_TABLES = {
+    "products", "materials", "operations", "material_costs", "operation_costs",
+    "product_cost_overrides", "boms", "bom_components", "price_calculation_runs", "price_calculation_details",
+}
+# Le partizioni mensili (<tabella>_yAAAAmMM, <tabella>_default) contano come la tabella madre
+PARTITION_PREFIXES = ("price_calculation_runs_", "price_calculation_details_")
+SAMPLE = 50
+# Sotto questa dimensione (es. partizioni vuote o appena create) un Seq Scan e' la scelta giusta
+MIN_ROWS = 1000
+AS_OF = date.today()
+
+def hot_queries(conn):
+    # Le stesse forme di query di explosion.py e dei router, con liste IN realistiche.
+    def sample(col):
+        return list(conn.execute(select(col).order_by(func.random()).limit(SAMPLE)).scalars())
+    product_ids = sample(Product.product_id)
+    bom_ids = sample(BOM.bom_id)
+    material_ids = sample(Material.material_id)
+    operation_ids = sample(Operation.operation_id)
+    sku = conn.execute(select(Product.sku).limit(1)).scalar_one()
+    code = conn.execute(select(Material.code).limit(1)).scalar_one()
+    return {
+        "boms_active": select(BOM).where(BOM.product_id.in_(product_ids), BOM.is_active == True),
+        "boms_valid": select(BOM).where(BOM.product_id.in_(product_ids), _valid_at(BOM, AS_OF)),
+        "bom_components": select(BOMComponent).where(BOMComponent.bom_id.in_(bom_ids)),
+        "material_costs": select(MaterialCost.material_id, MaterialCost.unit_cost, MaterialCost.valid_from)
+            .where(MaterialCost.material_id.in_(material_ids), _valid_at(MaterialCost, AS_OF)),
+        "operation_costs": select(OperationCost.operation_id, OperationCost.unit_cost, OperationCost.valid_from)
+            .where(OperationCost.operation_id.in_(operation_ids), _valid_at(OperationCost, AS_OF)),
+        "product_overrides": select(ProductCostOverride.product_id, ProductCostOverride.kind,
+                                    ProductCostOverride.ref_id, ProductCostOverride.override_unit_cost,
+                                    ProductCostOverride.valid_from)
+            .where(ProductCostOverride.product_id.in_(product_ids), _valid_at(ProductCostOverride, AS_OF)),
+        "materials_by_id": select(Material).where(Material.material_id.in_(material_ids)),
+        "products_by_id": select(Product).where(Product.product_id.in_(product_ids)),
+        "product_by_sku": select(Product).where(Product.sku == sku),
+        "product_by_sku_ci": select(Product).where(func.lower(Product.sku) == sku.lower()),
+        "product_by_name_ci": select(Product).where(func.lower(Product.name) == "prodotto 1"),
+        "material_by_code_ci": select(Material).where(func.lower(Material.code) == code.lower()),
+        "material_by_name_ci": select(Material).where(func.lower(Material.name) == "material 1"),
+        "operation_by_code_ci": select(Operation).where(func.lower(Operation.code) == "o00000001"),
+        "operation_by_name_ci": select(Operation).where(func.lower(Operation.name) == "operation 1"),
+        "product_search_sku_prefix": prefix_query(Product, Product.sku, sku.lower()[:4], 20),
+        "product_search_name_prefix": prefix_query(Product, Product.name, "prodotto 12", 20),
+        "product_search_fuzzy": fuzzy_query(Product, Product.sku, "prodoto 123", 20),
+        "material_search_fuzzy": fuzzy_query(Material, Material.code, "materail 12", 20),
+        "products_page": select(Product).where(Product.sku > sku).order_by(Product.sku).limit(101),
+        "run_details": select(PriceCalculationDetail).where(PriceCalculationDetail.run_id == uuid.uuid4()),
+        "run_history": select(PriceCalculationRun)
+            .where(PriceCalculationRun.product_id == product_ids[0],
+                   PriceCalculationRun.calculated_at >= datetime(AS_OF.year, AS_OF.month, 1))
+            .order_by(PriceCalculationRun.calculated_at.desc(), PriceCalculationRun.run_id.desc()).limit(101),
+    }
+
+def seq_scans(node, found=None):
+    found = [] if found is None else found
+    relation = node.get("Relation Name") or ""
+    if node.get("Node Type") == "Seq Scan" and (relation in HOT_TABLES or relation.startswith(PARTITION_PREFIXES)):
+        found.append(relation)
+    for child in node.get("Plans", ()):
+        seq_scans(child, found)
+    return found
+
+def explain(conn, stmt):
+    compiled = stmt.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + str(compiled), compiled.params).scalar_one()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+def large(conn, relations):
+    return [r for r in relations if (conn.execute(
+        text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:name)"), {"name": r}
+    ).scalar() or 0) >= MIN_ROWS]
+
+def prepare(engine, populate_products=0):
+    # Migra, riempie (se richiesto) e aggiorna le statistiche del planner
+    migrate(engine)
+    if populate_products:
+        with engine.begin() as conn:
+            generate_catalog(conn, products=populate_products)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("ANALYZE"))
+
+def check(conn, report=None):
+    # -> {query: [tabelle grandi lette con Seq Scan]}; report(riga) per l'esito di ogni query
+    failures = {}
+    for name, stmt in hot_queries(conn).items():
+        plan = explain(conn, stmt)
+        scans = large(conn, seq_scans(plan))
+        if report is not None:
+            report(f"{'SEQ SCAN' if scans else 'ok':8} {name:26} {plan['Node Type']} (cost {plan['Total Cost']})")
+        if scans:
+            failures[name] = scans
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verifica che le query calde non usino Seq Scan")
+    parser.add_argument("--populate", action="store_true", help="riempie il DB (di prova!) con un catalogo sintetico")
+    parser.add_argument("--products", type=int, default=20000, help="prodotti del catalogo sintetico")
+    args = parser.parse_args()
+    if engine.dialect.name != "postgresql":
+        sys.exit("check_plans richiede Postgres")
+    prepare(engine, args.products if args.populate else 0)
+    with engine.connect() as conn:
+        failures = check(conn, report=print)
+    if failures:
+        sys.exit(f"Seq Scan su tabelle calde: {failures}")
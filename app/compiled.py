@@ -0,0 +1,181 @@
+import os
+import threading
+from collections import OrderedDict
+from sqlalchemy.orm import Session
+from .changes import on_catalog_change
+from .explosion import BomTree, PriceLine
+
+# Cache delle BOM "compilate". Il risultato dell'esplosione e' lineare nella quantita' richiesta,
+# quindi basta risolvere BOM e costi una volta per (prodotto, data) e poi scalare. I sottoassiemi
+# sono compilati una volta sola e riusati da tutti i padri (i costi dipendono solo dalla BOM del
+# sottoassieme stesso).
+#
+# La BOM compilata conserva la struttura ad albero: scale() ripete la visita di
+# BomTree.expand con le stesse moltiplicazioni e somme nello stesso ordine, per cui righe e totali
+# sono identici bit per bit a quelli dell'esplosione (non qty * (a * b) al posto di (qty * a) * b).
+#
+# La chiave e' (product_id, as_of, epoch): la BOM risolta dipende solo da prodotto e data, e
+# l'epoch cambia a ogni modifica di BOM, componenti, costi, override o anagrafiche.
+#
+# COMPILED_BOM_CACHE=1                abilita la cache
+# COMPILED_BOM_CACHE_MAX_LINES        numero massimo di righe compilate in memoria (LRU)
+
+COMPILED_BOM_CACHE_ENABLED = os.getenv("COMPILED_BOM_CACHE", "0") == "1"
+COMPILED_BOM_CACHE_MAX_LINES = int(os.getenv("COMPILED_BOM_CACHE_MAX_LINES", "1000000"))
+
+_INVALIDATING = {
+    "bom", "bom_component", "material_cost", "operation_cost", "product_override", "material", "operation"
+}
+
+class CompiledBom:
+    __slots__ = ("product_id", "bom_id", "steps", "size", "unit_material", "unit_operation")
+
+    def __init__(self, product_id, bom_id):
+        self.product_id = product_id
+        self.bom_id = bom_id
+        # (quantita' per unita', CompiledBom del sottoassieme) oppure
+        # (quantita' per unita', (kind, ref_id, description, uom, unit_cost, source))
+        self.steps = []
+        self.size = 0           # righe dell'esplosione, sottoassiemi compresi
+        self.unit_material = 0.0
+        self.unit_operation = 0.0
+
+    def __len__(self):
+        return self.size
+
+    def scale(self, qty):
+        # -> (items, total_material, total_operation) per la quantita' richiesta
+        items = []
+        _, total_mat, total_op = self._scale(qty, items, 1)
+        return items, total_mat, total_op
+
+    def _scale(self, qty, items, cur_line):
+        # Stesse operazioni, nello stesso ordine, di BomTree.expand
+        total_mat = 0.0
+        total_op = 0.0
+        for qty_per_unit, step in self.steps:
+            eff_qty = qty * qty_per_unit
+            if isinstance(step, CompiledBom):
+                cur_line, sub_mat, sub_op = step._scale(eff_qty, items, cur_line)
+                total_mat += sub_mat
+                total_op += sub_op
+                continue
+            kind, ref_id, desc, uom, unit_cost, source = step
+            extended = eff_qty * unit_cost
+            if kind == "material":
+                total_mat += extended
+            elif kind == "operation":
+                total_op += extended
+            items.append(PriceLine(cur_line, kind, ref_id, desc, uom, eff_qty, unit_cost, extended, source))
+            cur_line += 1
+        return cur_line, total_mat, total_op
+
+class CompiledBomCache:
+    def __init__(self, enabled=COMPILED_BOM_CACHE_ENABLED, max_lines=COMPILED_BOM_CACHE_MAX_LINES):
+        self.enabled = enabled
+        self.max_lines = max_lines
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # (product_id, as_of, epoch) -> CompiledBom
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        with self._lock:
+            if key[2] != self.epoch:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = entry
+            self._size += len(entry)
+            while self._size > self.max_lines and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def is_compiled(self, product_id, as_of):
+        return self._get((product_id, as_of, self.epoch)) is not None
+
+    def compile(self, session: Session, tree: BomTree, product_id):
+        epoch = self.epoch
+        key = (product_id, tree.as_of, epoch)
+        entry = self._get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        # Carica solo i rami non ancora compilati.
+        tree.load(session, [product_id], skip=lambda pid: self._get((pid, tree.as_of, epoch)) is not None)
+        return self._compile(session, tree, product_id, epoch, ())
+
+    def _compile(self, session, tree, product_id, epoch, path):
+        key = (product_id, tree.as_of, epoch)
+        entry = self._get(key)
+        if entry is not None:
+            return entry
+        if product_id not in tree.boms:
+            # Sottoassieme saltato al caricamento ma nel frattempo uscito dalla cache.
+            tree.load(session, [product_id])
+        bom = tree.bom_for(product_id)
+        if product_id in path:
+            raise ValueError(f"BOM ciclica per product_id={product_id}")
+        path = path + (product_id,)
+
+        entry = CompiledBom(product_id, bom.bom_id)
+        for comp in tree.components[bom.bom_id]:
+            qty_per_unit = float(comp.quantity) * (1.0 + float(comp.waste_pct or 0)/100.0)
+
+            if comp.kind == "product":
+                sub = self._compile(session, tree, comp.ref_id, epoch, path)
+                entry.steps.append((qty_per_unit, sub))
+                entry.size += sub.size
+                entry.unit_material += qty_per_unit * sub.unit_material
+                entry.unit_operation += qty_per_unit * sub.unit_operation
+                continue
+
+            unit_cost, source = tree.resolve_cost(bom.product_id, comp)
+            desc, uom = None, None
+            if comp.kind == "material":
+                desc, uom = tree.materials.get(comp.ref_id, (None, None))
+                entry.unit_material += qty_per_unit * unit_cost
+            elif comp.kind == "operation":
+                desc, uom = tree.operations.get(comp.ref_id, (None, None))
+                entry.unit_operation += qty_per_unit * unit_cost
+            entry.steps.append((qty_per_unit, (comp.kind, comp.ref_id, desc, uom, unit_cost, source)))
+            entry.size += 1
+
+        self._put(key, entry)
+        return entry
+
+    def invalidate_all(self):
+        with self._lock:
+            self.epoch += 1
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "epoch": self.epoch,
+                "entries": len(self._entries),
+                "lines": self._size,
+                "max_lines": self.max_lines,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+compiled_cache = CompiledBomCache()
+
+@on_catalog_change
+def _invalidate_compiled(keys):
+    if any(kind in _INVALIDATING for kind, _ in keys):
+        compiled_cache.invalidate_all()
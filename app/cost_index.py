@@ -0,0 +1,189 @@
+import os
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .changes import on_catalog_change
+from .database import in_chunks
+from .models import MaterialCost, OperationCost, ProductCostOverride
+
+# Indice in memoria delle finestre di validita' dei costi (listino materiali/lavorazioni e
+# override di prodotto). Le finestre di una chiave vengono caricate una volta sola dal DB,
+# ordinate per valid_from, e la domanda "costo valido alla data X" diventa una bisect.
+#
+# COST_INDEX=1              abilita l'indice (default: query dirette al DB)
+# COST_INDEX_MAX_WINDOWS    numero massimo di finestre tenute in memoria (LRU per chiave)
+#
+# Le chiavi vengono invalidate dalle modifiche pubblicate da changes.py.
+
+COST_INDEX_ENABLED = os.getenv("COST_INDEX", "0") == "1"
+COST_INDEX_MAX_WINDOWS = int(os.getenv("COST_INDEX_MAX_WINDOWS", "500000"))
+
+class _Windows:
+    __slots__ = ("starts", "rows")
+
+    def __init__(self, rows):
+        # rows: (valid_from, valid_to, unit_cost)
+        rows = sorted(rows, key=lambda r: r[0])
+        self.starts = [r[0] for r in rows]
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def at(self, as_of):
+        # Stessa semantica di ORDER BY valid_from DESC LIMIT 1 sulle righe valide alla data.
+        i = bisect_right(self.starts, as_of)
+        while i > 0:
+            i -= 1
+            valid_from, valid_to, cost = self.rows[i]
+            if valid_to is None or valid_to >= as_of:
+                return cost
+        return None
+
+class CostIndex:
+    def __init__(self, enabled=COST_INDEX_ENABLED, max_windows=COST_INDEX_MAX_WINDOWS):
+        self.enabled = enabled
+        self.max_windows = max_windows
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> _Windows (None = chiave senza costi)
+        self._size = 0
+        self._lock = threading.RLock()
+
+    # --- lookup ---
+
+    def material_costs(self, session: Session, material_ids, as_of):
+        return self._lookup(session, "material", material_ids, as_of)
+
+    def operation_costs(self, session: Session, operation_ids, as_of):
+        return self._lookup(session, "operation", operation_ids, as_of)
+
+    def product_overrides(self, session: Session, keys, as_of):
+        # keys: (product_id, kind, ref_id). Le finestre sono indicizzate per prodotto.
+        by_product = self._load(session, "override", {k[0] for k in keys})
+        out = {}
+        for key in keys:
+            windows = (by_product.get(key[0]) or {}).get((key[1], key[2]))
+            cost = windows.at(as_of) if windows else None
+            if cost is not None:
+                out[key] = cost
+        return out
+
+    def _lookup(self, session, kind, ref_ids, as_of):
+        entries = self._load(session, kind, ref_ids)
+        out = {}
+        for ref_id, windows in entries.items():
+            cost = windows.at(as_of) if windows else None
+            if cost is not None:
+                out[ref_id] = cost
+        return out
+
+    def _load(self, session, kind, ids):
+        found, missing = {}, []
+        with self._lock:
+            for ref_id in ids:
+                key = (kind, ref_id)
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[ref_id] = self._entries[key]
+                    self.hits += 1
+                else:
+                    missing.append(ref_id)
+                    self.misses += 1
+            version = self.version
+        if missing:
+            loaded = _LOADERS[kind](session, missing)
+            with self._lock:
+                for ref_id in missing:
+                    entry = loaded.get(ref_id)
+                    found[ref_id] = entry
+                    # Se nel frattempo e' arrivata un'invalidazione, non salviamo dati forse vecchi.
+                    if version == self.version:
+                        self._put((kind, ref_id), entry)
+        return found
+
+    def _put(self, key, entry):
+        old = self._entries.pop(key, None)
+        self._size -= _entry_size(old)
+        self._entries[key] = entry
+        self._size += _entry_size(entry)
+        while self._size > self.max_windows and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= _entry_size(evicted)
+
+    # --- invalidazione ---
+
+    def invalidate(self, kind, ref_id):
+        with self._lock:
+            self.version += 1
+            entry = self._entries.pop((kind, ref_id), None)
+            self._size -= _entry_size(entry)
+
+    def invalidate_all(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "version": self.version,
+                "keys": len(self._entries),
+                "windows": self._size,
+                "max_windows": self.max_windows,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+def _entry_size(entry):
+    if entry is None:
+        return 0
+    if isinstance(entry, dict):
+        return sum(len(w) for w in entry.values()) or 1
+    return len(entry) or 1
+
+def _load_list_windows(table, id_field):
+    id_col = getattr(table, id_field)
+
+    def load(session, ref_ids):
+        rows = {}
+        for chunk in in_chunks(ref_ids):
+            for ref_id, valid_from, valid_to, cost in session.execute(
+                select(id_col, table.valid_from, table.valid_to, table.unit_cost).where(id_col.in_(chunk))
+            ):
+                rows.setdefault(ref_id, []).append((valid_from, valid_to, cost))
+        return {ref_id: _Windows(r) for ref_id, r in rows.items()}
+    return load
+
+def _load_override_windows(session, product_ids):
+    rows = {}
+    for chunk in in_chunks(product_ids):
+        for pid, kind, ref_id, valid_from, valid_to, cost in session.execute(
+            select(
+                ProductCostOverride.product_id, ProductCostOverride.kind, ProductCostOverride.ref_id,
+                ProductCostOverride.valid_from, ProductCostOverride.valid_to, ProductCostOverride.override_unit_cost
+            ).where(ProductCostOverride.product_id.in_(chunk))
+        ):
+            rows.setdefault(pid, {}).setdefault((kind, ref_id), []).append((valid_from, valid_to, cost))
+    return {pid: {k: _Windows(r) for k, r in by_key.items()} for pid, by_key in rows.items()}
+
+_LOADERS = {
+    "material": _load_list_windows(MaterialCost, "material_id"),
+    "operation": _load_list_windows(OperationCost, "operation_id"),
+    "override": _load_override_windows,
+}
+
+cost_index = CostIndex()
+
+_CHANGE_KINDS = {"material_cost": "material", "operation_cost": "operation", "product_override": "override"}
+
+@on_catalog_change
+def _invalidate_cost_changes(keys):
+    for kind, ref_id in keys:
+        if kind in _CHANGE_KINDS:
+            cost_index.invalidate(_CHANGE_KINDS[kind], ref_id)
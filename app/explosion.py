@@ -0,0 +1,305 @@
+from dataclasses import dataclass
+from typing import Optional
+from uuid import UUID
+from sqlalchemy.orm import Session
+from sqlalchemy import select
+from .catalog_snapshot import catalog_snapshot
+from .cost_index import cost_index
+from .database import in_chunks
+from .metrics import stage
+from .models import (
+    BOM, BOMComponent, Material, MaterialCost, Operation, OperationCost, ProductCostOverride
+)
+
+# Esplosione BOM set-based: invece di una query per ogni (sotto)prodotto e per ogni riga,
+# carica un livello di BOM alla volta e poi costi, override e anagrafiche con poche IN batch.
+# Il numero di query dipende dalla profondita' della distinta, non dal numero di righe.
+
+@dataclass(slots=True)
+class PriceLine:
+    # Riga di dettaglio del calcolo: record compatto (slot, nessun dict per riga). orjson serializza
+    # le dataclass direttamente, con i campi nell'ordine di PriceCalcDetail.
+    line_no: int
+    kind: str
+    ref_id: UUID
+    description: Optional[str]
+    uom: Optional[str]
+    quantity: float
+    unit_cost: float
+    extended_cost: float
+    source: str
+
+    def as_dict(self):
+        # Forma usata nello snapshot JSON salvato (ref_id come stringa)
+        return {
+            "line_no": self.line_no,
+            "kind": self.kind,
+            "ref_id": str(self.ref_id),
+            "description": self.description,
+            "uom": self.uom,
+            "quantity": self.quantity,
+            "unit_cost": self.unit_cost,
+            "extended_cost": self.extended_cost,
+            "source": self.source
+        }
+
+def _valid_at(table, as_of):
+    return (table.valid_from <= as_of) & ((table.valid_to == None) | (table.valid_to >= as_of))
+
+def _pick_latest(rows):
+    # rows: (key, value, valid_from) -> {key: value} con valid_from piu' recente
+    best = {}
+    for key, value, valid_from in rows:
+        cur = best.get(key)
+        if cur is None or valid_from > cur[1]:
+            best[key] = (value, valid_from)
+    return {k: v for k, (v, _) in best.items()}
+
+def load_boms(session: Session, product_ids, as_of):
+    # Stessa regola di selezione di una BOM per prodotto: prima l'attiva con versione piu' alta,
+    # altrimenti la valida alla data con versione piu' alta.
+    product_ids = set(product_ids)
+    found = {}
+    for chunk in in_chunks(product_ids):
+        for bom in session.execute(
+            select(BOM).where(BOM.product_id.in_(chunk), BOM.is_active == True)
+        ).scalars():
+            cur = found.get(bom.product_id)
+            if cur is None or bom.version > cur.version:
+                found[bom.product_id] = bom
+    missing = product_ids - found.keys()
+    for chunk in in_chunks(missing):
+        for bom in session.execute(
+            select(BOM).where(BOM.product_id.in_(chunk), _valid_at(BOM, as_of))
+        ).scalars():
+            cur = found.get(bom.product_id)
+            if cur is None or bom.version > cur.version:
+                found[bom.product_id] = bom
+    return {pid: found.get(pid) for pid in product_ids}
+
+def load_components(session: Session, bom_ids):
+    components = {bid: [] for bid in bom_ids}
+    for chunk in in_chunks(bom_ids):
+        for comp in session.execute(
+            select(BOMComponent).where(BOMComponent.bom_id.in_(chunk))
+        ).scalars():
+            components[comp.bom_id].append(comp)
+    for comps in components.values():
+        comps.sort(key=lambda c: c.line_no)
+    return components
+
+def load_list_costs(session: Session, table, id_field, ref_ids, as_of):
+    id_col = getattr(table, id_field)
+    rows = []
+    for chunk in in_chunks(ref_ids):
+        rows.extend(session.execute(
+            select(id_col, table.unit_cost, table.valid_from)
+            .where(id_col.in_(chunk))
+            .where(_valid_at(table, as_of))
+        ).all())
+    return _pick_latest(rows)
+
+def load_product_overrides(session: Session, keys, as_of):
+    # keys: set di (product_id, kind, ref_id). Gli override sono pochi per prodotto:
+    # si filtra per prodotto nel DB e per (kind, ref_id) in memoria.
+    keys = set(keys)
+    rows = []
+    for chunk in in_chunks({k[0] for k in keys}):
+        for pid, kind, ref_id, cost, valid_from in session.execute(
+            select(
+                ProductCostOverride.product_id, ProductCostOverride.kind, ProductCostOverride.ref_id,
+                ProductCostOverride.override_unit_cost, ProductCostOverride.valid_from
+            )
+            .where(ProductCostOverride.product_id.in_(chunk))
+            .where(_valid_at(ProductCostOverride, as_of))
+        ):
+            if (pid, kind, ref_id) in keys:
+                rows.append(((pid, kind, ref_id), cost, valid_from))
+    return _pick_latest(rows)
+
+def load_master_data(session: Session, model, id_field, ids):
+    id_col = getattr(model, id_field)
+    out = {}
+    for chunk in in_chunks(ids):
+        for ref_id, name, uom in session.execute(
+            select(id_col, model.name, model.uom).where(id_col.in_(chunk))
+        ):
+            out[ref_id] = (name, uom)
+    return out
+
+class BomTree:
+    # Distinta esplosa di uno o piu' prodotti con tutti i dati necessari al calcolo, in memoria.
+
+    def __init__(self, as_of):
+        self.as_of = as_of
+        self.boms = {}              # product_id -> BOM | None
+        self.components = {}        # bom_id -> [BOMComponent] ordinati per line_no
+        self.material_costs = {}    # material_id -> unit_cost
+        self.operation_costs = {}   # operation_id -> unit_cost
+        self.overrides = {}         # (product_id, kind, ref_id) -> override_unit_cost
+        self.materials = {}         # material_id -> (name, uom)
+        self.operations = {}        # operation_id -> (name, uom)
+
+    def load(self, session: Session, product_ids, skip=None):
+        # Livello per livello: BOM e componenti dei prodotti non ancora visti.
+        # skip(product_id) -> True per i sottoassiemi da non esplodere (es. gia' compilati).
+        snapshot = catalog_snapshot.current()
+        new_products = set(product_ids) - self.boms.keys()
+        loaded_boms = []
+        with stage("bom_resolution"):
+            while new_products:
+                boms = self._load_boms(session, snapshot, new_products)
+                self.boms.update(boms)
+                bom_ids = [b.bom_id for b in boms.values() if b is not None]
+                loaded_boms.extend(b for b in boms.values() if b is not None)
+                components = self._load_components(session, snapshot, bom_ids)
+                self.components.update(components)
+                next_products = set()
+                for comps in components.values():
+                    next_products.update(c.ref_id for c in comps if c.kind == "product")
+                new_products = next_products - self.boms.keys()
+                if skip is not None:
+                    new_products = {pid for pid in new_products if not skip(pid)}
+        if not loaded_boms:
+            return self
+
+        # Costi e anagrafiche di tutte le foglie, una query per tabella.
+        override_keys = set()
+        material_ids, operation_ids = set(), set()
+        listed_mats, listed_ops = set(), set()
+        for bom in loaded_boms:
+            for comp in self.components[bom.bom_id]:
+                if comp.kind == "material":
+                    material_ids.add(comp.ref_id)
+                elif comp.kind == "operation":
+                    operation_ids.add(comp.ref_id)
+                if comp.kind == "product" or comp.override_unit_cost is not None:
+                    continue
+                override_keys.add((bom.product_id, comp.kind, comp.ref_id))
+                if comp.kind == "material":
+                    listed_mats.add(comp.ref_id)
+                elif comp.kind == "operation":
+                    listed_ops.add(comp.ref_id)
+
+        with stage("cost_lookup"):
+            self.load_costs(
+                session, snapshot,
+                override_keys - self.overrides.keys(),
+                listed_mats - self.material_costs.keys(),
+                listed_ops - self.operation_costs.keys(),
+            )
+        with stage("master_data"):
+            new_mats = material_ids - self.materials.keys()
+            if new_mats:
+                self.materials.update(self._load_master_data(session, snapshot, Material, "material_id", new_mats))
+            new_ops = operation_ids - self.operations.keys()
+            if new_ops:
+                self.operations.update(self._load_master_data(session, snapshot, Operation, "operation_id", new_ops))
+        return self
+
+    # Con uno snapshot del catalogo (catalog_snapshot.py) i dati vengono letti dal file; dal DB
+    # (o dall'indice dei costi) solo le chiavi modificate dopo l'export o assenti dal file.
+
+    def _load_boms(self, session, snapshot, product_ids):
+        if snapshot is None:
+            return load_boms(session, product_ids, self.as_of)
+        found, missing = snapshot.boms(product_ids, self.as_of)
+        if missing:
+            found.update(load_boms(session, missing, self.as_of))
+        return found
+
+    def _load_components(self, session, snapshot, bom_ids):
+        if snapshot is None:
+            return load_components(session, bom_ids)
+        found, missing = snapshot.components(bom_ids)
+        if missing:
+            found.update(load_components(session, missing))
+        return found
+
+    def _load_master_data(self, session, snapshot, model, id_field, ids):
+        if snapshot is None:
+            return load_master_data(session, model, id_field, ids)
+        found, missing = snapshot.master_data("material" if model is Material else "operation", ids)
+        if missing:
+            found.update(load_master_data(session, model, id_field, missing))
+        return found
+
+    def load_costs(self, session: Session, snapshot, override_keys, material_ids, operation_ids):
+        if snapshot is not None:
+            found, override_keys = snapshot.product_overrides(override_keys, self.as_of)
+            self.overrides.update(found)
+            found, material_ids = snapshot.list_costs("material", material_ids, self.as_of)
+            self.material_costs.update(found)
+            found, operation_ids = snapshot.list_costs("operation", operation_ids, self.as_of)
+            self.operation_costs.update(found)
+        if cost_index.enabled:
+            self.overrides.update(cost_index.product_overrides(session, override_keys, self.as_of))
+            self.material_costs.update(cost_index.material_costs(session, material_ids, self.as_of))
+            self.operation_costs.update(cost_index.operation_costs(session, operation_ids, self.as_of))
+            return
+        if override_keys:
+            self.overrides.update(load_product_overrides(session, override_keys, self.as_of))
+        if material_ids:
+            self.material_costs.update(load_list_costs(session, MaterialCost, "material_id", material_ids, self.as_of))
+        if operation_ids:
+            self.operation_costs.update(load_list_costs(session, OperationCost, "operation_id", operation_ids, self.as_of))
+
+    def bom_for(self, product_id):
+        bom = self.boms.get(product_id)
+        if not bom:
+            raise ValueError(f"Nessuna BOM attiva/valida per product_id={product_id}")
+        return bom
+
+    def resolve_cost(self, product_id, comp):
+        if comp.override_unit_cost is not None:
+            return float(comp.override_unit_cost), "override_bom"
+        po = self.overrides.get((product_id, comp.kind, comp.ref_id))
+        if po is not None:
+            return float(po), "override_product"
+        if comp.kind == "material":
+            c = self.material_costs.get(comp.ref_id)
+        elif comp.kind == "operation":
+            c = self.operation_costs.get(comp.ref_id)
+        else:
+            raise ValueError(f"Kind non supportato: {comp.kind}")
+        if c is None:
+            raise ValueError(f"Nessun costo valido per {comp.kind} {comp.ref_id} alla data {self.as_of}")
+        return float(c), "listino"
+
+    def expand(self, product_id, qty, snapshot_items, line_no_start=1, _path=()):
+        # Stessa visita in profondita' (e stessa numerazione righe) della vecchia ricorsione,
+        # ma senza I/O: tutto e' gia' in memoria.
+        bom = self.bom_for(product_id)
+        if product_id in _path:
+            raise ValueError(f"BOM ciclica per product_id={product_id}")
+        path = _path + (product_id,)
+
+        total_mat = 0.0
+        total_op = 0.0
+        cur_line = line_no_start
+
+        for comp in self.components[bom.bom_id]:
+            qty_per_unit = float(comp.quantity) * (1.0 + float(comp.waste_pct or 0)/100.0)
+            eff_qty = qty * qty_per_unit
+
+            if comp.kind == "product":
+                cur_line, sub_mat, sub_op = self.expand(comp.ref_id, eff_qty, snapshot_items, cur_line, path)
+                total_mat += sub_mat
+                total_op += sub_op
+                continue
+
+            unit_cost, source = self.resolve_cost(bom.product_id, comp)
+            extended = eff_qty * unit_cost
+
+            desc, uom = None, None
+            if comp.kind == "material":
+                desc, uom = self.materials.get(comp.ref_id, (None, None))
+                total_mat += extended
+            elif comp.kind == "operation":
+                desc, uom = self.operations.get(comp.ref_id, (None, None))
+                total_op += extended
+
+            snapshot_items.append(PriceLine(cur_line, comp.kind, comp.ref_id, desc, uom, eff_qty, unit_cost, extended, source))
+            cur_line += 1
+
+        return cur_line, total_mat, total_op
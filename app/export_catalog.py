@@ -0,0 +1,17 @@
+import argparse
+import json
+from app.catalog_snapshot import CATALOG_CHANGES_RETENTION_DAYS, CATALOG_SNAPSHOT, export_snapshot
+from app.database import engine
+
+# Export dello snapshot binario del catalogo letto dai worker via mmap (da schedulare, o da
+# lanciare dopo modifiche massive). Il file viene sostituito con un rename atomico:
+#   python app/export_catalog.py --out /var/lib/priceforge/catalog.snap
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Esporta lo snapshot del catalogo per i worker")
+    parser.add_argument("--out", default=CATALOG_SNAPSHOT or None, required=not CATALOG_SNAPSHOT,
+                        help="file di destinazione (default: CATALOG_SNAPSHOT)")
+    parser.add_argument("--retention-days", type=int, default=CATALOG_CHANGES_RETENTION_DAYS,
+                        help="giorni di registro modifiche da mantenere")
+    args = parser.parse_args()
+    print(json.dumps(export_snapshot(engine, args.out, args.retention_days), indent=2))
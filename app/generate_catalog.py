@@ -0,0 +1,33 @@
+import argparse
+import json
+from app.database import engine
+from app.migrations import migrate
+from app.synthetic import generate_catalog
+
+# Catalogo sintetico su un DB vuoto (di prova!), es. 50k prodotti su 4 livelli:
+#   python app/generate_catalog.py --products 50000 --depth 4 --fanout 10 --cost-windows 1000 --window-days 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera un catalogo sintetico per benchmark")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=3, help="livelli di distinta")
+    parser.add_argument("--fanout", type=int, default=8, help="righe per BOM")
+    parser.add_argument("--sub-ratio", type=float, default=0.3, help="quota di righe che sono sottoassiemi")
+    parser.add_argument("--materials", type=int, default=None, help="default: products / 2")
+    parser.add_argument("--operations", type=int, default=None, help="default: products / 10")
+    parser.add_argument("--cost-windows", type=int, default=12, help="finestre di costo per materiale/lavorazione")
+    parser.add_argument("--window-days", type=int, default=30, help="durata di ogni finestra")
+    parser.add_argument("--override-ratio", type=float, default=0.1, help="quota di prodotti con un override")
+    parser.add_argument("--bom-versions", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    migrate(engine)
+    with engine.begin() as conn:
+        summary = generate_catalog(
+            conn, products=args.products, depth=args.depth, fanout=args.fanout, sub_ratio=args.sub_ratio,
+            materials=args.materials, operations=args.operations, cost_windows=args.cost_windows,
+            window_days=args.window_days, override_ratio=args.override_ratio, bom_versions=args.bom_versions,
+            seed=args.seed,
+        )
+    summary.pop("sellable_skus")
+    print(json.dumps(summary, indent=2))
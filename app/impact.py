@@ -0,0 +1,249 @@
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from .catalog_snapshot import CATALOG_CHANGES_RETENTION_DAYS
+from .changes import CATALOG_NOTIFY, ChangeCursor, on_catalog_change
+from .compiled import compiled_cache
+from .database import SessionLocal, in_chunks
+from .explosion import BomTree
+from .models import BOM, BOMComponent, CatalogChange, Product
+from .services import _load_settings
+
+# Indice "dove usato": per ogni (kind, ref_id) le BOM che lo contengono, e per ogni BOM il
+# prodotto padre. Copre tutte le versioni di BOM (superinsieme); la BOM effettiva alla data
+# viene poi risolta nel ricalcolo. E' costruito al primo uso e mantenuto incrementalmente:
+# le modifiche a BOM e componenti marcano prodotti/BOM da ricaricare alla richiesta successiva.
+# L'indice e' unico per processo: lo si legge sempre dal primario con una sessione propria, mai
+# con quella del chiamante (che puo' essere una replica in ritardo). Senza CATALOG_NOTIFY le
+# modifiche degli altri processi arrivano leggendo catalog_changes prima di ogni uso.
+
+class WhereUsedIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._loaded = False
+        self.bom_product = {}               # bom_id -> product_id
+        self.product_boms = defaultdict(set)  # product_id -> {bom_id}
+        self.bom_refs = {}                  # bom_id -> {(kind, ref_id)}
+        self.used_in = defaultdict(set)     # (kind, ref_id) -> {bom_id}
+        self._dirty_products = set()
+        self._dirty_boms = set()
+        self._cursor = None
+        self._read_at = 0.0                 # time.monotonic() dell'ultima lettura di catalog_changes
+
+    def mark_changed(self, keys):
+        with self._lock:
+            self._mark(keys)
+
+    def _mark(self, keys):
+        for kind, ref_id in keys:
+            if kind == "bom":
+                self._dirty_products.add(ref_id)
+            elif kind == "bom_component":
+                self._dirty_boms.add(ref_id)
+
+    def _add_bom(self, bom_id, product_id):
+        self.bom_product[bom_id] = product_id
+        self.product_boms[product_id].add(bom_id)
+        self.bom_refs.setdefault(bom_id, set())
+
+    def _drop_bom(self, bom_id):
+        product_id = self.bom_product.pop(bom_id, None)
+        if product_id is not None:
+            self.product_boms[product_id].discard(bom_id)
+        for ref in self.bom_refs.pop(bom_id, ()):
+            self.used_in[ref].discard(bom_id)
+
+    def _set_refs(self, bom_id, refs):
+        for ref in self.bom_refs.get(bom_id, ()):
+            self.used_in[ref].discard(bom_id)
+        self.bom_refs[bom_id] = refs
+        for ref in refs:
+            self.used_in[ref].add(bom_id)
+
+    def _load_refs(self, session, bom_ids):
+        refs = {bom_id: set() for bom_id in bom_ids}
+        for chunk in in_chunks(bom_ids):
+            for bom_id, kind, ref_id in session.execute(
+                select(BOMComponent.bom_id, BOMComponent.kind, BOMComponent.ref_id).where(BOMComponent.bom_id.in_(chunk))
+            ):
+                refs[bom_id].add((kind, ref_id))
+        for bom_id, r in refs.items():
+            if bom_id in self.bom_product:
+                self._set_refs(bom_id, r)
+
+    def refresh(self):
+        with self._lock:
+            if self._loaded and CATALOG_NOTIFY and not (self._dirty_products or self._dirty_boms):
+                return
+            with SessionLocal() as session:
+                self._refresh(session)
+
+    def _refresh(self, session: Session):
+        if self._loaded and not CATALOG_NOTIFY:
+            # Oltre la conservazione del registro le modifiche intermedie potrebbero essere state eliminate
+            if time.monotonic() - self._read_at > (CATALOG_CHANGES_RETENTION_DAYS - 1) * 86400:
+                self._reset()
+            else:
+                self._mark(self._cursor.read(session.connection()))
+                self._read_at = time.monotonic()
+        if not self._loaded:
+            if not CATALOG_NOTIFY:
+                # Cursore preso prima del caricamento: le modifiche concorrenti vengono rilette
+                self._cursor = ChangeCursor(session.execute(
+                    select(func.coalesce(func.max(CatalogChange.change_id), 0))).scalar())
+                self._read_at = time.monotonic()
+            for bom_id, product_id in session.execute(select(BOM.bom_id, BOM.product_id)):
+                self._add_bom(bom_id, product_id)
+            for bom_id, kind, ref_id in session.execute(
+                select(BOMComponent.bom_id, BOMComponent.kind, BOMComponent.ref_id).execution_options(yield_per=10000)
+            ):
+                if bom_id in self.bom_product:
+                    self.bom_refs[bom_id].add((kind, ref_id))
+                    self.used_in[(kind, ref_id)].add(bom_id)
+            self._loaded = True
+            self._dirty_products.clear()
+            self._dirty_boms.clear()
+            return
+        dirty_products, self._dirty_products = self._dirty_products, set()
+        dirty_boms, self._dirty_boms = self._dirty_boms, set()
+        if dirty_products:
+            current = {}
+            for chunk in in_chunks(dirty_products):
+                for bom_id, product_id in session.execute(
+                    select(BOM.bom_id, BOM.product_id).where(BOM.product_id.in_(chunk))
+                ):
+                    current[bom_id] = product_id
+            for product_id in dirty_products:
+                for bom_id in list(self.product_boms.get(product_id, ())):
+                    if bom_id not in current:
+                        self._drop_bom(bom_id)
+            for bom_id, product_id in current.items():
+                if bom_id not in self.bom_product:
+                    self._add_bom(bom_id, product_id)
+                    dirty_boms.add(bom_id)
+        if dirty_boms:
+            self._load_refs(session, dirty_boms)
+
+    def parents(self, kind, ref_id):
+        # Prodotti che usano direttamente (kind, ref_id) in una loro BOM
+        self.refresh()
+        with self._lock:
+            return {self.bom_product[b] for b in self.used_in.get((kind, ref_id), ())}
+
+    def ancestors(self, refs):
+        # Tutti i prodotti che usano, anche indirettamente, uno dei (kind, ref_id)
+        self.refresh()
+        found = set()
+        with self._lock:
+            frontier = list(refs)
+            while frontier:
+                ref = frontier.pop()
+                for bom_id in self.used_in.get(ref, ()):
+                    product_id = self.bom_product[bom_id]
+                    if product_id not in found:
+                        found.add(product_id)
+                        frontier.append(("product", product_id))
+        return found
+
+where_used = WhereUsedIndex()
+
+@on_catalog_change
+def _where_used_changes(keys):
+    where_used.mark_changed(keys)
+
+# Analisi d'impatto di variazioni ipotetiche dei costi di listino: nessuna scrittura.
+# Si ricalcola solo il sottografo dei prodotti che usano gli elementi variati; i sottoassiemi
+# non toccati entrano con il costo unitario gia' calcolato (una volta per richiesta, o dalla
+# cache delle BOM compilate se abilitata).
+
+def cost_impact(session: Session, changes, as_of, requested_qty=1.0):
+    # changes: {(kind, ref_id): unit_cost ipotetico}
+    # -> lista di dict per i prodotti con prezzo variato (o non calcolabili)
+    affected = where_used.ancestors(changes.keys())
+    if not affected:
+        return []
+    use_compiled = compiled_cache.enabled
+    tree = BomTree(as_of)
+    tree.load(session, affected,
+              skip=lambda pid: use_compiled and pid not in affected and compiled_cache.is_compiled(pid, as_of))
+
+    def listed(product_id, comp):
+        return tree.resolve_cost(product_id, comp)[0]
+
+    def hypothetical(product_id, comp):
+        change = changes.get((comp.kind, comp.ref_id))
+        if (change is not None and comp.override_unit_cost is None
+                and (product_id, comp.kind, comp.ref_id) not in tree.overrides):
+            return float(change)
+        return listed(product_id, comp)
+
+    # I prodotti fuori da affected costano uguale prima e dopo: calcolati una volta sola.
+    untouched = {}
+
+    def unit_totals(product_id, cost_of, memo, path=()):
+        # -> (materiale, lavorazioni) per una unita' di prodotto
+        if product_id in untouched:
+            return untouched[product_id]
+        if product_id in memo:
+            return memo[product_id]
+        if product_id not in affected and use_compiled:
+            compiled = compiled_cache.compile(session, tree, product_id)
+            untouched[product_id] = (compiled.unit_material, compiled.unit_operation)
+            return untouched[product_id]
+        bom = tree.bom_for(product_id)
+        if product_id in path:
+            raise ValueError(f"BOM ciclica per product_id={product_id}")
+        path = path + (product_id,)
+        mat, op = 0.0, 0.0
+        for comp in tree.components[bom.bom_id]:
+            qty_per_unit = float(comp.quantity) * (1.0 + float(comp.waste_pct or 0)/100.0)
+            if comp.kind == "product":
+                sub_mat, sub_op = unit_totals(comp.ref_id, cost_of, memo, path)
+                mat += qty_per_unit * sub_mat
+                op += qty_per_unit * sub_op
+                continue
+            unit_cost = cost_of(product_id, comp)
+            if comp.kind == "material":
+                mat += qty_per_unit * unit_cost
+            elif comp.kind == "operation":
+                op += qty_per_unit * unit_cost
+        (memo if product_id in affected else untouched)[product_id] = (mat, op)
+        return mat, op
+
+    products = {}
+    for chunk in in_chunks(affected):
+        for p in session.execute(select(Product).where(Product.product_id.in_(chunk))).scalars():
+            products[p.product_id] = p
+    default_markup, _ = _load_settings(session)
+
+    old_memo, new_memo = {}, {}
+    qty = float(requested_qty)
+    out = []
+    for product_id, product in products.items():
+        markup_pct = float(product.default_markup_pct) if product.default_markup_pct is not None else default_markup
+        row = {"product_id": product_id, "sku": product.sku, "is_sellable": product.is_sellable}
+        try:
+            old = sum(unit_totals(product_id, listed, old_memo)) * qty
+        except ValueError as e:
+            old, row["old_error"] = None, str(e)
+        try:
+            new = sum(unit_totals(product_id, hypothetical, new_memo)) * qty
+        except ValueError as e:
+            new, row["new_error"] = None, str(e)
+        if old is not None and new is not None and abs(new - old) < 1e-9:
+            continue
+        row["old_cost"] = old
+        row["new_cost"] = new
+        row["old_price"] = round(old * (1 + markup_pct/100.0), 4) if old is not None else None
+        row["new_price"] = round(new * (1 + markup_pct/100.0), 4) if new is not None else None
+        if old is not None and new is not None:
+            row["delta_cost"] = new - old
+            row["delta_price"] = round(row["new_price"] - row["old_price"], 4)
+        out.append(row)
+    out.sort(key=lambda r: r["sku"])
+    return out
@@ -0,0 +1,19 @@
+import argparse
+import json
+from app.database import SessionLocal
+from app.imports import ENTITIES, import_file
+
+# Import massivo da file, con la stessa logica di POST /import/{entity}:
+#   python app/import_catalog.py material_costs listino.csv
+#   python app/import_catalog.py boms distinte.ndjson
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Importa anagrafiche, costi o distinte da CSV/NDJSON")
+    parser.add_argument("entity", choices=list(ENTITIES))
+    parser.add_argument("file")
+    parser.add_argument("--format", choices=["csv", "ndjson"],
+                        help="default: dall'estensione del file (.ndjson/.jsonl, altrimenti csv)")
+    args = parser.parse_args()
+    fmt = args.format or ("ndjson" if args.file.endswith((".ndjson", ".jsonl")) else "csv")
+    with SessionLocal() as db, open(args.file, "rb") as f:
+        print(json.dumps(import_file(db, args.entity, f, fmt), indent=2))
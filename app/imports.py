@@ -0,0 +1,415 @@
+import csv
+import io
+import json
+import os
+import time
+import uuid
+from datetime import date
+from typing import Literal, Optional
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from sqlalchemy import (
+    Boolean, Column, Date, Integer, MetaData, Numeric, String, Table, Text, and_, delete, exists, insert, select, update
+)
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import Session
+from .changes import publish_changes, record_changes
+from .database import in_chunks
+from .models import BOM, BOMComponent, Material, MaterialCost, Operation, OperationCost, Product
+
+# Import massivo di anagrafiche, costi e distinte da CSV (con intestazione) o NDJSON.
+# Il corpo e' letto a pezzi: le righe complete vengono validate a blocchi di IMPORT_CHUNK_ROWS,
+# caricate in una tabella temporanea di staging (COPY con psycopg2, INSERT multi-riga altrimenti)
+# e da li' applicate con due statement set-based: UPDATE delle chiavi esistenti, INSERT delle
+# nuove. Le righe non valide (formato, validazione, riferimenti inesistenti) sono riportate con
+# il loro numero e non interrompono l'import. Tutto l'import e' una transazione: le modifiche
+# sono registrate e pubblicate (catalog_version) una volta sola, al commit.
+#
+# Chiavi di upsert: materiali/lavorazioni per code, prodotti per sku, costi per
+# (code, valid_from), distinte per (product_sku, version) e le loro righe per line_no.
+#
+# IMPORT_CHUNK_ROWS   righe per blocco di validazione e staging
+# IMPORT_MAX_ERRORS   errori di riga riportati nella risposta (il conteggio e' sempre completo)
+
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "5000"))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", "1000"))
+READ_BLOCK = 1 << 20
+
+# --- righe ---
+
+def _check_window(row):
+    if row.valid_to is not None and row.valid_to < row.valid_from:
+        raise ValueError("valid_to precedente a valid_from")
+    return row
+
+class MasterRow(BaseModel):
+    code: str = Field(min_length=1, max_length=64)
+    name: str = Field(min_length=1, max_length=200)
+    uom: str = Field(min_length=1, max_length=16)
+
+class ProductRow(BaseModel):
+    sku: str = Field(min_length=1, max_length=64)
+    name: str = Field(min_length=1, max_length=200)
+    description: Optional[str] = None
+    currency: str = Field("EUR", min_length=3, max_length=3)
+    default_markup_pct: Optional[float] = None
+    is_sellable: bool = True
+
+class CostRow(BaseModel):
+    code: str
+    unit_cost: float = Field(ge=0)
+    currency: str = Field("EUR", min_length=3, max_length=3)
+    valid_from: date
+    valid_to: Optional[date] = None
+
+    _window = model_validator(mode="after")(_check_window)
+
+class BomLineRow(BaseModel):
+    product_sku: str
+    version: int = Field(ge=1)
+    is_active: bool = False
+    valid_from: date
+    valid_to: Optional[date] = None
+    line_no: int = Field(ge=1)
+    kind: Literal["material", "operation", "product"]
+    ref_code: str = Field(description="code del materiale/lavorazione o sku del sottoassieme")
+    quantity: float = Field(1, gt=0)
+    waste_pct: float = Field(0, ge=0)
+    override_unit_cost: Optional[float] = Field(None, ge=0)
+
+    _window = model_validator(mode="after")(_check_window)
+
+def _describe(error: ValidationError):
+    return "; ".join(f"{'.'.join(str(p) for p in e['loc']) or 'riga'}: {e['msg']}" for e in error.errors())
+
+class RowReader:
+    # Righe complete da un corpo letto a pezzi: feed(bytes) -> [(numero riga, dict | errore)].
+    # CSV: prima riga di intestazione, campi vuoti = valore di default; un record puo' proseguire
+    # su piu' righe dentro un campo tra virgolette.
+
+    def __init__(self, fmt):
+        if fmt not in ("csv", "ndjson"):
+            raise ValueError(f"Formato non supportato: {fmt}")
+        self.fmt = fmt
+        self.row_no = 0
+        self._buffer = b""
+        self._record = ""
+        self._header = None
+        self._started = False
+
+    def feed(self, data):
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        return self._parse(lines)
+
+    def close(self):
+        lines, self._buffer = [self._buffer], b""
+        out = self._parse(lines)
+        if self._record:
+            self.row_no += 1
+            out.append((self.row_no, "virgolette non chiuse"))
+            self._record = ""
+        return out
+
+    def _parse(self, lines):
+        out = []
+        for raw in lines:
+            try:
+                line = raw.decode("utf-8").rstrip("\r")
+            except UnicodeDecodeError:
+                self.row_no += 1
+                out.append((self.row_no, "codifica non UTF-8"))
+                continue
+            if not self._started:
+                line = line.lstrip("﻿")
+                self._started = True
+            if self.fmt == "ndjson":
+                if not line.strip():
+                    continue
+                self.row_no += 1
+                try:
+                    obj = json.loads(line)
+                except ValueError:
+                    obj = None
+                out.append((self.row_no, obj if isinstance(obj, dict) else "JSON non valido (atteso un oggetto)"))
+                continue
+            self._record = f"{self._record}\n{line}" if self._record else line
+            if self._record.count('"') % 2:
+                continue
+            record, self._record = self._record, ""
+            if not record.strip():
+                continue
+            fields = next(csv.reader([record]))
+            if self._header is None:
+                self._header = [f.strip() for f in fields]
+                continue
+            self.row_no += 1
+            if len(fields) != len(self._header):
+                out.append((self.row_no, f"{len(fields)} campi invece di {len(self._header)}"))
+                continue
+            out.append((self.row_no, {k: v for k, v in zip(self._header, fields) if v != ""}))
+        return out
+
+# --- staging ---
+
+_staging = MetaData()
+
+def _stage_table(name, *columns):
+    return Table(name, _staging, *columns, prefixes=["TEMPORARY"])
+
+_MASTER_COLUMNS = (Column("code", String(64)), Column("name", String(200)), Column("uom", String(16)))
+_COST_COLUMNS = (
+    Column("unit_cost", Numeric(12, 4)), Column("currency", String(3)), Column("valid_from", Date),
+    Column("valid_to", Date),
+)
+
+STAGE_MATERIALS = _stage_table("import_stage_materials", Column("material_id", UUID(as_uuid=True)),
+                               *(c.copy() for c in _MASTER_COLUMNS))
+STAGE_OPERATIONS = _stage_table("import_stage_operations", Column("operation_id", UUID(as_uuid=True)),
+                                *(c.copy() for c in _MASTER_COLUMNS))
+STAGE_PRODUCTS = _stage_table(
+    "import_stage_products", Column("product_id", UUID(as_uuid=True)), Column("sku", String(64)),
+    Column("name", String(200)), Column("description", Text), Column("currency", String(3)),
+    Column("default_markup_pct", Numeric(6, 3)), Column("is_sellable", Boolean),
+)
+STAGE_MATERIAL_COSTS = _stage_table(
+    "import_stage_material_costs", Column("material_cost_id", UUID(as_uuid=True)),
+    Column("material_id", UUID(as_uuid=True)), *(c.copy() for c in _COST_COLUMNS)
+)
+STAGE_OPERATION_COSTS = _stage_table(
+    "import_stage_operation_costs", Column("operation_cost_id", UUID(as_uuid=True)),
+    Column("operation_id", UUID(as_uuid=True)), *(c.copy() for c in _COST_COLUMNS)
+)
+STAGE_BOMS = _stage_table(
+    "import_stage_boms", Column("bom_id", UUID(as_uuid=True)), Column("product_id", UUID(as_uuid=True)),
+    Column("version", Integer), Column("is_active", Boolean), Column("valid_from", Date), Column("valid_to", Date),
+)
+STAGE_BOM_LINES = _stage_table(
+    "import_stage_bom_lines", Column("bom_component_id", UUID(as_uuid=True)), Column("bom_id", UUID(as_uuid=True)),
+    Column("product_id", UUID(as_uuid=True)), Column("version", Integer), Column("line_no", Integer),
+    Column("kind", String(20)), Column("ref_id", UUID(as_uuid=True)), Column("quantity", Numeric(14, 6)),
+    Column("waste_pct", Numeric(6, 3)), Column("override_unit_cost", Numeric(12, 4)),
+)
+
+def _stage(session: Session, table, rows):
+    # Sostituisce il contenuto della tabella di staging con rows (dict con tutte le colonne)
+    session.execute(delete(table))
+    if not rows:
+        return
+    conn = session.connection()
+    if conn.dialect.name == "postgresql" and conn.dialect.driver == "psycopg2":
+        columns = [c.name for c in table.columns]
+        buf = io.StringIO()
+        writer = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC)
+        for row in rows:
+            writer.writerow([_copy_value(row[c]) for c in columns])
+        buf.seek(0)
+        with conn.connection.driver_connection.cursor() as cur:
+            cur.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+    else:
+        session.execute(insert(table), rows)
+
+def _copy_value(value):
+    # QUOTE_NONNUMERIC: stringhe tra virgolette, numeri no, None -> campo vuoto (NULL per COPY)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+def _upsert(session: Session, target, stage, keys, update_columns, insert_columns):
+    # -> (aggiornate, inserite)
+    match = and_(*(target.c[k] == stage.c[k] for k in keys))
+    updated = session.execute(
+        update(target).values({c: stage.c[c] for c in update_columns}).where(match)
+    ).rowcount
+    inserted = session.execute(insert(target).from_select(
+        insert_columns, select(*(stage.c[c] for c in insert_columns)).where(~exists().where(match))
+    )).rowcount
+    return updated, inserted
+
+def _resolve(session: Session, model, key_field, id_field, values):
+    # {code/sku: id} per i valori esistenti
+    key_col, id_col = getattr(model, key_field), getattr(model, id_field)
+    out = {}
+    for chunk in in_chunks(values):
+        out.update(session.execute(select(key_col, id_col).where(key_col.in_(chunk))).all())
+    return out
+
+# --- applicazione di un blocco di righe valide: [(numero riga, riga)] ---
+
+def _master_apply(model, stage, id_field, key_field, change_kind):
+    table = model.__table__
+    columns = [c.name for c in stage.columns]
+
+    def apply(session: Session, job, rows):
+        latest = {getattr(row, key_field): row for _, row in rows}
+        _stage(session, stage, [{id_field: uuid.uuid4(), **row.model_dump()} for row in latest.values()])
+        job.count(*_upsert(session, table, stage, [key_field], [c for c in columns if c not in (id_field, key_field)],
+                           columns))
+        ids = session.execute(
+            select(table.c[id_field]).join(stage, table.c[key_field] == stage.c[key_field])
+        ).scalars()
+        job.keys.update((change_kind, i) for i in ids)
+    return apply
+
+def _cost_apply(model, parent, stage, id_field, parent_field, change_kind):
+    table = model.__table__
+    columns = [c.name for c in stage.columns]
+
+    def apply(session: Session, job, rows):
+        ids = _resolve(session, parent, "code", parent_field, {row.code for _, row in rows})
+        latest = {}
+        for row_no, row in rows:
+            parent_id = ids.get(row.code)
+            if parent_id is None:
+                job.error(row_no, f"code non trovato: {row.code}")
+                continue
+            latest[(parent_id, row.valid_from)] = {
+                id_field: uuid.uuid4(), parent_field: parent_id, "unit_cost": row.unit_cost,
+                "currency": row.currency, "valid_from": row.valid_from, "valid_to": row.valid_to,
+            }
+        _stage(session, stage, list(latest.values()))
+        job.count(*_upsert(session, table, stage, [parent_field, "valid_from"],
+                           ["unit_cost", "currency", "valid_to"], columns))
+        job.keys.update((change_kind, parent_id) for parent_id, _ in latest)
+    return apply
+
+def _bom_apply(session: Session, job, rows):
+    refs = {"product": set(), "material": set(), "operation": set()}
+    for _, row in rows:
+        refs["product"].add(row.product_sku)
+        refs[row.kind].add(row.ref_code)
+    resolved = {
+        "product": _resolve(session, Product, "sku", "product_id", refs["product"]),
+        "material": _resolve(session, Material, "code", "material_id", refs["material"]),
+        "operation": _resolve(session, Operation, "code", "operation_id", refs["operation"]),
+    }
+    headers, lines = {}, {}
+    for row_no, row in rows:
+        product_id = resolved["product"].get(row.product_sku)
+        ref_id = resolved[row.kind].get(row.ref_code)
+        if product_id is None:
+            job.error(row_no, f"product_sku non trovato: {row.product_sku}")
+            continue
+        if ref_id is None:
+            job.error(row_no, f"{row.kind} non trovato: {row.ref_code}")
+            continue
+        headers[(product_id, row.version)] = {
+            "bom_id": uuid.uuid4(), "product_id": product_id, "version": row.version, "is_active": row.is_active,
+            "valid_from": row.valid_from, "valid_to": row.valid_to,
+        }
+        lines[(product_id, row.version, row.line_no)] = {
+            "bom_component_id": uuid.uuid4(), "bom_id": None, "product_id": product_id, "version": row.version,
+            "line_no": row.line_no, "kind": row.kind, "ref_id": ref_id, "quantity": row.quantity,
+            "waste_pct": row.waste_pct, "override_unit_cost": row.override_unit_cost,
+        }
+    boms, components = BOM.__table__, BOMComponent.__table__
+    _stage(session, STAGE_BOMS, list(headers.values()))
+    _upsert(session, boms, STAGE_BOMS, ["product_id", "version"], ["is_active", "valid_from", "valid_to"],
+            [c.name for c in STAGE_BOMS.columns])
+    _stage(session, STAGE_BOM_LINES, list(lines.values()))
+    session.execute(update(STAGE_BOM_LINES).values(bom_id=select(boms.c.bom_id).where(
+        boms.c.product_id == STAGE_BOM_LINES.c.product_id, boms.c.version == STAGE_BOM_LINES.c.version
+    ).limit(1).scalar_subquery()))
+    job.count(*_upsert(
+        session, components, STAGE_BOM_LINES, ["bom_id", "line_no"],
+        ["kind", "ref_id", "quantity", "waste_pct", "override_unit_cost"],
+        ["bom_component_id", "bom_id", "line_no", "kind", "ref_id", "quantity", "waste_pct", "override_unit_cost"],
+    ))
+    job.keys.update(("bom", product_id) for product_id, _ in headers)
+    job.keys.update(("bom_component", bom_id) for bom_id in session.execute(
+        select(STAGE_BOM_LINES.c.bom_id).distinct()
+    ).scalars())
+
+# entita' -> (modello della riga, tabelle di staging, applicazione)
+ENTITIES = {
+    "materials": (MasterRow, [STAGE_MATERIALS],
+                  _master_apply(Material, STAGE_MATERIALS, "material_id", "code", "material")),
+    "operations": (MasterRow, [STAGE_OPERATIONS],
+                   _master_apply(Operation, STAGE_OPERATIONS, "operation_id", "code", "operation")),
+    "products": (ProductRow, [STAGE_PRODUCTS], _master_apply(Product, STAGE_PRODUCTS, "product_id", "sku", "product")),
+    "material_costs": (CostRow, [STAGE_MATERIAL_COSTS], _cost_apply(
+        MaterialCost, Material, STAGE_MATERIAL_COSTS, "material_cost_id", "material_id", "material_cost")),
+    "operation_costs": (CostRow, [STAGE_OPERATION_COSTS], _cost_apply(
+        OperationCost, Operation, STAGE_OPERATION_COSTS, "operation_cost_id", "operation_id", "operation_cost")),
+    "boms": (BomLineRow, [STAGE_BOMS, STAGE_BOM_LINES], _bom_apply),
+}
+
+class CatalogImport:
+    # Un import: add() per ogni blocco di righe lette, finish() per commit e pubblicazione.
+    # Nessun commit intermedio: un errore del DB annulla l'intero import.
+
+    def __init__(self, session: Session, entity):
+        if entity not in ENTITIES:
+            raise ValueError(f"Entita' non importabile: {entity}")
+        self.entity = entity
+        self.row_model, self.stages, self.apply = ENTITIES[entity]
+        self.rows = self.inserted = self.updated = self.failed = 0
+        self.errors = []
+        self.keys = set()
+        self.started = time.perf_counter()
+        conn = session.connection()
+        for table in self.stages:
+            table.drop(conn, checkfirst=True)
+            table.create(conn)
+
+    def error(self, row_no, message):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"row": row_no, "error": message})
+
+    def count(self, updated, inserted):
+        self.updated += updated
+        self.inserted += inserted
+
+    def add(self, session: Session, rows):
+        # rows: [(numero riga, dict | messaggio di errore del lettore)]
+        valid = []
+        for row_no, raw in rows:
+            self.rows += 1
+            if isinstance(raw, str):
+                self.error(row_no, raw)
+                continue
+            try:
+                valid.append((row_no, self.row_model.model_validate(raw)))
+            except ValidationError as e:
+                self.error(row_no, _describe(e))
+        if valid:
+            self.apply(session, self, valid)
+
+    def finish(self, session: Session):
+        conn = session.connection()
+        for table in self.stages:
+            table.drop(conn)
+        record_changes(conn, self.keys)
+        session.commit()
+        publish_changes(self.keys)
+        return self.summary()
+
+    def summary(self):
+        return {
+            "entity": self.entity,
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "failed": self.failed,
+            "errors": sorted(self.errors, key=lambda e: e["row"]),
+            "errors_truncated": self.failed > len(self.errors),
+            "elapsed_s": round(time.perf_counter() - self.started, 3),
+        }
+
+def import_file(session: Session, entity, fileobj, fmt):
+    # Import da un file binario aperto (CLI), a blocchi come l'endpoint
+    job = CatalogImport(session, entity)
+    reader = RowReader(fmt)
+    pending = []
+    while True:
+        data = fileobj.read(READ_BLOCK)
+        if not data:
+            break
+        pending.extend(reader.feed(data))
+        if len(pending) >= IMPORT_CHUNK_ROWS:
+            job.add(session, pending)
+            pending = []
+    pending.extend(reader.close())
+    if pending:
+        job.add(session, pending)
+    return job.finish(session)
@@ -1,16 +1,31 @@
 from fastapi import FastAPI
-from .database import Base, engine
-from .routers import products, pricing
+from fastapi.responses import PlainTextResponse
+from .database import engine, async_engine
+from .changes import start_notify_listener, CATALOG_NOTIFY
+from .catalog_snapshot import catalog_snapshot
+from .migrations import migrate
+from .retention import ensure_partitions
+from .metrics import MetricsMiddleware, render as render_metrics
+from .admission import AdmissionMiddleware
+from .persistence import run_writer
+from .replicas import replica_router
+from .price_list import price_list
+from .routers import products, materials, operations, pricing, admin, imports
 import time
 from sqlalchemy.exc import OperationalError
 
 app = FastAPI(title="PriceForge - Pricing Service")
+# L'ultimo aggiunto e' il piu' esterno: le metriche misurano anche le richieste rifiutate
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
-# Tentativo di creare le tabelle con retry (DB potrebbe non essere pronto)
+# Tentativo di applicare le migrazioni con retry (DB potrebbe non essere pronto)
 def init_db_with_retry(retries=15, delay=2):
     for i in range(retries):
         try:
-            Base.metadata.create_all(bind=engine)
+            migrate(engine)
+            with engine.begin() as conn:
+                ensure_partitions(conn)
             return
         except OperationalError as e:
             if i == retries - 1:
@@ -20,9 +35,34 @@ def init_db_with_retry(retries=15, delay=2):
 @app.on_event("startup")
 def on_startup():
     init_db_with_retry()
+    if CATALOG_NOTIFY:
+        start_notify_listener(engine)
+    if catalog_snapshot.enabled:
+        catalog_snapshot.start(engine)
+    if run_writer.enabled:
+        run_writer.start()
+    replica_router.start()
+    price_list.start(engine)
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    run_writer.stop()
+    catalog_snapshot.stop()
+    price_list.stop()
+    await replica_router.stop()
+    if async_engine is not None:
+        await async_engine.dispose()
 
 app.include_router(products.router)
+app.include_router(materials.router)
+app.include_router(operations.router)
 app.include_router(pricing.router)
+app.include_router(admin.router)
+app.include_router(imports.router)
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 @app.get("/")
 def root():
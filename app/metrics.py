@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Strumentazione del percorso di pricing, esposta in formato Prometheus su /metrics:
+#   - durata delle richieste HTTP per rotta (template), metodo e status
+#   - statement SQL e tempo SQL per richiesta (eventi dell'engine) e durata di ogni statement
+#   - timer per fase del calcolo (risoluzione BOM, costi, anagrafiche, esplosione, salvataggio...)
+#   - attesa per ottenere una connessione dal pool
+# Le misure di una richiesta sono raccolte in un RequestProfile legato al contesto (ContextVar),
+# che segue la richiesta anche nel threadpool e in run_sync. Con l'header X-Profile: 1 la
+# risposta riporta il dettaglio per fase nell'header Server-Timing.
+#
+# METRICS=0 disattiva la raccolta. I valori sono per processo: con piu' worker uvicorn ogni
+# processo espone i propri.
+
+METRICS_ENABLED = os.getenv("METRICS", "1") == "1"
+PROFILE_HEADER = "x-profile"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+_registry = []
+
+def _label_str(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._series = {}   # valori delle label -> [conteggi per bucket, somma, totale]
+        _registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self._series.items()]
+        for label_values, counts, total, count in sorted(items):
+            for bound, n in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_label_str(self.labels + ('le',), label_values + (bound,))} {n}")
+            lines.append(f"{self.name}_bucket{_label_str(self.labels + ('le',), label_values + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_label_str(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_label_str(self.labels, label_values)} {count}")
+        return lines
+
+class Gauge:
+    # Valore letto al momento dello scrape: fn() -> {valori delle label: valore}.
+    # kind="counter" per contatori mantenuti altrove (monotoni).
+    def __init__(self, name, help, fn, labels=(), kind="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = tuple(labels)
+        self.kind = kind
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self.fn().items()):
+            lines.append(f"{self.name}{_label_str(self.labels, label_values)} {value}")
+        return lines
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+REQUEST_SECONDS = Histogram(
+    "priceforge_http_request_duration_seconds", "Durata delle richieste HTTP",
+    labels=("route", "method", "status"))
+REQUEST_SQL_STATEMENTS = Histogram(
+    "priceforge_request_sql_statements", "Statement SQL eseguiti per richiesta", COUNT_BUCKETS, labels=("route",))
+REQUEST_SQL_SECONDS = Histogram(
+    "priceforge_request_sql_duration_seconds", "Tempo SQL totale per richiesta", labels=("route",))
+SQL_SECONDS = Histogram(
+    "priceforge_sql_statement_duration_seconds", "Durata dei singoli statement SQL", SQL_BUCKETS)
+STAGE_SECONDS = Histogram(
+    "priceforge_pricing_stage_duration_seconds", "Durata delle fasi del calcolo prezzi", labels=("stage",))
+POOL_WAIT_SECONDS = Histogram(
+    "priceforge_db_pool_checkout_wait_seconds", "Attesa per ottenere una connessione dal pool",
+    SQL_BUCKETS + (2.5, 5.0, 10.0, 30.0))
+
+class RequestProfile:
+    __slots__ = ("started", "sql_count", "sql_seconds", "stages")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.stages = {}
+
+    def server_timing(self, total):
+        parts = [f'sql;dur={self.sql_seconds * 1000:.2f};desc="{self.sql_count} statements"']
+        parts.extend(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in self.stages.items())
+        parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts)
+
+_profile = ContextVar("priceforge_request_profile", default=None)
+
+@contextmanager
+def stage(name):
+    # Cronometra una fase del calcolo: istogramma per fase e, se in una richiesta, il suo profilo
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, name)
+        profile = _profile.get()
+        if profile is not None:
+            profile.stages[name] = profile.stages.get(name, 0.0) + elapsed
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("priceforge_started", []).append(time.perf_counter())
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("priceforge_started")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    SQL_SECONDS.observe(elapsed)
+    profile = _profile.get()
+    if profile is not None:
+        profile.sql_count += 1
+        profile.sql_seconds += elapsed
+
+def instrument_engine(engine):
+    if METRICS_ENABLED:
+        event.listen(engine, "before_cursor_execute", _before_execute)
+        event.listen(engine, "after_cursor_execute", _after_execute)
+
+class _TimedCheckout:
+    # _do_get e' il punto in cui il pool consegna (o attende, o apre) una connessione
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+class MetricsMiddleware:
+    # Middleware ASGI: apre il profilo della richiesta, osserva le metriche a fine risposta e,
+    # su richiesta, aggiunge Server-Timing.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        wants_profile = any(k == PROFILE_HEADER.encode() and v not in (b"", b"0") for k, v in scope["headers"])
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if wants_profile:
+                    timing = profile.server_timing(time.perf_counter() - profile.started)
+                    message = dict(message)
+                    message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _profile.reset(token)
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            REQUEST_SECONDS.observe(time.perf_counter() - profile.started, route, scope["method"], status["code"])
+            REQUEST_SQL_STATEMENTS.observe(profile.sql_count, route)
+            REQUEST_SQL_SECONDS.observe(profile.sql_seconds, route)
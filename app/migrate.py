@@ -0,0 +1,22 @@
+import argparse
+from app.database import engine
+from app.migrations import MIGRATIONS, current_version, migrate
+
+# Applica le migrazioni di schema mancanti (all'avvio del servizio avviene gia' in automatico):
+#   python app/migrate.py            # fino all'ultima versione
+#   python app/migrate.py --status   # versione corrente e migrazioni in sospeso
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrazioni di schema PriceForge")
+    parser.add_argument("--target", type=int, default=None, help="versione massima da applicare")
+    parser.add_argument("--status", action="store_true", help="mostra lo stato senza applicare nulla")
+    args = parser.parse_args()
+    if args.status:
+        version = current_version(engine)
+        print(f"versione corrente: {version}")
+        for v, description, _ in MIGRATIONS:
+            if v > version:
+                print(f"  in sospeso: {v} {description}")
+    else:
+        applied = migrate(engine, args.target)
+        print(f"applicate: {applied or 'nessuna'}; versione corrente: {current_version(engine)}")
@@ -0,0 +1,196 @@
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, bindparam, insert, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from .database import Base
+from .models import (
+    CatalogChange, PriceCalculationDetail, PriceCalculationRun, PriceSnapshot, PublishedPrice, PublishedPriceState
+)
+from .persistence import snapshot_hash
+from .retention import ensure_partitions
+from . import schema_v1
+
+# Migrazioni di schema versionate. Ogni migrazione ha un numero crescente e viene applicata una
+# sola volta; le versioni applicate sono registrate in schema_migrations. Su Postgres gli indici
+# sono creati CONCURRENTLY (fuori transazione) e un advisory lock evita che piu' worker migrino
+# insieme all'avvio.
+
+_meta = MetaData()
+schema_migrations = Table(
+    "schema_migrations", _meta,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+MIGRATION_LOCK_ID = 72010
+
+def _initial_schema(conn):
+    # Lo schema di partenza congelato (schema_v1), non i modelli correnti: ogni versione
+    # corrisponde sempre allo stesso schema
+    schema_v1.metadata.create_all(bind=conn)
+
+# Indici per le query calde del pricing e per i lookup by-name/by-sku/by-code
+_PRICING_INDEXES = [
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_material_costs_material_valid_from "
+    "ON material_costs (material_id, valid_from)",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_operation_costs_operation_valid_from "
+    "ON operation_costs (operation_id, valid_from)",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_product_cost_overrides_lookup "
+    "ON product_cost_overrides (product_id, kind, ref_id, valid_from)",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_boms_product_active_version "
+    "ON boms (product_id, is_active, version)",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_bom_components_bom_line "
+    "ON bom_components (bom_id, line_no)",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_products_lower_sku ON products (lower(sku))",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_products_lower_name ON products (lower(name))",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_materials_lower_code ON materials (lower(code))",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_materials_lower_name ON materials (lower(name))",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_operations_lower_code ON operations (lower(code))",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_operations_lower_name ON operations (lower(name))",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_price_calculation_runs_product "
+    "ON price_calculation_runs (product_id)",
+    "CREATE INDEX {concurrently} IF NOT EXISTS ix_price_calculation_details_run "
+    "ON price_calculation_details (run_id)",
+]
+
+# Ricerca per prefisso (btree in collation "C") e trigrammi (GIN pg_trgm) su sku/code e nome.
+# Solo Postgres: su SQLite la ricerca per prefisso usa gli indici lower() della migrazione 2.
+_SEARCH_INDEXES = [("postgresql", "CREATE EXTENSION IF NOT EXISTS pg_trgm")] + [
+    ("postgresql", stmt.format(table=table, col=col, concurrently="{concurrently}"))
+    for table, cols in (("products", ("sku", "name")), ("materials", ("code", "name")), ("operations", ("code", "name")))
+    for col in cols
+    for stmt in (
+        'CREATE INDEX {concurrently} IF NOT EXISTS ix_{table}_{col}_prefix ON {table} ((lower({col}) COLLATE "C"))',
+        "CREATE INDEX {concurrently} IF NOT EXISTS ix_{table}_{col}_trgm ON {table} USING gin (lower({col}) gin_trgm_ops)",
+    )
+]
+
+def _partition_runs(conn):
+    # Run e dettagli con calculated_at (su Postgres partizionati per mese) e snapshot deduplicati in
+    # price_snapshots. Le tabelle della versione 1 sono rinominate in *_legacy, copiate e poi
+    # eliminate; le run storiche non hanno data di calcolo e prendono quella della migrazione.
+    # Gli indici su run e dettagli della migrazione 2 sono eliminati qui: ora sono dichiarati sui
+    # modelli (CONCURRENTLY non e' ammesso sulle tabelle partizionate).
+    # I dettagli perdono la FK verso le run e il suo ON DELETE CASCADE, anche su SQLite (stesso
+    # modello; li' la FK non era applicata comunque, manca PRAGMA foreign_keys): l'archiviazione
+    # stacca ed elimina le partizioni dei due mesi separatamente. I dettagli vanno via con il loro
+    # mese; una run cancellata a mano (o con il suo prodotto) li lascia fino all'archiviazione.
+    postgres = conn.dialect.name == "postgresql"
+    run_tables = [PriceSnapshot.__table__, PriceCalculationRun.__table__, PriceCalculationDetail.__table__]
+    if any(c["name"] == "calculated_at" for c in inspect(conn).get_columns("price_calculation_runs")):
+        # Tabelle gia' nella forma attuale (create dai modelli e non dalla migrazione 1)
+        conn.execute(text("DROP INDEX IF EXISTS ix_price_calculation_runs_product"))
+        Base.metadata.create_all(bind=conn, tables=run_tables)
+        ensure_partitions(conn)
+        return
+    for table in ("price_calculation_runs", "price_calculation_details"):
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_legacy"))
+        if postgres:
+            conn.execute(text(f"ALTER TABLE {table}_legacy RENAME CONSTRAINT {table}_pkey TO {table}_legacy_pkey"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_price_calculation_runs_product"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_price_calculation_details_run"))
+    Base.metadata.create_all(bind=conn, tables=run_tables)
+    migrated_at = datetime.utcnow()
+    ensure_partitions(conn, migrated_at.date())
+
+    # Letta con la definizione della versione 1 (tipi compresi), non riflessa dal DB
+    legacy = schema_v1.metadata.tables["price_calculation_runs"].to_metadata(
+        MetaData(), name="price_calculation_runs_legacy"
+    )
+    insert_snapshots = (postgresql if postgres else sqlite).insert(PriceSnapshot).on_conflict_do_nothing()
+    run_columns = [c.name for c in legacy.columns if c.name != "snapshot_json"]
+    last = None
+    while True:
+        stmt = select(legacy).order_by(legacy.c.run_id).limit(5000)
+        if last is not None:
+            stmt = stmt.where(legacy.c.run_id > last)
+        batch = conn.execute(stmt).mappings().all()
+        if not batch:
+            break
+        snapshots, runs = {}, []
+        for row in batch:
+            digest = snapshot_hash(row["snapshot_json"])
+            snapshots[digest] = {"snapshot_hash": digest, "snapshot_json": row["snapshot_json"], "created_at": migrated_at}
+            runs.append({**{c: row[c] for c in run_columns}, "calculated_at": migrated_at, "snapshot_hash": digest})
+        conn.execute(insert_snapshots, list(snapshots.values()))
+        conn.execute(insert(PriceCalculationRun.__table__), runs)
+        last = batch[-1]["run_id"]
+    conn.execute(text(
+        "INSERT INTO price_calculation_details (detail_id, calculated_at, run_id, line_no, kind, ref_id, "
+        "description, uom, quantity, unit_cost, extended_cost, source) "
+        "SELECT detail_id, :ts, run_id, line_no, kind, ref_id, description, uom, quantity, unit_cost, "
+        "extended_cost, source FROM price_calculation_details_legacy"
+    ).bindparams(bindparam("ts", type_=DateTime)), {"ts": migrated_at})
+    conn.execute(text("DROP TABLE price_calculation_details_legacy"))
+    conn.execute(text("DROP TABLE price_calculation_runs_legacy"))
+
+def _catalog_changes(conn):
+    CatalogChange.__table__.create(bind=conn, checkfirst=True)
+
+def _published_prices(conn):
+    PublishedPrice.__table__.create(bind=conn, checkfirst=True)
+    PublishedPriceState.__table__.create(bind=conn, checkfirst=True)
+
+# (versione, descrizione, funzione(conn) oppure lista di DDL da eseguire fuori transazione;
+# una DDL (dialetto, statement) viene eseguita solo su quel dialetto)
+MIGRATIONS = [
+    (1, "schema iniziale", _initial_schema),
+    (2, "indici per il percorso di pricing e i lookup", _PRICING_INDEXES),
+    (3, "run e dettagli partizionati per mese, snapshot deduplicati", _partition_runs),
+    (4, "registro delle modifiche al catalogo", _catalog_changes),
+    (5, "indici di ricerca per prefisso e trigrammi", _SEARCH_INDEXES),
+    (6, "listino pubblicato", _published_prices),
+]
+
+def _applied(conn):
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+def _record(conn, version, description):
+    conn.execute(insert(schema_migrations).values(
+        version=version, description=description, applied_at=datetime.utcnow()
+    ))
+
+def _run_ddl(engine: Engine, statements):
+    concurrently = "CONCURRENTLY" if engine.dialect.name == "postgresql" else ""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for stmt in statements:
+            if isinstance(stmt, tuple):
+                dialect, stmt = stmt
+                if dialect != engine.dialect.name:
+                    continue
+            conn.execute(text(stmt.format(concurrently=concurrently)))
+
+def current_version(engine: Engine):
+    with engine.connect() as conn:
+        if not engine.dialect.has_table(conn, "schema_migrations"):
+            return 0
+        return max(_applied(conn), default=0)
+
+def migrate(engine: Engine, target=None):
+    # -> versioni applicate da questa chiamata
+    done = []
+    with engine.connect() as lock_conn:
+        if engine.dialect.name == "postgresql":
+            lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        try:
+            with engine.begin() as conn:
+                _meta.create_all(bind=conn)
+                applied = _applied(conn)
+            for version, description, step in MIGRATIONS:
+                if version in applied or (target is not None and version > target):
+                    continue
+                if callable(step):
+                    with engine.begin() as conn:
+                        step(conn)
+                        _record(conn, version, description)
+                else:
+                    _run_ddl(engine, step)
+                    with engine.begin() as conn:
+                        _record(conn, version, description)
+                done.append(version)
+        finally:
+            if engine.dialect.name == "postgresql":
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+                lock_conn.commit()
+    return done
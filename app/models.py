@@ -1,5 +1,9 @@
 import uuid
-from sqlalchemy import Column, String, Text, Boolean, Date, Numeric, ForeignKey, Integer, CheckConstraint, JSON
+from datetime import datetime
+from sqlalchemy import (
+    Column, String, Text, Boolean, Date, DateTime, Numeric, ForeignKey, Integer, BigInteger, CheckConstraint, JSON,
+    Index
+)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 from .database import Base
@@ -88,9 +92,61 @@ class PricingSettings(Base):
     default_markup_pct = Column(Numeric(6,3), nullable=False, default=15.000)
     currency = Column(String(3), nullable=False, default="EUR")
 
+# Registro delle modifiche al catalogo (vedi changes.py): una riga per chiave (tipo, id) scritta
+# nella stessa transazione della modifica. Serve a chi lavora su una copia del catalogo (lo
+# snapshot mmap) per sapere cosa e' cambiato dopo l'export.
+class CatalogChange(Base):
+    __tablename__ = "catalog_changes"
+    change_id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    kind = Column(String(32), nullable=False)
+    ref_id = Column(UUID(as_uuid=True))
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (Index("ix_catalog_changes_changed_at", "changed_at"),)
+
+# Listino pubblicato (vedi price_list.py): prezzo a quantita' 1 alla data as_of di ogni prodotto
+# vendibile, ricalcolato solo per i prodotti toccati da una modifica. stale_since e' valorizzato
+# tra la registrazione della modifica e il ricalcolo; error quando il prodotto non e' calcolabile.
+class PublishedPrice(Base):
+    __tablename__ = "published_prices"
+    product_id = Column(UUID(as_uuid=True), ForeignKey("products.product_id", ondelete="CASCADE"), primary_key=True)
+    sku = Column(String(64), unique=True, nullable=False)
+    bom_id = Column(UUID(as_uuid=True))
+    as_of = Column(Date, nullable=False)
+    markup_pct = Column(Numeric(6,3), nullable=False)
+    total_material_cost = Column(Numeric(14,4))
+    total_operation_cost = Column(Numeric(14,4))
+    total_other_cost = Column(Numeric(14,4))
+    total_cost = Column(Numeric(14,4))
+    price = Column(Numeric(14,4))
+    currency = Column(String(3), nullable=False)
+    error = Column(Text)
+    computed_at = Column(DateTime, nullable=False)
+    stale_since = Column(DateTime)
+
+# Stato del listino pubblicato (una sola riga): ultimo change_id di catalog_changes applicato e
+# data dei prezzi.
+class PublishedPriceState(Base):
+    __tablename__ = "published_price_state"
+    state_id = Column(Boolean, primary_key=True, default=True)
+    change_id = Column(BigInteger, nullable=False, default=0)
+    as_of = Column(Date)
+    refreshed_at = Column(DateTime)
+
+# Snapshot di calcolo deduplicati per contenuto: run identiche (stessa BOM, costi, quantita')
+# referenziano la stessa riga tramite l'hash SHA-256 del JSON canonico.
+class PriceSnapshot(Base):
+    __tablename__ = "price_snapshots"
+    snapshot_hash = Column(String(64), primary_key=True)
+    snapshot_json = Column(JSON, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+# Run e dettagli sono partizionati per mese su calculated_at (Postgres, vedi retention.py):
+# la chiave di partizione fa parte della chiave primaria e i dettagli la ripetono, cosi'
+# le partizioni di un mese si archiviano e si eliminano insieme.
 class PriceCalculationRun(Base):
     __tablename__ = "price_calculation_runs"
     run_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    calculated_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
     product_id = Column(UUID(as_uuid=True), ForeignKey("products.product_id", ondelete="CASCADE"), nullable=False)
     bom_id = Column(UUID(as_uuid=True), ForeignKey("boms.bom_id", ondelete="SET NULL"))
     requested_qty = Column(Numeric(14,6), nullable=False, default=1)
@@ -102,12 +158,19 @@ class PriceCalculationRun(Base):
     price = Column(Numeric(14,4), nullable=False)
     currency = Column(String(3), nullable=False, default="EUR")
     validated = Column(Boolean, nullable=False, default=False)
-    snapshot_json = Column(JSON, nullable=False)
+    snapshot_hash = Column(String(64), ForeignKey("price_snapshots.snapshot_hash"), nullable=False)
+    snapshot = relationship("PriceSnapshot")
+    __table_args__ = (
+        Index("ix_price_calculation_runs_product_time", "product_id", "calculated_at"),
+        Index("ix_price_calculation_runs_snapshot", "snapshot_hash"),
+        {"postgresql_partition_by": "RANGE (calculated_at)"},
+    )
 
 class PriceCalculationDetail(Base):
     __tablename__ = "price_calculation_details"
     detail_id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    run_id = Column(UUID(as_uuid=True), ForeignKey("price_calculation_runs.run_id", ondelete="CASCADE"), nullable=False)
+    calculated_at = Column(DateTime, primary_key=True)
+    run_id = Column(UUID(as_uuid=True), nullable=False)
     line_no = Column(Integer, nullable=False)
     kind = Column(String(20), nullable=False)
     ref_id = Column(UUID(as_uuid=True), nullable=False)
@@ -117,3 +180,7 @@ class PriceCalculationDetail(Base):
     unit_cost = Column(Numeric(12,4), nullable=False)
     extended_cost = Column(Numeric(14,4), nullable=False)
     source = Column(String(32), nullable=False)
+    __table_args__ = (
+        Index("ix_price_calculation_details_run", "run_id"),
+        {"postgresql_partition_by": "RANGE (calculated_at)"},
+    )
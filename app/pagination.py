@@ -0,0 +1,67 @@
+import base64
+import binascii
+import json
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from .database import DB_ASYNC
+from .replicas import replica_router
+
+# Paginazione keyset per le liste di anagrafica: ordinamento sulla chiave unica (sku/code) e
+# cursore opaco con l'ultima chiave restituita. Il costo di una pagina non dipende da quante
+# pagine la precedono. La modalita' stream restituisce NDJSON leggendo dal DB con un cursore
+# lato server (yield_per), quindi la memoria resta costante qualunque sia la dimensione; come le
+# pagine, legge da una replica (replica_router) quando ce n'e' una utilizzabile.
+
+STREAM_YIELD_PER = 1000
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps([key]).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, key_type=str):
+    # key_type: tipo atteso della chiave (str per sku/code); un cursore forgiato con un altro tipo
+    # finirebbe nel WHERE del keyset e l'errore del DB diventerebbe un 500
+    if cursor is None:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        (key,) = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+    if not isinstance(key, key_type):
+        raise HTTPException(status_code=400, detail="Cursore non valido")
+    return key
+
+def _ordered(model, key_col, after):
+    stmt = select(model).order_by(key_col)
+    if after is not None:
+        stmt = stmt.where(key_col > after)
+    return stmt
+
+def keyset_page(db, model, key_col, after, limit):
+    # -> (righe, cursore della pagina successiva o None)
+    rows = db.execute(_ordered(model, key_col, after).limit(limit + 1)).scalars().all()
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(getattr(rows[limit - 1], key_col.key))
+    return rows, None
+
+def ndjson_response(model, key_col, schema, after):
+    # La sessione (di lettura, vedi replicas.py) e' aperta dal generatore stesso: deve vivere
+    # quanto lo stream, non la richiesta.
+    stmt = _ordered(model, key_col, after).execution_options(yield_per=STREAM_YIELD_PER)
+
+    def line(obj):
+        return schema.model_validate(obj).model_dump_json() + "\n"
+
+    if DB_ASYNC:
+        async def rows():
+            async with replica_router.session() as db:
+                result = await db.stream_scalars(stmt)
+                async for obj in result:
+                    yield line(obj)
+    else:
+        def rows():
+            with replica_router.session() as db:
+                for obj in db.execute(stmt).scalars():
+                    yield line(obj)
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
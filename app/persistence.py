@@ -0,0 +1,392 @@
+import hashlib
+import json
+import logging
+import os
+import pickle
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy import Numeric, insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from .database import SessionLocal
+from .explosion import PriceLine
+from .metrics import Gauge, stage
+from .models import PriceCalculationRun, PriceCalculationDetail, PriceSnapshot
+
+# Salvataggio delle run di calcolo. Testate e dettagli sono inseriti con un unico INSERT
+# multi-riga per tabella (executemany), senza passare dalla unit of work dell'ORM.
+# Lo snapshot JSON e' salvato una volta sola per contenuto (price_snapshots, chiave SHA-256
+# del JSON canonico): le run che ripetono lo stesso calcolo ne referenziano l'hash.
+#
+# In modalita' write-behind (WRITE_BEHIND=1) la richiesta non aspetta il DB: le righe vanno in una
+# coda e un thread le scrive raggruppando le run di piu' richieste nello stesso commit. Il run_id
+# e' generato prima, quindi la risposta e' gia' completa. Su un errore transitorio (connessione,
+# DB non disponibile) il batch resta al writer e viene riprovato con backoff finche' il DB non
+# torna; nel frattempo la coda si riempie e, piena, le richieste scrivono da sole in modo sincrono
+# (la risposta arriva solo a run salvata, o con l'errore del DB). Se invece il DB rifiuta le righe
+# (vincoli, dati, partizione mancante) il batch e' diviso a meta' fino a isolare le run rifiutate,
+# che finiscono nel file degli scarti con una riga di log; le altre sono salvate.
+# Allo shutdown la coda viene svuotata; se il DB non risponde entro il timeout, le run rimaste
+# vanno nel journal locale, riscritto nel DB all'avvio successivo del writer. Un journal illeggibile
+# viene rinominato (.corrupt) e lasciato li' per un controllo a mano.
+#
+# WRITE_BEHIND_MAX_QUEUE     batch in coda oltre i quali le richieste scrivono in modo sincrono
+# WRITE_BEHIND_BATCH         run massime per commit
+# WRITE_BEHIND_INTERVAL_MS   attesa massima per riempire un batch
+# WRITE_BEHIND_JOURNAL       file delle run non salvate allo shutdown
+# WRITE_BEHIND_REJECTED      file delle run rifiutate dal DB (non riprovate)
+
+log = logging.getLogger(__name__)
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "50"))
+WRITE_BEHIND_JOURNAL = os.getenv("WRITE_BEHIND_JOURNAL", "write_behind.journal")
+WRITE_BEHIND_REJECTED = os.getenv("WRITE_BEHIND_REJECTED", "write_behind.rejected")
+WRITE_BEHIND_MAX_BACKOFF_S = 5.0
+
+_RUN_COLUMNS = [c.key for c in PriceCalculationRun.__table__.columns]
+_RUN_SCALES = {
+    c.key: Decimal(1).scaleb(-c.type.scale)
+    for c in PriceCalculationRun.__table__.columns if isinstance(c.type, Numeric) and c.type.scale is not None
+}
+
+def _to_scale(value, quantum):
+    # Come Postgres quando converte un float in numeric(p, s): arrotondamento half away from zero.
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(repr(float(value))).quantize(quantum, rounding=ROUND_HALF_UP)
+
+def snapshot_hash(snapshot_json):
+    canonical = json.dumps(snapshot_json, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def snapshot_document(snapshot_json):
+    # Le righe del calcolo (PriceLine) diventano dict solo qui, quando lo snapshot viene salvato.
+    # Idempotente: uno snapshot condiviso tra piu' run puo' passare di qui da thread diversi.
+    items = [it.as_dict() if isinstance(it, PriceLine) else it for it in snapshot_json.get("items", ())]
+    return {**snapshot_json, "items": items}
+
+def quantize_run(run):
+    # Porta i valori numerici della run alla scala delle colonne, come farebbe il DB
+    for col, quantum in _RUN_SCALES.items():
+        setattr(run, col, _to_scale(getattr(run, col), quantum))
+    return run
+
+def run_rows(run, items):
+    # -> (riga price_calculation_runs, righe price_calculation_details, riga price_snapshots)
+    # La run non viene riletta dal DB dopo l'insert: i valori numerici sono portati qui alla
+    # scala delle colonne, cosi' la risposta e' identica a quella letta dalla tabella.
+    if run.run_id is None:
+        run.run_id = uuid.uuid4()
+    if run.calculated_at is None:
+        run.calculated_at = datetime.utcnow()
+    snapshot = run.snapshot
+    if snapshot.snapshot_hash is None:
+        document = snapshot_document(snapshot.snapshot_json)
+        snapshot.snapshot_json, snapshot.snapshot_hash = document, snapshot_hash(document)
+    run.snapshot_hash = snapshot.snapshot_hash
+    quantize_run(run)
+    run_row = {col: getattr(run, col) for col in _RUN_COLUMNS}
+    details = [
+        {
+            "detail_id": uuid.uuid4(),
+            "calculated_at": run.calculated_at,
+            "run_id": run.run_id,
+            "line_no": it.line_no,
+            "kind": it.kind,
+            "ref_id": it.ref_id,
+            "description": it.description,
+            "uom": it.uom,
+            "quantity": it.quantity,
+            "unit_cost": it.unit_cost,
+            "extended_cost": it.extended_cost,
+            "source": it.source,
+        }
+        for it in items
+    ]
+    snapshot_row = {
+        "snapshot_hash": snapshot.snapshot_hash,
+        "snapshot_json": snapshot.snapshot_json,
+        "created_at": run.calculated_at,
+    }
+    return run_row, details, snapshot_row
+
+def _insert_ignore(session: Session, model):
+    # INSERT che ignora le chiavi gia' presenti (snapshot gia' salvati da altre run)
+    dialect = session.get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return insert(model).prefix_with("IGNORE")
+
+def insert_runs(session: Session, rows):
+    # rows: [(run_row, detail_rows, snapshot_row)]; non fa commit
+    snapshots = {snap["snapshot_hash"]: snap for _, _, snap in rows}
+    session.execute(_insert_ignore(session, PriceSnapshot), list(snapshots.values()))
+    session.execute(insert(PriceCalculationRun), [run_row for run_row, _, _ in rows])
+    details = [d for _, detail_rows, _ in rows for d in detail_rows]
+    if details:
+        session.execute(insert(PriceCalculationDetail), details)
+
+def _transient(error):
+    # Errori per cui ha senso riprovare lo stesso batch: connessione persa, DB non disponibile,
+    # lock/timeout. Gli altri (IntegrityError, DataError, ...) dipendono dalle righe.
+    if isinstance(error, (OperationalError, InterfaceError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+class RunWriter:
+    def __init__(self, enabled=WRITE_BEHIND_ENABLED, max_queue=WRITE_BEHIND_MAX_QUEUE,
+                 batch=WRITE_BEHIND_BATCH, interval_ms=WRITE_BEHIND_INTERVAL_MS, session_factory=SessionLocal,
+                 journal=WRITE_BEHIND_JOURNAL, rejected=WRITE_BEHIND_REJECTED):
+        self.enabled = enabled
+        self.batch = batch
+        self.interval = interval_ms / 1000.0
+        self.session_factory = session_factory
+        self.journal = journal
+        self.rejected = rejected
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._abort = threading.Event()
+        self._journal_lock = threading.Lock()
+        self._abandoned = False     # stop() ha gia' scritto nel journal le run del writer bloccato
+        self._inflight = []         # parti del batch in corso non ancora salvate
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0, "written_runs": 0, "written_details": 0, "flushes": 0, "failed_flushes": 0,
+            "retrying_runs": 0, "rejected_runs": 0, "sync_writes": 0, "journaled_runs": 0, "replayed_runs": 0,
+            "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0,
+        }
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._abort.clear()
+                self._abandoned = False
+                self._thread = threading.Thread(target=self._run, name="run-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, rows):
+        # rows: [(run_row, detail_rows, snapshot_row)] di una richiesta.
+        # -> False se la coda e' piena: il chiamante deve salvare le run da se'.
+        self.start()
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats["sync_writes"] += len(rows)
+            return False
+        with self._stats_lock:
+            self._stats["submitted"] += len(rows)
+        return True
+
+    def stop(self, timeout=30.0):
+        # Svuota la coda e ferma il thread: nessuna run accettata va persa allo shutdown. Se il DB
+        # non risponde entro timeout, quello che resta finisce nel journal.
+        if self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+            self._thread.join(timeout)
+        except queue.Full:
+            pass
+        if self._thread.is_alive():
+            self._abort.set()
+            self._thread.join(timeout)
+        if self._thread.is_alive():
+            # Writer fermo in una chiamata al DB: il batch in corso e il resto della coda vanno nel
+            # journal. Se la chiamata poi riesce, al replay quelle run sono duplicati e finiscono
+            # negli scarti.
+            log.error("write-behind: il writer non si e' fermato entro %s s", timeout)
+            self._spill([r for part in list(self._inflight) for r in part] + self._drain(), abandon=True)
+        self._thread = None
+
+    def _run(self):
+        replay = self._read_journal()
+        if replay and not self._flush(replay):
+            self._spill(self._drain())
+            return
+        if replay:
+            with self._stats_lock:
+                self._stats["replayed_runs"] += len(replay)
+        while True:
+            pending, stop = self._collect()
+            if pending and not self._flush(pending):
+                self._spill(self._drain())
+                return
+            if stop:
+                return
+
+    def _collect(self):
+        pending = []
+        item = self._queue.get()
+        if item is None:
+            return pending, True
+        pending.extend(item)
+        deadline = time.monotonic() + self.interval
+        while len(pending) < self.batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return pending, True
+            pending.extend(item)
+        return pending, False
+
+    def _drain(self):
+        rows = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return rows
+            if item is not None:
+                rows.extend(item)
+
+    def _write(self, rows):
+        # -> None se salvate, altrimenti l'eccezione
+        session = self.session_factory()
+        try:
+            insert_runs(session, rows)
+            session.commit()
+            return None
+        except Exception as e:
+            session.rollback()
+            return e
+        finally:
+            session.close()
+
+    def _flush(self, pending):
+        # Salva il batch: errori transitori riprovati con backoff finche' il DB non torna, run
+        # rifiutate isolate dividendo il batch e messe negli scarti. -> False se interrotto da
+        # stop() (le run non salvate vanno nel journal insieme al resto della coda)
+        started = time.perf_counter()
+        parts = self._inflight = [pending]
+        attempt = 0
+        written = 0
+        while parts:
+            rows = parts[-1]    # resta in parts (e in _inflight) finche' non e' salvato o rifiutato
+            error = self._write(rows)
+            if error is None:
+                parts.pop()
+                attempt = 0
+                written += len(rows)
+                with self._stats_lock:
+                    s = self._stats
+                    s["written_runs"] += len(rows)
+                    s["written_details"] += sum(len(d) for _, d, _ in rows)
+                continue
+            if not _transient(error):
+                parts.pop()
+                if len(rows) == 1:
+                    self._reject(rows, error)
+                else:
+                    mid = len(rows) // 2
+                    parts.extend((rows[mid:], rows[:mid]))
+                continue
+            attempt += 1
+            with self._stats_lock:
+                self._stats["failed_flushes"] += 1
+                self._stats["retrying_runs"] = sum(len(part) for part in parts)
+            if attempt == 1 or attempt % 20 == 0:
+                log.error("write-behind: %d run non ancora salvate (tentativo %d): %s",
+                          sum(len(part) for part in parts), attempt, error)
+            if self._abort.wait(min(0.1 * 2 ** (attempt - 1), WRITE_BEHIND_MAX_BACKOFF_S)):
+                self._spill([r for part in parts for r in part])
+                self._inflight = []
+                return False
+        self._inflight = []
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        with self._stats_lock:
+            s = self._stats
+            s["flushes"] += 1
+            s["retrying_runs"] = 0
+            s["last_flush_ms"] = elapsed_ms
+            s["max_flush_ms"] = max(s["max_flush_ms"], elapsed_ms)
+            s["total_flush_ms"] += elapsed_ms
+        return True
+
+    def _reject(self, rows, error):
+        # Run che il DB non accettera' mai cosi' come sono: tenute da parte, non riprovate
+        with self._journal_lock:
+            with open(self.rejected, "ab") as f:
+                pickle.dump(rows, f)
+                f.flush()
+                os.fsync(f.fileno())
+        log.error("write-behind: run %s rifiutata dal DB, salvata in %s: %s",
+                  rows[0][0]["run_id"], self.rejected, error)
+        with self._stats_lock:
+            self._stats["rejected_runs"] += len(rows)
+
+    def _spill(self, rows, abandon=False):
+        with self._journal_lock:
+            if self._abandoned:
+                return
+            self._abandoned = abandon
+            if not rows:
+                return
+            with open(self.journal, "ab") as f:
+                pickle.dump(rows, f)
+                f.flush()
+                os.fsync(f.fileno())
+        log.error("write-behind: DB non raggiungibile allo shutdown, %d run salvate nel journal %s",
+                  len(rows), self.journal)
+        with self._stats_lock:
+            self._stats["journaled_runs"] += len(rows)
+
+    def _read_journal(self):
+        # Run lasciate da uno shutdown precedente; il file e' rimosso, quelle non riscritte ci tornano.
+        # Un journal troncato o illeggibile e' rinominato: si riscrivono solo i record interi letti
+        # prima del punto rovinato.
+        rows = []
+        try:
+            with open(self.journal, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                while f.tell() < size:
+                    rows.extend(pickle.load(f))
+        except FileNotFoundError:
+            return rows
+        except Exception:
+            aside = f"{self.journal}.corrupt-{datetime.utcnow():%Y%m%d%H%M%S}"
+            os.replace(self.journal, aside)
+            log.exception("write-behind: journal %s illeggibile, spostato in %s (%d run lette prima "
+                          "dell'errore)", self.journal, aside, len(rows))
+        else:
+            os.remove(self.journal)
+        log.info("write-behind: %d run dal journal %s", len(rows), self.journal)
+        return rows
+
+    def stats(self):
+        with self._stats_lock:
+            s = dict(self._stats)
+        s["enabled"] = self.enabled
+        s["queue_depth"] = self._queue.qsize()
+        s["avg_flush_ms"] = s.pop("total_flush_ms") / s["flushes"] if s["flushes"] else 0.0
+        return s
+
+run_writer = RunWriter()
+
+Gauge("priceforge_write_behind_queue_depth", "Batch di run in attesa del writer in background",
+      lambda: {(): run_writer.stats()["queue_depth"]})
+
+def persist_runs(session: Session, runs):
+    # runs: [(PriceCalculationRun, items)], salvati in un'unica transazione (o accodati)
+    with stage("persistence"):
+        rows = [run_rows(run, items) for run, items in runs]
+        if run_writer.enabled and run_writer.submit(rows):
+            return
+        insert_runs(session, rows)
+        session.commit()
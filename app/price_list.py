@@ -0,0 +1,307 @@
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy import and_, delete, insert, or_, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from .catalog_snapshot import CATALOG_CHANGES_RETENTION_DAYS
+from .changes import ChangeCursor, on_catalog_change, on_changes_recorded
+from .database import SessionLocal, in_chunks
+from .impact import where_used
+from .metrics import Gauge
+from .models import (
+    BOM, MaterialCost, OperationCost, PriceCalculationRun, Product, ProductCostOverride, PublishedPrice,
+    PublishedPriceState
+)
+from .persistence import quantize_run
+from .repricing import rollup
+from .services import _load_settings
+
+log = logging.getLogger(__name__)
+
+# Listino pubblicato: per ogni prodotto vendibile il prezzo di oggi a quantita' 1 con i totali di
+# costo, in published_prices. La lettura per sku e' un lookup sull'indice unico, senza esplosione
+# della BOM; l'export e' una scansione ordinata per sku.
+#
+# Aggiornamento incrementale: ogni passata legge da catalog_changes le chiavi registrate dopo
+# l'ultima applicata (da qualunque worker, import compresi) e ricalcola solo i prodotti toccati:
+#   costo di listino di un materiale/lavorazione -> i prodotti che lo usano, anche indirettamente
+#   override, BOM, componenti                    -> il prodotto e quelli che lo usano
+#   prodotto (markup, valuta, vendibile, sku)    -> il prodotto
+#   impostazioni di pricing                      -> tutto il listino
+# Al cambio di data si aggiungono le chiavi le cui finestre di validita' iniziano o finiscono tra
+# la data precedente e oggi. Il calcolo e' il rollup vettoriale di repricing.py sulla chiusura
+# dei prodotti toccati. Le righe toccate sono marcate stale_since gia' nella transazione della
+# modifica (on_changes_recorded), anche senza thread di aggiornamento, e restano stale fino al
+# ricalcolo; anche una riga con as_of precedente a oggi e' stale.
+#
+# Un solo processo aggiorna alla volta (advisory lock su Postgres). Il thread in background fa
+# una passata ogni PRICE_LIST_REFRESH_S secondi e subito dopo le modifiche fatte nel processo.
+#
+# PRICE_LIST_REFRESH_S   intervallo delle passate in background; 0 (default) = nessun thread,
+#                        aggiornamento con app/publish_prices.py o POST /pricing/price-list/refresh
+# PRICE_LIST_CHUNK       prodotti ricalcolati per transazione
+
+PRICE_LIST_REFRESH_S = float(os.getenv("PRICE_LIST_REFRESH_S", "0"))
+PRICE_LIST_CHUNK = int(os.getenv("PRICE_LIST_CHUNK", "1000"))
+PRICE_LIST_LOCK_ID = 72011
+
+# Tabelle con finestre di validita' -> tipo di chiave del registro
+_WINDOWED = (
+    (MaterialCost, "material_cost", MaterialCost.material_id),
+    (OperationCost, "operation_cost", OperationCost.operation_id),
+    (ProductCostOverride, "product_override", ProductCostOverride.product_id),
+    (BOM, "bom", BOM.product_id),
+)
+
+def _window_keys(session: Session, since, today):
+    # Chiavi con una finestra che inizia in (since, today] o finisce in [since, today)
+    keys = set()
+    for table, kind, ref_col in _WINDOWED:
+        keys.update((kind, ref_id) for ref_id in session.execute(select(ref_col).distinct().where(or_(
+            and_(table.valid_from > since, table.valid_from <= today),
+            and_(table.valid_to >= since, table.valid_to < today),
+        ))).scalars())
+    return keys
+
+def affected_products(session: Session, keys):
+    # -> product_id da ricalcolare per le chiavi modificate; None = tutto il listino
+    direct, refs, bom_ids = set(), set(), set()
+    for kind, ref_id in keys:
+        if kind == "settings":
+            return None
+        if kind in ("material_cost", "material"):
+            refs.add(("material", ref_id))
+        elif kind in ("operation_cost", "operation"):
+            refs.add(("operation", ref_id))
+        elif kind in ("product_override", "bom"):
+            direct.add(ref_id)
+            refs.add(("product", ref_id))
+        elif kind == "bom_component":
+            bom_ids.add(ref_id)
+        elif kind == "product":
+            direct.add(ref_id)
+    for chunk in in_chunks(bom_ids):
+        for product_id in session.execute(select(BOM.product_id).where(BOM.bom_id.in_(chunk))).scalars():
+            direct.add(product_id)
+            refs.add(("product", product_id))
+    if refs:
+        direct |= where_used.ancestors(refs)
+    return direct
+
+def _mark_stale(conn, product_ids):
+    # product_ids None = tutto il listino
+    mark = update(PublishedPrice).where(PublishedPrice.stale_since == None).values(stale_since=datetime.utcnow())
+    if product_ids is None:
+        conn.execute(mark)
+    else:
+        for chunk in in_chunks(product_ids):
+            conn.execute(mark.where(PublishedPrice.product_id.in_(chunk)))
+
+def _publish(session: Session, product_ids, as_of, default_markup, default_currency):
+    # Sostituisce le righe di product_ids: i prodotti non vendibili (o eliminati) escono dal listino.
+    # -> (righe scritte, di cui non calcolabili)
+    products = {}
+    for p in session.execute(
+        select(Product).where(Product.product_id.in_(product_ids), Product.is_sellable == True)
+    ).scalars():
+        products[p.product_id] = p
+    rows = []
+    if products:
+        ids, boms, tot_mat, tot_op, bad, reasons = rollup(session, products.keys(), as_of)
+        pos = {pid: i for i, pid in enumerate(ids)}
+        now = datetime.utcnow()
+        for pid, product in products.items():
+            i = pos[pid]
+            markup_pct = float(product.default_markup_pct) if product.default_markup_pct is not None else default_markup
+            row = {
+                "product_id": pid, "sku": product.sku, "as_of": as_of, "markup_pct": markup_pct,
+                "currency": product.currency or default_currency, "computed_at": now, "stale_since": None,
+                "bom_id": None, "total_material_cost": None, "total_operation_cost": None,
+                "total_other_cost": None, "total_cost": None, "price": None, "error": None,
+            }
+            if bad[i]:
+                row["error"] = reasons.get(pid, "errore")
+            else:
+                # Stessi valori (e stessa scala) di /pricing/quote a quantita' 1
+                tot = float(tot_mat[i]) + float(tot_op[i])
+                run = quantize_run(PriceCalculationRun(
+                    requested_qty=1, markup_pct=markup_pct, total_material_cost=float(tot_mat[i]),
+                    total_operation_cost=float(tot_op[i]), total_other_cost=0.0, total_cost=tot,
+                    price=round(tot * (1 + markup_pct/100.0), 4),
+                ))
+                row.update(
+                    bom_id=boms[pid].bom_id, total_material_cost=run.total_material_cost,
+                    total_operation_cost=run.total_operation_cost, total_other_cost=run.total_other_cost,
+                    total_cost=run.total_cost, price=run.price, markup_pct=run.markup_pct,
+                )
+            rows.append(row)
+    # Anche la riga di un altro prodotto con lo stesso sku (rinominato, ricalcolato a parte)
+    session.execute(delete(PublishedPrice).where(or_(
+        PublishedPrice.product_id.in_(product_ids), PublishedPrice.sku.in_([r["sku"] for r in rows])
+    )))
+    if rows:
+        session.execute(insert(PublishedPrice), rows)
+    return len(rows), sum(1 for r in rows if r["error"] is not None)
+
+class PriceListPublisher:
+    def __init__(self, refresh_s=PRICE_LIST_REFRESH_S, chunk=PRICE_LIST_CHUNK):
+        self.refresh_s = refresh_s
+        self.chunk = chunk
+        self._cursor = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.passes = 0
+        self.full_refreshes = 0
+        self.recomputed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.last_refresh = None    # time.time() dell'ultima passata completata
+        self.last_summary = None
+
+    @property
+    def enabled(self):
+        return self.refresh_s > 0
+
+    def refresh(self, engine: Engine, full=False):
+        # Una passata (incrementale, o completa con full) -> riepilogo
+        postgres = engine.dialect.name == "postgresql"
+        with self._lock, engine.connect() as lock_conn:
+            if postgres and not lock_conn.execute(
+                text("SELECT pg_try_advisory_lock(:id)"), {"id": PRICE_LIST_LOCK_ID}
+            ).scalar():
+                self.skipped += 1
+                return {"skipped": True, "reason": "aggiornamento in corso in un altro processo"}
+            try:
+                with SessionLocal(bind=engine) as session:
+                    summary = self._refresh(session, full)
+            except Exception:
+                # Il cursore in memoria puo' essere avanzato oltre lo stato salvato
+                self._cursor = None
+                self.errors += 1
+                raise
+            finally:
+                if postgres:
+                    lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": PRICE_LIST_LOCK_ID})
+                    lock_conn.commit()
+        self.passes += 1
+        self.full_refreshes += summary["full"]
+        self.recomputed += summary["published"]
+        self.last_refresh = time.time()
+        self.last_summary = summary
+        return summary
+
+    def _refresh(self, session: Session, full):
+        started = time.perf_counter()
+        today = date.today()
+        state = session.get(PublishedPriceState, True)
+        if state is None:
+            state = PublishedPriceState(state_id=True, change_id=0)
+            session.add(state)
+        if self._cursor is None or self._cursor.seen != state.change_id:
+            self._cursor = ChangeCursor(state.change_id)
+        keys = self._cursor.read(session.connection())
+        # Oltre la conservazione del registro le modifiche intermedie potrebbero essere state eliminate
+        expired = state.refreshed_at is None or state.refreshed_at < (
+            datetime.utcnow() - timedelta(days=CATALOG_CHANGES_RETENTION_DAYS - 1))
+        targets = None
+        if not (full or expired or state.as_of is None or state.as_of > today):
+            if state.as_of < today:
+                keys |= _window_keys(session, state.as_of, today)
+            # Modifiche di altri processi: l'indice "dove usato" ricarica le BOM toccate
+            where_used.mark_changed(keys)
+            targets = affected_products(session, keys)
+
+        full = targets is None
+        if full:
+            _mark_stale(session, None)
+            targets = set(session.execute(select(Product.product_id).where(Product.is_sellable == True)).scalars())
+            targets.update(session.execute(select(PublishedPrice.product_id)).scalars())
+        else:
+            _mark_stale(session, targets)
+        session.commit()
+
+        default_markup, default_currency = _load_settings(session)
+        published = failed = 0
+        for chunk in in_chunks(list(targets), self.chunk):
+            n, bad = _publish(session, chunk, today, default_markup, default_currency)
+            session.commit()
+            published += n
+            failed += bad
+        state.change_id = self._cursor.seen
+        state.as_of = today
+        state.refreshed_at = datetime.utcnow()
+        session.commit()
+        # Modifiche registrate durante la passata e non lette dal cursore: le righe ricalcolate
+        # con i dati precedenti tornano stale fino alla prossima passata
+        late = ChangeCursor(state.change_id).read(session.connection())
+        if late:
+            _mark_stale(session, affected_products(session, late))
+            session.commit()
+        return {
+            "as_of": today.isoformat(),
+            "full": full,
+            "changes": len(keys),
+            "products": len(targets),
+            "published": published,
+            "failed": failed,
+            "change_id": state.change_id,
+            "elapsed_s": round(time.perf_counter() - started, 3),
+        }
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self, engine: Engine):
+        if not self.enabled or self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.is_set():
+                self._wake.clear()
+                try:
+                    self.refresh(engine)
+                except Exception:
+                    log.exception("Aggiornamento del listino pubblicato fallito")
+                self._wake.wait(self.refresh_s)
+
+        self._thread = threading.Thread(target=run, name="price-list", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "refresh_s": self.refresh_s,
+            "passes": self.passes,
+            "full_refreshes": self.full_refreshes,
+            "recomputed": self.recomputed,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "last_refresh_age_s": round(time.time() - self.last_refresh, 1) if self.last_refresh else None,
+            "last": self.last_summary,
+        }
+
+price_list = PriceListPublisher()
+
+@on_changes_recorded
+def _changes_recorded(conn, keys):
+    # Righe toccate stale dal commit della modifica (nessun listino pubblicato: niente da marcare)
+    if conn.execute(select(PublishedPrice.product_id).limit(1)).first() is not None:
+        _mark_stale(conn, affected_products(conn, keys))
+
+@on_catalog_change
+def _catalog_changed(keys):
+    price_list.wake()
+
+Gauge("priceforge_price_list_refresh_age_seconds", "Secondi dall'ultima passata completata sul listino pubblicato",
+      lambda: {(): round(time.time() - price_list.last_refresh, 1)} if price_list.last_refresh else {})
+Gauge("priceforge_price_list_recomputed_total", "Righe del listino pubblicato ricalcolate",
+      lambda: {(): price_list.recomputed}, kind="counter")
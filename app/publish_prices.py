@@ -0,0 +1,14 @@
+import argparse
+import json
+from app.database import engine
+from app.price_list import price_list
+
+# Aggiornamento del listino pubblicato (senza il thread in background del servizio):
+#   python app/publish_prices.py           # solo i prodotti toccati dalle modifiche
+#   python app/publish_prices.py --full    # tutto il listino
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aggiorna il listino pubblicato (published_prices)")
+    parser.add_argument("--full", action="store_true", help="ricalcola tutti i prodotti vendibili")
+    args = parser.parse_args()
+    print(json.dumps(price_list.refresh(engine, args.full), indent=2))
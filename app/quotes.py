@@ -0,0 +1,101 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from .changes import get_catalog_version, on_catalog_change
+
+# Cache dei preventivi in sola lettura (GET /pricing/quote). La chiave e' la richiesta
+# (sku, quantita', data) piu' la catalog_version: qualunque scrittura su prodotti, BOM, costi,
+# override, anagrafiche o impostazioni la incrementa, quindi le voci vecchie non sono piu'
+# raggiungibili (e vengono comunque svuotate). Il valore e' la risposta gia' serializzata con il
+# suo ETag, un hash del contenuto: uguale tra worker diversi a parita' di risultato.
+#
+# Le scritture fatte da altri processi arrivano solo con CATALOG_NOTIFY=1; quelle fatte fuori
+# dal servizio non arrivano affatto, per questo le voci scadono comunque dopo QUOTE_CACHE_TTL.
+#
+# QUOTE_CACHE_MAX_ENTRIES   voci massime in memoria (LRU); 0 disabilita la cache
+# QUOTE_CACHE_TTL           secondi di validita' massima di una voce
+
+QUOTE_CACHE_MAX_ENTRIES = int(os.getenv("QUOTE_CACHE_MAX_ENTRIES", "10000"))
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "300"))
+
+def make_etag(body):
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match: lista di ETag (anche deboli, W/"...") oppure *
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+class QuoteCache:
+    def __init__(self, max_entries=QUOTE_CACHE_MAX_ENTRIES, ttl=QUOTE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (sku, qty, as_of, versione) -> (etag, body, salvata_alle)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def key(self, product_sku, requested_qty, as_of):
+        return (product_sku, float(requested_qty), as_of, get_catalog_version())
+
+    def get(self, key):
+        # -> (etag, body) oppure None
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[2] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, body):
+        # key calcolata prima del calcolo: se nel frattempo il catalogo e' cambiato la voce
+        # non viene salvata. -> etag
+        etag = make_etag(body)
+        if not self.enabled:
+            return etag
+        with self._lock:
+            if key[3] == get_catalog_version():
+                self._entries[key] = (etag, body, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return etag
+
+    def invalidate_all(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "catalog_version": get_catalog_version(),
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+quote_cache = QuoteCache()
+
+@on_catalog_change
+def _invalidate_quotes(keys):
+    quote_cache.invalidate_all()
@@ -0,0 +1,215 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from sqlalchemy import create_engine, make_url, text
+from starlette.concurrency import run_in_threadpool
+from .changes import on_catalog_change
+from .database import (
+    DB_ASYNC, DB_MAX_OVERFLOW, DB_POOL_SIZE, AsyncSessionLocal, SessionLocal, _async_url, extra_pools
+)
+from .metrics import Gauge, TimedAsyncQueuePool, TimedQueuePool, instrument_engine
+
+log = logging.getLogger(__name__)
+
+# Instradamento delle letture su repliche: le rotte in sola lettura (liste e lookup del catalogo,
+# preventivi, impatto, storico) e la fase di lettura del calcolo prezzi (BOM, costi) usano una
+# sessione su una replica; scritture e salvataggio delle run restano sul primario (engine).
+#
+# Scelta della replica: round_robin o least_loaded (meno connessioni in uso nel pool). Un thread
+# misura periodicamente il ritardo di replica; quelle irraggiungibili o in ritardo oltre
+# REPLICA_MAX_LAG_S sono escluse e, se non ne resta nessuna, si legge dal primario. Dopo una
+# modifica al catalogo (anche di un altro worker, con CATALOG_NOTIFY) le letture restano sul
+# primario per REPLICA_MAX_LAG_S secondi, cosi' cache e indici invalidati non vengono riempiti
+# con dati non ancora replicati.
+#
+# Su un'istanza che non e' in recovery il ritardo vale 0: due Postgres locali indipendenti
+# bastano per provare l'instradamento.
+
+def _urls(value):
+    return [u.strip() for u in value.split(",") if u.strip()]
+
+DATABASE_REPLICA_URLS = _urls(os.getenv("DATABASE_REPLICA_URLS", ""))
+ASYNC_DATABASE_REPLICA_URLS = _urls(os.getenv("ASYNC_DATABASE_REPLICA_URLS", ""))
+REPLICA_POLICY = os.getenv("REPLICA_POLICY", "round_robin")
+REPLICA_MAX_LAG_S = float(os.getenv("REPLICA_MAX_LAG_S", "5"))
+REPLICA_CHECK_S = float(os.getenv("REPLICA_CHECK_S", "2"))
+REPLICA_POOL_SIZE = int(os.getenv("REPLICA_POOL_SIZE", str(DB_POOL_SIZE)))
+REPLICA_MAX_OVERFLOW = int(os.getenv("REPLICA_MAX_OVERFLOW", str(DB_MAX_OVERFLOW)))
+
+_LAG_SQL = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+class Replica:
+    def __init__(self, name, url, async_url=None):
+        self.name = name
+        self.url = make_url(url).render_as_string(hide_password=True)
+        self.engine = create_engine(
+            url, echo=False, future=True, pool_size=REPLICA_POOL_SIZE, max_overflow=REPLICA_MAX_OVERFLOW,
+            poolclass=TimedQueuePool
+        )
+        instrument_engine(self.engine)
+        extra_pools[name] = self.engine.pool
+        self.async_engine = None
+        if DB_ASYNC:
+            from sqlalchemy.ext.asyncio import create_async_engine
+            self.async_engine = create_async_engine(
+                async_url or _async_url(url), echo=False, pool_size=REPLICA_POOL_SIZE, max_overflow=REPLICA_MAX_OVERFLOW,
+                poolclass=TimedAsyncQueuePool
+            )
+            instrument_engine(self.async_engine.sync_engine)
+            extra_pools[f"{name}-async"] = self.async_engine.pool
+        self.lag = None         # secondi; None = non ancora misurato
+        self.error = None
+        self.reads = 0
+
+    @property
+    def pool(self):
+        return (self.async_engine or self.engine).pool
+
+    def check(self):
+        try:
+            with self.engine.connect() as conn:
+                self.lag = float(conn.execute(_LAG_SQL).scalar()) if conn.dialect.name == "postgresql" else 0.0
+            self.error = None
+        except Exception as e:
+            if self.error is None:
+                log.warning("Replica %s non raggiungibile: %s", self.url, e)
+            self.lag, self.error = None, str(e)
+
+class ReplicaRouter:
+    def __init__(self, urls=DATABASE_REPLICA_URLS, async_urls=ASYNC_DATABASE_REPLICA_URLS, policy=REPLICA_POLICY,
+                 max_lag_s=REPLICA_MAX_LAG_S, check_s=REPLICA_CHECK_S):
+        if policy not in ("round_robin", "least_loaded"):
+            raise ValueError(f"REPLICA_POLICY non valida: {policy}")
+        if async_urls and len(async_urls) != len(urls):
+            raise ValueError("ASYNC_DATABASE_REPLICA_URLS deve avere un URL per ogni replica")
+        self.replicas = [
+            Replica(f"replica{i}", url, async_urls[i - 1] if async_urls else None) for i, url in enumerate(urls, 1)
+        ]
+        self.policy = policy
+        self.max_lag_s = max_lag_s
+        self.check_s = check_s
+        self._next = itertools.count()
+        self._primary_until = 0.0
+        self.primary_reads = 0
+        self.fallbacks = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def enabled(self):
+        return bool(self.replicas)
+
+    def pick(self):
+        # -> Replica, oppure None per leggere dal primario
+        if not self.enabled:
+            return None
+        if time.monotonic() < self._primary_until:
+            self.primary_reads += 1
+            return None
+        candidates = [r for r in self.replicas if r.lag is not None and r.lag <= self.max_lag_s]
+        if not candidates:
+            self.primary_reads += 1
+            self.fallbacks += 1
+            return None
+        if self.policy == "least_loaded":
+            replica = min(candidates, key=lambda r: r.pool.checkedout())
+        else:
+            replica = candidates[next(self._next) % len(candidates)]
+        replica.reads += 1
+        return replica
+
+    def catalog_changed(self):
+        self._primary_until = time.monotonic() + self.max_lag_s
+
+    def check(self):
+        for replica in self.replicas:
+            replica.check()
+
+    def start(self):
+        # Prima misura sincrona: fino ad allora (e senza start, es. negli script) si legge dal primario
+        if not self.enabled or self._thread is not None:
+            return
+        self.check()
+
+        def run():
+            while not self._stop.wait(self.check_s):
+                self.check()
+
+        self._thread = threading.Thread(target=run, name="replica-lag", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        self._stop.set()
+        for replica in self.replicas:
+            if replica.async_engine is not None:
+                await replica.async_engine.dispose()
+            replica.engine.dispose()
+
+    def session(self):
+        replica = self.pick()
+        if DB_ASYNC:
+            return AsyncSessionLocal(bind=replica.async_engine) if replica else AsyncSessionLocal()
+        return SessionLocal(bind=replica.engine) if replica else SessionLocal()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "policy": self.policy,
+            "max_lag_s": self.max_lag_s,
+            "primary_reads": self.primary_reads,
+            "fallbacks": self.fallbacks,
+            "replicas": [
+                {
+                    "name": r.name,
+                    "url": r.url,
+                    "lag_s": r.lag,
+                    "available": r.lag is not None and r.lag <= self.max_lag_s,
+                    "reads": r.reads,
+                    "checked_out": r.pool.checkedout(),
+                    "error": r.error,
+                }
+                for r in self.replicas
+            ],
+        }
+
+replica_router = ReplicaRouter()
+
+@on_catalog_change
+def _catalog_changed(keys):
+    replica_router.catalog_changed()
+
+# Come get_db / run_db_detached, ma su una replica (o sul primario se non ce ne sono di utilizzabili)
+
+if DB_ASYNC:
+    async def get_read_db():
+        async with replica_router.session() as db:
+            yield db
+else:
+    def get_read_db():
+        db = replica_router.session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+def _with_read_session(fn, *args, **kwargs):
+    with replica_router.session() as db:
+        return fn(db, *args, **kwargs)
+
+async def run_read_detached(fn, *args, **kwargs):
+    if DB_ASYNC:
+        async with replica_router.session() as db:
+            return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(_with_read_session, fn, *args, **kwargs)
+
+Gauge("priceforge_db_replica_lag_seconds", "Ritardo misurato delle repliche in lettura",
+      lambda: {(r.name,): r.lag for r in replica_router.replicas if r.lag is not None}, labels=("replica",))
+Gauge("priceforge_db_read_routed_total", "Sessioni di lettura per destinazione",
+      lambda: {("primary",): replica_router.primary_reads,
+               **{(r.name,): r.reads for r in replica_router.replicas}} if replica_router.enabled else {},
+      labels=("target",), kind="counter")
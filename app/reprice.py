@@ -0,0 +1,24 @@
+import argparse
+import json
+import os
+from datetime import date
+from app.repricing import reprice_catalog
+
+# Ricalcolo notturno di tutti i prodotti vendibili:
+#   python app/reprice.py --as-of 2025-01-01 --workers 4 --validate
+
+def _workers(value):
+    # stesso limite di POST /admin/reprice: 1..os.cpu_count()
+    n = int(value)
+    top = os.cpu_count() or 1
+    if not 1 <= n <= top:
+        raise argparse.ArgumentTypeError(f"deve essere tra 1 e {top}")
+    return n
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ricalcola i prezzi di tutti i prodotti vendibili")
+    parser.add_argument("--as-of", type=date.fromisoformat, default=None, help="data dei costi (default: oggi)")
+    parser.add_argument("--workers", type=_workers, default=1, help="processi paralleli (1..numero di CPU)")
+    parser.add_argument("--validate", action="store_true", help="salva le run come validate")
+    args = parser.parse_args()
+    print(json.dumps(reprice_catalog(args.as_of, args.validate, args.workers), indent=2))
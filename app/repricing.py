@@ -0,0 +1,236 @@
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import multiprocessing
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .database import SessionLocal, in_chunks
+from .explosion import load_boms, load_list_costs, load_product_overrides
+from .models import BOMComponent, MaterialCost, OperationCost, Product, PriceCalculationRun, PriceSnapshot
+from .persistence import run_rows, insert_runs
+from .services import _load_settings
+
+# Ricalcolo vettoriale dell'intero catalogo. Il DAG prodotti/BOM viene caricato una volta:
+#   A      (prodotti x prodotti)   quantita' per unita' dei sottoassiemi
+#   M, O   (prodotti x materiali/lavorazioni) quantita' per unita' delle righe a listino
+#   c_m, c_o                       costi di listino alla data
+# e i costi diretti sono d = M @ c_m (+ righe con override). Il costo totale si ottiene per
+# livelli topologici, dalle foglie in su: tot[livello] = d[livello] + A[livello] @ tot,
+# quindi le operazioni matriciali sono tante quanti i livelli della distinta.
+#
+# Le run scritte hanno requested_qty=1 e solo i totali nello snapshot (niente righe di dettaglio).
+
+REPRICE_WRITE_CHUNK = int(os.getenv("REPRICE_WRITE_CHUNK", "5000"))
+
+def _load_components(session: Session, bom_ids):
+    rows = []
+    for chunk in in_chunks(bom_ids):
+        rows.extend(session.execute(
+            select(
+                BOMComponent.bom_id, BOMComponent.kind, BOMComponent.ref_id,
+                BOMComponent.quantity, BOMComponent.waste_pct, BOMComponent.override_unit_cost
+            ).where(BOMComponent.bom_id.in_(chunk))
+        ).all())
+    return rows
+
+def load_catalog_graph(session: Session, root_ids, as_of):
+    # Chiusura del DAG a partire da root_ids: BOM risolte e righe, livello per livello.
+    boms, components = {}, []
+    new_products = set(root_ids)
+    while new_products:
+        level = load_boms(session, new_products, as_of)
+        boms.update(level)
+        comps = _load_components(session, [b.bom_id for b in level.values() if b is not None])
+        components.extend(comps)
+        new_products = {c.ref_id for c in comps if c.kind == "product"} - boms.keys()
+    return boms, components
+
+def rollup(session: Session, root_ids, as_of):
+    # -> (product_ids, boms, tot_mat, tot_op, bad, reasons); bad marca i prodotti non calcolabili
+    boms, components = load_catalog_graph(session, root_ids, as_of)
+    product_ids = list(boms.keys())
+    p_idx = {pid: i for i, pid in enumerate(product_ids)}
+    n = len(product_ids)
+    bom_owner = {b.bom_id: p_idx[pid] for pid, b in boms.items() if b is not None}
+    owner_product = {b.bom_id: pid for pid, b in boms.items() if b is not None}
+
+    # Costi di listino e override di prodotto, una query per tabella (a blocchi).
+    listed = {"material": set(), "operation": set()}
+    override_keys = set()
+    for c in components:
+        if c.kind in listed and c.override_unit_cost is None:
+            listed[c.kind].add(c.ref_id)
+            override_keys.add((owner_product[c.bom_id], c.kind, c.ref_id))
+    overrides = load_product_overrides(session, override_keys, as_of) if override_keys else {}
+    costs = {
+        "material": load_list_costs(session, MaterialCost, "material_id", listed["material"], as_of),
+        "operation": load_list_costs(session, OperationCost, "operation_id", listed["operation"], as_of),
+    }
+    ref_idx = {kind: {ref: i for i, ref in enumerate(sorted(refs))} for kind, refs in listed.items()}
+
+    a_rows, a_cols, a_vals = [], [], []
+    leaf = {kind: ([], [], []) for kind in listed}
+    direct = {kind: np.zeros(n) for kind in listed}
+    bad = np.zeros(n, dtype=bool)
+    reasons = {}
+    for pid, b in boms.items():
+        if b is None:
+            bad[p_idx[pid]] = True
+            reasons[pid] = "Nessuna BOM attiva/valida"
+
+    for c in components:
+        row = bom_owner[c.bom_id]
+        qty_per_unit = float(c.quantity) * (1.0 + float(c.waste_pct or 0)/100.0)
+        if c.kind == "product":
+            a_rows.append(row); a_cols.append(p_idx[c.ref_id]); a_vals.append(qty_per_unit)
+        elif c.kind in listed:
+            if c.override_unit_cost is not None:
+                direct[c.kind][row] += qty_per_unit * float(c.override_unit_cost)
+                continue
+            po = overrides.get((product_ids[row], c.kind, c.ref_id))
+            if po is not None:
+                direct[c.kind][row] += qty_per_unit * float(po)
+                continue
+            rows, cols, vals = leaf[c.kind]
+            rows.append(row); cols.append(ref_idx[c.kind][c.ref_id]); vals.append(qty_per_unit)
+        elif c.override_unit_cost is None:
+            bad[row] = True
+            reasons[product_ids[row]] = f"Kind non supportato: {c.kind}"
+
+    d = {}
+    for kind, (rows, cols, vals) in leaf.items():
+        refs = ref_idx[kind]
+        c_vec = np.full(len(refs), np.nan)
+        for ref, i in refs.items():
+            if ref in costs[kind]:
+                c_vec[i] = float(costs[kind][ref])
+        L = sparse.csr_matrix((vals, (rows, cols)), shape=(n, len(refs)))
+        missing = np.isnan(c_vec)
+        # Sulla struttura, non sulle quantita': anche una riga a quantita' 0 (o righe che si
+        # compensano) senza costo rende il prodotto non calcolabile, come nell'esplosione
+        used = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, len(refs)))
+        missing_rows = (used @ missing.astype(float)) > 0
+        for i in np.flatnonzero(missing_rows & ~bad):
+            reasons[product_ids[i]] = f"Nessun costo valido per {kind} alla data {as_of}"
+        bad |= missing_rows
+        d[kind] = L @ np.where(missing, 0.0, c_vec) + direct[kind]
+
+    A = sparse.csr_matrix((a_vals, (a_rows, a_cols)), shape=(n, n))
+    A_bool = sparse.csr_matrix((np.ones(len(a_rows), dtype=np.int32), (a_rows, a_cols)), shape=(n, n))
+    tot_mat = np.zeros(n)
+    tot_op = np.zeros(n)
+    done = np.zeros(n, dtype=bool)
+    while not done.all():
+        ready = ~done & ((A_bool @ (~done).astype(np.int32)) == 0)
+        if not ready.any():
+            break
+        idx = np.flatnonzero(ready)
+        A_lvl = A[idx]
+        tot_mat[idx] = d["material"][idx] + A_lvl @ tot_mat
+        tot_op[idx] = d["operation"][idx] + A_lvl @ tot_op
+        inherited = (A_bool[idx] @ bad.astype(np.int32)) > 0
+        for i in idx[inherited & ~bad[idx]]:
+            reasons[product_ids[i]] = "Sottoassieme non calcolabile"
+        bad[idx] |= inherited
+        done |= ready
+    for i in np.flatnonzero(~done):
+        reasons[product_ids[i]] = "BOM ciclica"
+    bad |= ~done
+    return product_ids, boms, tot_mat, tot_op, bad, reasons
+
+def reprice(session: Session, product_ids, as_of, validate=False):
+    # Ricalcola e salva una run per ciascun prodotto in product_ids. -> riepilogo
+    started = time.perf_counter()
+    products = {}
+    for chunk in in_chunks(product_ids):
+        for p in session.execute(select(Product).where(Product.product_id.in_(chunk))).scalars():
+            products[p.product_id] = p
+    default_markup, default_currency = _load_settings(session)
+    ids, boms, tot_mat, tot_op, bad, reasons = rollup(session, products.keys(), as_of)
+    pos = {pid: i for i, pid in enumerate(ids)}
+
+    rows, failed = [], {}
+    for pid, product in products.items():
+        i = pos[pid]
+        if bad[i]:
+            failed[product.sku] = reasons.get(pid, "errore")
+            continue
+        markup_pct = float(product.default_markup_pct) if product.default_markup_pct is not None else default_markup
+        currency = product.currency or default_currency
+        tot = float(tot_mat[i]) + float(tot_op[i])
+        run = PriceCalculationRun(
+            run_id=uuid.uuid4(),
+            product_id=pid,
+            bom_id=boms[pid].bom_id,
+            requested_qty=1,
+            markup_pct=markup_pct,
+            total_material_cost=float(tot_mat[i]),
+            total_operation_cost=float(tot_op[i]),
+            total_other_cost=0.0,
+            total_cost=tot,
+            price=round(tot * (1 + markup_pct/100.0), 4),
+            currency=currency,
+            validated=validate,
+            snapshot=PriceSnapshot(snapshot_json={
+                "as_of": as_of.isoformat(),
+                "requested_qty": 1,
+                "markup_pct": markup_pct,
+                "currency": currency,
+                "mode": "repricing",
+                "items": []
+            })
+        )
+        rows.append(run_rows(run, []))
+    computed = time.perf_counter()
+
+    for chunk in in_chunks(rows, REPRICE_WRITE_CHUNK):
+        insert_runs(session, chunk)
+        session.commit()
+    return {
+        "as_of": as_of.isoformat(),
+        "products": len(products),
+        "repriced": len(rows),
+        "failed": len(failed),
+        "failures": dict(list(failed.items())[:100]),
+        "compute_s": round(computed - started, 3),
+        "write_s": round(time.perf_counter() - computed, 3),
+    }
+
+def _sellable_ids(session: Session):
+    return list(session.execute(select(Product.product_id).where(Product.is_sellable == True)).scalars())
+
+def _reprice_shard(product_ids, as_of, validate):
+    session = SessionLocal()
+    try:
+        return reprice(session, product_ids, as_of, validate)
+    finally:
+        session.close()
+
+def reprice_catalog(as_of=None, validate=False, workers=1):
+    # Ricalcola tutti i prodotti vendibili; con workers > 1 divide i prodotti in shard su un
+    # process pool (ogni processo carica la chiusura del proprio shard e scrive le sue run).
+    as_of = as_of or date.today()
+    session = SessionLocal()
+    try:
+        product_ids = _sellable_ids(session)
+        if workers <= 1 or len(product_ids) < 2:
+            return reprice(session, product_ids, as_of, validate)
+    finally:
+        session.close()
+
+    shards = [product_ids[i::workers] for i in range(workers)]
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        results = list(pool.map(_reprice_shard, shards, [as_of] * workers, [validate] * workers))
+    summary = {"as_of": as_of.isoformat(), "workers": workers, "failures": {}}
+    for r in results:
+        for key in ("products", "repriced", "failed"):
+            summary[key] = summary.get(key, 0) + r[key]
+        for key in ("compute_s", "write_s"):
+            summary[key] = max(summary.get(key, 0.0), r[key])
+        summary["failures"].update(r["failures"])
+    return summary
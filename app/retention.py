@@ -0,0 +1,126 @@
+import gzip
+import json
+import os
+from datetime import date, datetime
+from sqlalchemy import delete, exists, func, select, text
+from sqlalchemy.engine import Engine
+from .models import PriceCalculationRun, PriceCalculationDetail, PriceSnapshot
+
+# Partizioni mensili di price_calculation_runs / price_calculation_details e retention.
+# Su Postgres le tabelle sono partizionate per RANGE (calculated_at): una partizione per mese
+# (<tabella>_yAAAAmMM) piu' una DEFAULT di sicurezza. Le partizioni dei mesi successivi sono
+# create in anticipo all'avvio e a ogni passata di retention.
+#
+# La retention archivia i mesi piu' vecchi di RUN_RETENTION_MONTHS in file NDJSON compressi
+# (una riga per run con il suo snapshot, una per dettaglio) e poi elimina la partizione intera,
+# senza DELETE riga per riga ne' vacuum. Infine rimuove gli snapshot non piu' referenziati.
+#
+# RUN_RETENTION_MONTHS   mesi completi mantenuti nel DB oltre al corrente
+# RUN_ARCHIVE_DIR        directory dei file di archivio
+# RUN_PARTITIONS_AHEAD   mesi futuri per cui creare le partizioni
+
+RUN_RETENTION_MONTHS = int(os.getenv("RUN_RETENTION_MONTHS", "13"))
+RUN_ARCHIVE_DIR = os.getenv("RUN_ARCHIVE_DIR", "archive")
+RUN_PARTITIONS_AHEAD = int(os.getenv("RUN_PARTITIONS_AHEAD", "3"))
+
+PARTITIONED = (PriceCalculationRun.__table__, PriceCalculationDetail.__table__)
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+def add_months(d, n):
+    m = d.year * 12 + d.month - 1 + n
+    return date(m // 12, m % 12 + 1, 1)
+
+def partition_name(table_name, month):
+    return f"{table_name}_y{month.year:04d}m{month.month:02d}"
+
+def ensure_partitions(conn, start=None, ahead=RUN_PARTITIONS_AHEAD):
+    # Crea (se mancano) la partizione DEFAULT e quelle mensili da start a start + ahead mesi.
+    if conn.dialect.name != "postgresql":
+        return
+    start = month_start(start or date.today())
+    for table in PARTITIONED:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table.name}_default PARTITION OF {table.name} DEFAULT"))
+        for i in range(ahead + 1):
+            month = add_months(start, i)
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {partition_name(table.name, month)} PARTITION OF {table.name} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+            ))
+
+def _month_range(table, month):
+    col = table.c.calculated_at
+    return (col >= datetime.combine(month, datetime.min.time())) & \
+           (col < datetime.combine(add_months(month, 1), datetime.min.time()))
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return str(value)
+
+def _export(conn, stmt, path):
+    # Scrive su file temporaneo e rinomina: un archivio esiste solo se e' completo.
+    # I mesi senza righe non producono file.
+    tmp = path + ".tmp"
+    count = 0
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        for row in conn.execute(stmt.execution_options(yield_per=5000)).mappings():
+            f.write(json.dumps(dict(row), default=_json_default) + "\n")
+            count += 1
+    if count:
+        os.replace(tmp, path)
+    else:
+        os.remove(tmp)
+    return count
+
+def _partition_exists(conn, name):
+    return conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+def archive_month(engine: Engine, month, archive_dir=RUN_ARCHIVE_DIR):
+    # Archivia ed elimina run e dettagli di un mese. -> {"month", "runs", "details", "files"}
+    runs, details = PriceCalculationRun.__table__, PriceCalculationDetail.__table__
+    os.makedirs(archive_dir, exist_ok=True)
+    paths = {t.name: os.path.join(archive_dir, partition_name(t.name, month) + ".ndjson.gz") for t in PARTITIONED}
+    with engine.begin() as conn:
+        n_runs = _export(
+            conn,
+            select(runs, PriceSnapshot.snapshot_json)
+            .join(PriceSnapshot, PriceSnapshot.snapshot_hash == runs.c.snapshot_hash)
+            .where(_month_range(runs, month)),
+            paths[runs.name],
+        )
+        n_details = _export(conn, select(details).where(_month_range(details, month)), paths[details.name])
+        for table in (details, runs):
+            name = partition_name(table.name, month)
+            if conn.dialect.name == "postgresql" and _partition_exists(conn, name):
+                conn.execute(text(f"ALTER TABLE {table.name} DETACH PARTITION {name}"))
+                conn.execute(text(f"DROP TABLE {name}"))
+            # Righe finite nella partizione DEFAULT (o tabella non partizionata)
+            conn.execute(delete(table).where(_month_range(table, month)))
+    files = [path for path, n in ((paths[runs.name], n_runs), (paths[details.name], n_details)) if n]
+    return {"month": month.isoformat()[:7], "runs": n_runs, "details": n_details, "files": files}
+
+def purge_snapshots(engine: Engine):
+    # Snapshot non piu' referenziati da alcuna run -> righe eliminate
+    runs = PriceCalculationRun.__table__
+    with engine.begin() as conn:
+        return conn.execute(
+            delete(PriceSnapshot).where(~exists().where(runs.c.snapshot_hash == PriceSnapshot.snapshot_hash))
+        ).rowcount
+
+def apply_retention(engine: Engine, keep_months=RUN_RETENTION_MONTHS, archive_dir=RUN_ARCHIVE_DIR, today=None):
+    # Archivia tutti i mesi anteriori a (mese corrente - keep_months), dal piu' vecchio.
+    today = today or date.today()
+    cutoff = add_months(month_start(today), -keep_months)
+    with engine.begin() as conn:
+        ensure_partitions(conn, today)
+        oldest = conn.execute(select(func.min(PriceCalculationRun.calculated_at))).scalar()
+    archived = []
+    month = month_start(oldest) if oldest is not None else cutoff
+    while month < cutoff:
+        result = archive_month(engine, month, archive_dir)
+        if result["runs"] or result["details"]:
+            archived.append(result)
+        month = add_months(month, 1)
+    return {"cutoff": cutoff.isoformat(), "archived": archived, "purged_snapshots": purge_snapshots(engine)}
@@ -0,0 +1,42 @@
+import os
+import threading
+from datetime import date
+from fastapi import APIRouter, HTTPException, Query
+from typing import Optional
+from ..repricing import reprice_catalog
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+# Stato dell'ultimo ricalcolo avviato da questo processo
+_reprice_lock = threading.Lock()
+_reprice_state = {"status": "idle", "result": None, "error": None}
+
+def _run_reprice(as_of, validate, workers):
+    try:
+        result = reprice_catalog(as_of, validate, workers)
+        _reprice_state.update(status="done", result=result, error=None)
+    except Exception as e:
+        _reprice_state.update(status="failed", result=None, error=str(e))
+    finally:
+        _reprice_lock.release()
+
+@router.post("/reprice", status_code=202)
+def start_reprice(as_of: Optional[date] = None, validate: bool = False,
+                  workers: int = Query(1, ge=1, le=os.cpu_count() or 1)):
+    if not _reprice_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Ricalcolo gia' in corso")
+    # thread proprio invece di BackgroundTasks: il ricalcolo parte subito, anche se l'invio della
+    # risposta fallisce; il lock lo rilascia il finally di _run_reprice, o questo se il thread non parte
+    try:
+        _reprice_state.update(status="running", result=None, error=None)
+        threading.Thread(target=_run_reprice, args=(as_of, validate, workers),
+                         name="reprice", daemon=True).start()
+    except BaseException as e:
+        _reprice_state.update(status="failed", result=None, error=str(e))
+        _reprice_lock.release()
+        raise
+    return _reprice_state
+
+@router.get("/reprice")
+def reprice_status():
+    return _reprice_state
@@ -0,0 +1,27 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from typing import Literal, Optional
+from ..database import get_db, run_db
+from ..imports import ENTITIES, IMPORT_CHUNK_ROWS, CatalogImport, RowReader
+
+router = APIRouter(prefix="/import", tags=["import"])
+
+@router.post("/{entity}")
+async def import_catalog(entity: str, request: Request, format: Optional[Literal["csv", "ndjson"]] = None,
+                         db=Depends(get_db)):
+    # Corpo CSV (con intestazione) o NDJSON letto in streaming; il formato, se non indicato,
+    # segue il Content-Type. Un'unica transazione: o tutte le righe valide o nessuna.
+    if entity not in ENTITIES:
+        raise HTTPException(404, f"Entita' non importabile: {entity} (ammesse: {', '.join(ENTITIES)})")
+    fmt = format or ("ndjson" if "json" in request.headers.get("content-type", "") else "csv")
+    reader = RowReader(fmt)
+    job = await run_db(db, CatalogImport, entity)
+    pending = []
+    async for data in request.stream():
+        pending.extend(reader.feed(data))
+        if len(pending) >= IMPORT_CHUNK_ROWS:
+            await run_db(db, job.add, pending)
+            pending = []
+    pending.extend(reader.close())
+    if pending:
+        await run_db(db, job.add, pending)
+    return await run_db(db, job.finish)
@@ -1,47 +1,71 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy import select, func
-from ..database import get_db
+from ..database import get_db, run_db
+from ..replicas import get_read_db
+from ..pagination import decode_cursor, keyset_page, ndjson_response
+from ..search import SEARCH_MAX_LIMIT, search
 from ..models import Material
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
 router = APIRouter(prefix="/materials", tags=["materials"])
 
 class MaterialIn(BaseModel):
-    material_id: str
+    # material_id facoltativo: se assente lo genera il modello
+    material_id: Optional[UUID] = None
     code: str
     name: str
-    uom: str | None = None
+    uom: Optional[str] = None
 
 class MaterialOut(MaterialIn):
-    Material_id: UUID
+    material_id: UUID
     class Config:
         from_attributes = True
 
-@router.post("/", response_model=MaterialOut)
-def create_material(body: MaterialIn, db: Session = Depends(get_db)):
-    p = Material(**body.model_dump())
+def _create(db, body):
+    p = Material(**body.model_dump(exclude_none=True))
     db.add(p); db.commit(); db.refresh(p)
     return p
 
+def _first(db, stmt):
+    return db.execute(stmt).scalars().first()
+
+@router.post("/", response_model=MaterialOut)
+async def create_material(body: MaterialIn, db=Depends(get_db)):
+    return await run_db(db, _create, body)
+
 @router.get("/", response_model=List[MaterialOut])
-def list_materials(db: Session = Depends(get_db)):
-    return db.query(Material).all()
+async def list_materials(response: Response, cursor: Optional[str] = None,
+                         limit: int = Query(100, ge=1, le=1000), stream: bool = False, db=Depends(get_read_db)):
+    # Pagina ordinata per code; il cursore della pagina successiva e' nell'header X-Next-Cursor.
+    # stream=true: tutte le righe (dal cursore in poi) come NDJSON.
+    after = decode_cursor(cursor)
+    if stream:
+        return ndjson_response(Material, Material.code, MaterialOut, after)
+    rows, next_cursor = await run_db(db, keyset_page, Material, Material.code, after, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
+
+@router.get("/search", response_model=List[MaterialOut])
+async def search_materials(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=SEARCH_MAX_LIMIT),
+                           db=Depends(get_read_db)):
+    # As-you-type: prefisso di code/nome, poi similarita' per trigrammi; in ordine di rilevanza
+    return await run_db(db, search, Material, "code", q, limit)
 
 @router.get("/by-name/{name}", response_model=MaterialOut)
-def get_material_by_name(name, db: Session = Depends(get_db)):
+async def get_material_by_name(name, db=Depends(get_read_db)):
     stmt = select(Material).where(func.lower(Material.name) == name.lower())
-    Material = db.execute(stmt).scalars().first()
-    if not Material:
+    material = await run_db(db, _first, stmt)
+    if not material:
         raise HTTPException(status_code=404, detail="Material not found")
-    return Material
+    return material
 
 @router.get("/by-code/{code}", response_model=MaterialOut)
-def get_material_by_code(code, db: Session = Depends(get_db)):
+async def get_material_by_code(code, db=Depends(get_read_db)):
     stmt = select(Material).where(func.lower(Material.code) == code.lower())
-    material = db.execute(stmt).scalars().first()
+    material = await run_db(db, _first, stmt)
     if not material:
         raise HTTPException(status_code=404, detail="Material not found")
-    return material
\ No newline at end of file
+    return material
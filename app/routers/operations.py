@@ -1,47 +1,71 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy import select, func
-from ..database import get_db
+from ..database import get_db, run_db
+from ..replicas import get_read_db
+from ..pagination import decode_cursor, keyset_page, ndjson_response
+from ..search import SEARCH_MAX_LIMIT, search
 from ..models import Operation
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
-router = APIRouter(prefix="/operationss", tags=["operations"])
+router = APIRouter(prefix="/operations", tags=["operations"])
 
 class OperationIn(BaseModel):
-    operation_id: str
+    # operation_id facoltativo: se assente lo genera il modello
+    operation_id: Optional[UUID] = None
     code: str
     name: str
-    uom: str | None = None
+    uom: Optional[str] = None
 
 class OperationOut(OperationIn):
-    Material_id: UUID
+    operation_id: UUID
     class Config:
         from_attributes = True
 
-@router.post("/", response_model=OperationOut)
-def create_operation(body: OperationIn, db: Session = Depends(get_db)):
-    p = Operation(**body.model_dump())
+def _create(db, body):
+    p = Operation(**body.model_dump(exclude_none=True))
     db.add(p); db.commit(); db.refresh(p)
     return p
 
+def _first(db, stmt):
+    return db.execute(stmt).scalars().first()
+
+@router.post("/", response_model=OperationOut)
+async def create_operation(body: OperationIn, db=Depends(get_db)):
+    return await run_db(db, _create, body)
+
 @router.get("/", response_model=List[OperationOut])
-def list_operations(db: Session = Depends(get_db)):
-    return db.query(Operation).all()
+async def list_operations(response: Response, cursor: Optional[str] = None,
+                          limit: int = Query(100, ge=1, le=1000), stream: bool = False, db=Depends(get_read_db)):
+    # Pagina ordinata per code; il cursore della pagina successiva e' nell'header X-Next-Cursor.
+    # stream=true: tutte le righe (dal cursore in poi) come NDJSON.
+    after = decode_cursor(cursor)
+    if stream:
+        return ndjson_response(Operation, Operation.code, OperationOut, after)
+    rows, next_cursor = await run_db(db, keyset_page, Operation, Operation.code, after, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
+
+@router.get("/search", response_model=List[OperationOut])
+async def search_operations(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=SEARCH_MAX_LIMIT),
+                            db=Depends(get_read_db)):
+    # As-you-type: prefisso di code/nome, poi similarita' per trigrammi; in ordine di rilevanza
+    return await run_db(db, search, Operation, "code", q, limit)
 
 @router.get("/by-name/{name}", response_model=OperationOut)
-def get_operation_by_name(name, db: Session = Depends(get_db)):
+async def get_operation_by_name(name, db=Depends(get_read_db)):
     stmt = select(Operation).where(func.lower(Operation.name) == name.lower())
-    Operation = db.execute(stmt).scalars().first()
-    if not Operation:
+    operation = await run_db(db, _first, stmt)
+    if not operation:
         raise HTTPException(status_code=404, detail="Operation not found")
-    return Operation
+    return operation
 
 @router.get("/by-code/{code}", response_model=OperationOut)
-def get_operation_by_code(code, db: Session = Depends(get_db)):
+async def get_operation_by_code(code, db=Depends(get_read_db)):
     stmt = select(Operation).where(func.lower(Operation.code) == code.lower())
-    operation = db.execute(stmt).scalars().first()
+    operation = await run_db(db, _first, stmt)
     if not operation:
         raise HTTPException(status_code=404, detail="Operation not found")
-    return operation
\ No newline at end of file
+    return operation
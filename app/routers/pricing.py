@@ -1,34 +1,304 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from ..database import get_db
-from ..schemas import PriceCalcRequest, PriceCalcResponse, PriceCalcDetail
-from ..services import calculate_and_persist
+from datetime import date, datetime, timedelta
+from typing import List, Literal, Optional
+from uuid import UUID
+import orjson
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from sqlalchemy import select, tuple_
+from starlette.concurrency import run_in_threadpool
+from ..database import engine, get_db, run_db, run_db_detached, in_chunks
+from ..schemas import (
+    PriceCalcRequest, PriceCalcResponse, PriceQuoteResponse, PriceTimelineResponse, PriceCalcBatchRequest, PriceCalcBatchResponse,
+    CostImpactRequest, CostImpactResponse, WhereUsedItem, PriceRunHistoryItem, PublishedPriceOut
+)
+from ..services import (
+    calculate_batch, calculate_coalesced, persist_batch, persist_copy, persist_run, price_batch, price_run, quote_price
+)
+from ..singleflight import pricing_flight
+from ..quotes import quote_cache, etag_matches
+from ..catalog_snapshot import catalog_snapshot
+from ..replicas import get_read_db, replica_router, run_read_detached
+from ..admission import admission
+from ..persistence import run_writer
+from ..impact import cost_impact, where_used
+from ..timeline import price_timeline
+from ..price_list import price_list
+from ..metrics import stage
+from ..models import Product, PriceCalculationRun, PriceSnapshot, PublishedPrice
+from ..pagination import encode_cursor, decode_cursor, keyset_page, ndjson_response
 
 router = APIRouter(prefix="/pricing", tags=["pricing"])
 
+# Le risposte di pricing sono serializzate direttamente con orjson a partire da run e righe
+# (PriceLine), senza costruire e rivalidare i modelli pydantic: response_model resta solo per la
+# documentazione OpenAPI. L'output e' identico byte per byte a quello di model_dump_json
+# (stesso ordine dei campi, stessa rappresentazione di float, UUID e date).
+
+def _run_payload(run, items):
+    return {
+        "run_id": run.run_id,
+        "product_id": run.product_id,
+        "requested_qty": float(run.requested_qty),
+        "markup_pct": float(run.markup_pct),
+        "total_material_cost": float(run.total_material_cost),
+        "total_operation_cost": float(run.total_operation_cost),
+        "total_other_cost": float(run.total_other_cost),
+        "total_cost": float(run.total_cost),
+        "price": float(run.price),
+        "currency": run.currency,
+        "validated": run.validated,
+        "items": items
+    }
+
+def _encode(payload):
+    # La fase "serialization" e' la sola codifica orjson (righe comprese), non la costruzione del dict
+    with stage("serialization"):
+        return orjson.dumps(payload)
+
+def _json_response(payload):
+    return Response(content=_encode(payload), media_type="application/json")
+
+async def _calculate_and_persist(product_sku, requested_qty, as_of):
+    # Con repliche: lettura di BOM e costi su una replica, salvataggio della run sul primario
+    if not replica_router.enabled:
+        return await run_db_detached(calculate_coalesced, product_sku, requested_qty, as_of)
+    run, items = await run_read_detached(price_run, product_sku, requested_qty, as_of)
+    return await run_db_detached(persist_run, run, items)
+
 @router.post("/calculate", response_model=PriceCalcResponse)
-def calculate_price(req: PriceCalcRequest, db: Session = Depends(get_db)):
+async def calculate_price(req: PriceCalcRequest, db=Depends(get_db)):
+    # Richieste identiche concorrenti condividono un solo calcolo (con una sessione propria,
+    # indipendente dalla richiesta che lo avvia). Senza validate condividono anche la run
+    # salvata; con validate ognuna salva la propria copia.
+    as_of = req.as_of or date.today()
+    key = (req.product_sku, float(req.requested_qty), as_of, req.validate)
     try:
-        run, items = calculate_and_persist(
-            session=db,
-            product_sku=req.product_sku,
-            requested_qty=req.requested_qty,
-            as_of=req.as_of,
-            validate=req.validate
-        )
+        if req.validate:
+            # Una run validata si basa solo su dati letti dal primario, mai da una replica
+            (run, items), _ = await pricing_flight.do_async(key, lambda: run_db_detached(
+                price_run, req.product_sku, req.requested_qty, as_of, True
+            ))
+            run, items = await run_db(db, persist_copy, run, items)
+        else:
+            (run, items), _ = await pricing_flight.do_async(key, lambda: _calculate_and_persist(
+                req.product_sku, req.requested_qty, as_of
+            ))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return _json_response(_run_payload(run, items))
+
+def _quote_body(db, product_sku, requested_qty, as_of):
+    run, items = quote_price(db, product_sku, requested_qty, as_of)
+    return _encode({
+        "product_id": run.product_id,
+        "product_sku": product_sku,
+        "as_of": as_of,
+        "requested_qty": float(run.requested_qty),
+        "markup_pct": float(run.markup_pct),
+        "total_material_cost": float(run.total_material_cost),
+        "total_operation_cost": float(run.total_operation_cost),
+        "total_other_cost": float(run.total_other_cost),
+        "total_cost": float(run.total_cost),
+        "price": float(run.price),
+        "currency": run.currency,
+        "items": items
+    })
+
+@router.get("/quote", response_model=PriceQuoteResponse)
+async def get_quote(sku: str, requested_qty: float = 1, as_of: Optional[date] = None,
+                    if_none_match: Optional[str] = Header(None), db=Depends(get_db)):
+    # Preventivo in sola lettura: nessuna run salvata. Risposte in cache finche' il catalogo
+    # non cambia; con If-None-Match uguale all'ETag corrente -> 304 senza ricalcolo.
+    as_of = as_of or date.today()
+    key = quote_cache.key(sku, requested_qty, as_of)
+    cached = quote_cache.get(key)
+    if cached is None:
+        try:
+            body, _ = await pricing_flight.do_async(("quote",) + key, lambda: run_read_detached(
+                _quote_body, sku, requested_qty, as_of
+            ))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        etag = quote_cache.put(key, body)
+    else:
+        etag, body = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@router.get("/timeline", response_model=PriceTimelineResponse)
+async def get_price_timeline(sku: str, date_from: date, date_to: date, requested_qty: float = 1, db=Depends(get_read_db)):
+    # Prezzo nel periodo come segmenti a prezzo costante, valutato solo nelle date in cui cambia
+    # una BOM, un costo di listino o un override (timeline.py). Nulla viene salvato.
+    try:
+        return await run_db(db, price_timeline, sku, requested_qty, date_from, date_to)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
-    return PriceCalcResponse(
-        run_id=run.run_id,
-        product_id=run.product_id,
-        requested_qty=float(run.requested_qty),
-        markup_pct=float(run.markup_pct),
-        total_material_cost=float(run.total_material_cost),
-        total_operation_cost=float(run.total_operation_cost),
-        total_other_cost=float(run.total_other_cost),
-        total_cost=float(run.total_cost),
-        price=float(run.price),
-        currency=run.currency,
-        validated=run.validated,
-        items=[PriceCalcDetail(**it) for it in items]
+
+# Listino pubblicato (price_list.py): prezzi a quantita' 1 gia' calcolati, letti senza esplosione.
+# stale/stale_since/age_s dicono quanto e' fresco ciascun valore.
+
+@router.get("/price-list", response_model=List[PublishedPriceOut])
+async def list_published_prices(response: Response, cursor: Optional[str] = None,
+                                limit: int = Query(100, ge=1, le=1000), stream: bool = False,
+                                db=Depends(get_read_db)):
+    # Come le liste di anagrafica: pagina per sku con X-Next-Cursor, oppure stream=true (NDJSON)
+    after = decode_cursor(cursor)
+    if stream:
+        return ndjson_response(PublishedPrice, PublishedPrice.sku, PublishedPriceOut, after)
+    rows, next_cursor = await run_db(db, keyset_page, PublishedPrice, PublishedPrice.sku, after, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
+
+@router.get("/price-list/refresh/stats")
+def price_list_stats():
+    return price_list.stats()
+
+@router.post("/price-list/refresh")
+async def refresh_price_list(full: bool = False):
+    return await run_in_threadpool(price_list.refresh, engine, full)
+
+def _published_price(db, sku):
+    return db.execute(select(PublishedPrice).where(PublishedPrice.sku == sku)).scalar_one_or_none()
+
+@router.get("/price-list/{sku}", response_model=PublishedPriceOut)
+async def get_published_price(sku: str, db=Depends(get_read_db)):
+    row = await run_db(db, _published_price, sku)
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"Prodotto non presente nel listino: {sku}")
+    return row
+
+@router.get("/quote/stats")
+def quote_cache_stats():
+    return quote_cache.stats()
+
+@router.get("/coalescing/stats")
+def coalescing_stats():
+    return pricing_flight.stats()
+
+@router.post("/calculate-batch", response_model=PriceCalcBatchResponse)
+async def calculate_price_batch(req: PriceCalcBatchRequest, db=Depends(get_db)):
+    if replica_router.enabled:
+        # Solo le richieste non validate leggono BOM e costi da una replica
+        replica_items = [r for r in req.items if not r.validate]
+        primary_items = [r for r in req.items if r.validate]
+        priced = iter(await run_read_detached(price_batch, replica_items) if replica_items else [])
+        primary = iter(await run_db(db, price_batch, primary_items) if primary_items else [])
+        results = [next(primary) if r.validate else next(priced) for r in req.items]
+        results = await run_db(db, persist_batch, results)
+    else:
+        results = await run_db(db, calculate_batch, req.items)
+    return _json_response({"items": [
+        {
+            "product_sku": r.product_sku,
+            "result": _run_payload(run, items) if error is None else None,
+            "error": error
+        }
+        for r, (run, items, error) in zip(req.items, results)
+    ]})
+
+@router.get("/write-behind/stats")
+def write_behind_stats():
+    return run_writer.stats()
+
+@router.get("/catalog-snapshot/stats")
+def catalog_snapshot_stats():
+    return catalog_snapshot.stats()
+
+@router.get("/admission/stats")
+def admission_stats():
+    return admission.stats()
+
+@router.get("/replicas/stats")
+def replica_stats():
+    return replica_router.stats()
+
+@router.post("/impact", response_model=CostImpactResponse)
+async def calculate_cost_impact(req: CostImpactRequest, db=Depends(get_read_db)):
+    # Variazioni ipotetiche di costo -> delta per prodotto, senza salvare nulla
+    as_of = req.as_of or date.today()
+    changes = {(c.kind, c.ref_id): c.unit_cost for c in req.changes}
+    items = await run_db(db, cost_impact, changes, as_of, req.requested_qty)
+    return CostImpactResponse(as_of=as_of, items=items)
+
+def _where_used(db, kind, ref_id, transitive):
+    if transitive:
+        ids = where_used.ancestors([(kind, ref_id)])
+    else:
+        ids = where_used.parents(kind, ref_id)
+    rows = []
+    for chunk in in_chunks(ids):
+        rows.extend(db.execute(select(Product.product_id, Product.sku).where(Product.product_id.in_(chunk))))
+    return [WhereUsedItem(product_id=pid, sku=sku) for pid, sku in sorted(rows, key=lambda r: r[1])]
+
+@router.get("/where-used/{kind}/{ref_id}", response_model=List[WhereUsedItem])
+async def get_where_used(kind: Literal["material", "operation", "product"], ref_id: UUID,
+                         transitive: bool = True, db=Depends(get_read_db)):
+    return await run_db(db, _where_used, kind, ref_id, transitive)
+
+def _history(db, sku, date_from, date_to, after, limit, include_snapshot):
+    # Filtri su calculated_at -> solo le partizioni dei mesi richiesti; su prodotto -> indice
+    # (product_id, calculated_at) dentro ciascuna partizione.
+    stmt = select(PriceCalculationRun, Product.sku).join(Product, Product.product_id == PriceCalculationRun.product_id)
+    if sku is not None:
+        product_id = db.execute(select(Product.product_id).where(Product.sku == sku)).scalar_one_or_none()
+        if product_id is None:
+            raise HTTPException(status_code=404, detail=f"Prodotto non trovato: {sku}")
+        stmt = stmt.where(PriceCalculationRun.product_id == product_id)
+    if date_from is not None:
+        stmt = stmt.where(PriceCalculationRun.calculated_at >= datetime.combine(date_from, datetime.min.time()))
+    if date_to is not None:
+        stmt = stmt.where(PriceCalculationRun.calculated_at < datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+    if after is not None:
+        try:
+            at, run_id = datetime.fromisoformat(after[0]), UUID(after[1])
+        except (TypeError, ValueError, IndexError):
+            raise HTTPException(status_code=400, detail="Cursore non valido")
+        stmt = stmt.where(tuple_(PriceCalculationRun.calculated_at, PriceCalculationRun.run_id) < (at, run_id))
+    stmt = stmt.order_by(PriceCalculationRun.calculated_at.desc(), PriceCalculationRun.run_id.desc()).limit(limit + 1)
+    rows = db.execute(stmt).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        next_cursor = encode_cursor([last.calculated_at.isoformat(), str(last.run_id)])
+    snapshots = {}
+    if include_snapshot:
+        hashes = {run.snapshot_hash for run, _ in rows}
+        for chunk in in_chunks(hashes):
+            snapshots.update(db.execute(
+                select(PriceSnapshot.snapshot_hash, PriceSnapshot.snapshot_json).where(PriceSnapshot.snapshot_hash.in_(chunk))
+            ).all())
+    items = [
+        PriceRunHistoryItem(
+            run_id=run.run_id,
+            calculated_at=run.calculated_at,
+            product_id=run.product_id,
+            sku=product_sku,
+            bom_id=run.bom_id,
+            requested_qty=float(run.requested_qty),
+            markup_pct=float(run.markup_pct),
+            total_cost=float(run.total_cost),
+            price=float(run.price),
+            currency=run.currency,
+            validated=run.validated,
+            snapshot_hash=run.snapshot_hash,
+            snapshot=snapshots.get(run.snapshot_hash)
+        )
+        for run, product_sku in rows
+    ]
+    return items, next_cursor
+
+@router.get("/history", response_model=List[PriceRunHistoryItem])
+async def get_price_history(response: Response, sku: Optional[str] = None,
+                            date_from: Optional[date] = None, date_to: Optional[date] = None,
+                            cursor: Optional[str] = None, limit: int = Query(100, ge=1, le=1000),
+                            include_snapshot: bool = False, db=Depends(get_read_db)):
+    # Run piu' recenti per prime; pagina successiva tramite l'header X-Next-Cursor.
+    items, next_cursor = await run_db(
+        db, _history, sku, date_from, date_to, decode_cursor(cursor, list), limit, include_snapshot
     )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
@@ -1,10 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
 from sqlalchemy import select, func
-from ..database import get_db
+from ..database import get_db, run_db
+from ..replicas import get_read_db
+from ..pagination import decode_cursor, keyset_page, ndjson_response
+from ..search import SEARCH_MAX_LIMIT, search
 from ..models import Product
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from uuid import UUID
 
 router = APIRouter(prefix="/products", tags=["products"])
@@ -22,28 +24,50 @@ class ProductOut(ProductIn):
     class Config:
         from_attributes = True
 
-@router.post("/", response_model=ProductOut)
-def create_product(body: ProductIn, db: Session = Depends(get_db)):
+def _create(db, body):
     p = Product(**body.model_dump())
     db.add(p); db.commit(); db.refresh(p)
     return p
 
+def _first(db, stmt):
+    return db.execute(stmt).scalars().first()
+
+@router.post("/", response_model=ProductOut)
+async def create_product(body: ProductIn, db=Depends(get_db)):
+    return await run_db(db, _create, body)
+
 @router.get("/", response_model=List[ProductOut])
-def list_products(db: Session = Depends(get_db)):
-    return db.query(Product).all()
+async def list_products(response: Response, cursor: Optional[str] = None,
+                        limit: int = Query(100, ge=1, le=1000), stream: bool = False, db=Depends(get_read_db)):
+    # Pagina ordinata per sku; il cursore della pagina successiva e' nell'header X-Next-Cursor.
+    # stream=true: tutte le righe (dal cursore in poi) come NDJSON.
+    after = decode_cursor(cursor)
+    if stream:
+        return ndjson_response(Product, Product.sku, ProductOut, after)
+    rows, next_cursor = await run_db(db, keyset_page, Product, Product.sku, after, limit)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
+
+@router.get("/search", response_model=List[ProductOut])
+async def search_products(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=SEARCH_MAX_LIMIT),
+                          db=Depends(get_read_db)):
+    # As-you-type: prefisso di sku/nome, poi similarita' per trigrammi; in ordine di rilevanza
+    return await run_db(db, search, Product, "sku", q, limit)
 
 @router.get("/by-name/{name}", response_model=ProductOut)
-def get_product_by_name(name, db: Session = Depends(get_db)):
+async def get_product_by_name(name, db=Depends(get_read_db)):
     stmt = select(Product).where(func.lower(Product.name) == name.lower())
-    product = db.execute(stmt).scalars().first()
+    product = await run_db(db, _first, stmt)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     return product
 
-@router.get("/by-sku/{sku}", response_model=ProductOut)
-def get_product_by_name(sku, db: Session = Depends(get_db)):
+# name invariato: operationId e url_for restano quelli pubblicati
+@router.get("/by-sku/{sku}", response_model=ProductOut, name="get_product_by_name")
+async def get_product_by_sku(sku, db=Depends(get_read_db)):
     stmt = select(Product).where(func.lower(Product.sku) == sku.lower())
-    product = db.execute(stmt).scalars().first()
+    product = await run_db(db, _first, stmt)
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    return product
\ No newline at end of file
+    return product
@@ -0,0 +1,130 @@
+from sqlalchemy import (
+    Boolean, CheckConstraint, Column, Date, ForeignKey, Integer, JSON, MetaData, Numeric, String, Table, Text
+)
+from sqlalchemy.dialects.postgresql import UUID
+
+# Schema iniziale (migrazione 1), congelato: le tabelle come erano prima delle migrazioni,
+# indipendenti dai modelli correnti. Non va modificato: le variazioni successive sono migrazioni.
+
+metadata = MetaData()
+
+Table(
+    "products", metadata,
+    Column("product_id", UUID(as_uuid=True), primary_key=True),
+    Column("sku", String(64), unique=True, nullable=False),
+    Column("name", String(200), nullable=False),
+    Column("description", Text),
+    Column("currency", String(3), nullable=False),
+    Column("default_markup_pct", Numeric(6,3)),
+    Column("is_sellable", Boolean, nullable=False),
+)
+
+Table(
+    "materials", metadata,
+    Column("material_id", UUID(as_uuid=True), primary_key=True),
+    Column("code", String(64), unique=True, nullable=False),
+    Column("name", String(200), nullable=False),
+    Column("uom", String(16), nullable=False),
+)
+
+Table(
+    "material_costs", metadata,
+    Column("material_cost_id", UUID(as_uuid=True), primary_key=True),
+    Column("material_id", UUID(as_uuid=True), ForeignKey("materials.material_id", ondelete="CASCADE"), nullable=False),
+    Column("unit_cost", Numeric(12,4), nullable=False),
+    Column("currency", String(3), nullable=False),
+    Column("valid_from", Date, nullable=False),
+    Column("valid_to", Date),
+)
+
+Table(
+    "operations", metadata,
+    Column("operation_id", UUID(as_uuid=True), primary_key=True),
+    Column("code", String(64), unique=True, nullable=False),
+    Column("name", String(200), nullable=False),
+    Column("uom", String(16), nullable=False),
+)
+
+Table(
+    "operation_costs", metadata,
+    Column("operation_cost_id", UUID(as_uuid=True), primary_key=True),
+    Column("operation_id", UUID(as_uuid=True), ForeignKey("operations.operation_id", ondelete="CASCADE"), nullable=False),
+    Column("unit_cost", Numeric(12,4), nullable=False),
+    Column("currency", String(3), nullable=False),
+    Column("valid_from", Date, nullable=False),
+    Column("valid_to", Date),
+)
+
+Table(
+    "boms", metadata,
+    Column("bom_id", UUID(as_uuid=True), primary_key=True),
+    Column("product_id", UUID(as_uuid=True), ForeignKey("products.product_id", ondelete="CASCADE"), nullable=False),
+    Column("version", Integer, nullable=False),
+    Column("is_active", Boolean, nullable=False),
+    Column("valid_from", Date, nullable=False),
+    Column("valid_to", Date),
+    CheckConstraint("version >= 1", name="chk_bom_version"),
+)
+
+Table(
+    "bom_components", metadata,
+    Column("bom_component_id", UUID(as_uuid=True), primary_key=True),
+    Column("bom_id", UUID(as_uuid=True), ForeignKey("boms.bom_id", ondelete="CASCADE"), nullable=False),
+    Column("line_no", Integer, nullable=False),
+    Column("kind", String(20), nullable=False),
+    Column("ref_id", UUID(as_uuid=True), nullable=False),
+    Column("quantity", Numeric(14,6), nullable=False),
+    Column("waste_pct", Numeric(6,3), nullable=False),
+    Column("override_unit_cost", Numeric(12,4)),
+)
+
+Table(
+    "product_cost_overrides", metadata,
+    Column("product_cost_override_id", UUID(as_uuid=True), primary_key=True),
+    Column("product_id", UUID(as_uuid=True), ForeignKey("products.product_id", ondelete="CASCADE"), nullable=False),
+    Column("kind", String(20), nullable=False),
+    Column("ref_id", UUID(as_uuid=True), nullable=False),
+    Column("override_unit_cost", Numeric(12,4), nullable=False),
+    Column("currency", String(3), nullable=False),
+    Column("valid_from", Date, nullable=False),
+    Column("valid_to", Date),
+)
+
+Table(
+    "pricing_settings", metadata,
+    Column("settings_id", Boolean, primary_key=True),
+    Column("default_markup_pct", Numeric(6,3), nullable=False),
+    Column("currency", String(3), nullable=False),
+)
+
+Table(
+    "price_calculation_runs", metadata,
+    Column("run_id", UUID(as_uuid=True), primary_key=True),
+    Column("product_id", UUID(as_uuid=True), ForeignKey("products.product_id", ondelete="CASCADE"), nullable=False),
+    Column("bom_id", UUID(as_uuid=True), ForeignKey("boms.bom_id", ondelete="SET NULL")),
+    Column("requested_qty", Numeric(14,6), nullable=False),
+    Column("markup_pct", Numeric(6,3), nullable=False),
+    Column("total_material_cost", Numeric(14,4), nullable=False),
+    Column("total_operation_cost", Numeric(14,4), nullable=False),
+    Column("total_other_cost", Numeric(14,4), nullable=False),
+    Column("total_cost", Numeric(14,4), nullable=False),
+    Column("price", Numeric(14,4), nullable=False),
+    Column("currency", String(3), nullable=False),
+    Column("validated", Boolean, nullable=False),
+    Column("snapshot_json", JSON, nullable=False),
+)
+
+Table(
+    "price_calculation_details", metadata,
+    Column("detail_id", UUID(as_uuid=True), primary_key=True),
+    Column("run_id", UUID(as_uuid=True), ForeignKey("price_calculation_runs.run_id", ondelete="CASCADE"), nullable=False),
+    Column("line_no", Integer, nullable=False),
+    Column("kind", String(20), nullable=False),
+    Column("ref_id", UUID(as_uuid=True), nullable=False),
+    Column("description", String(200)),
+    Column("uom", String(16)),
+    Column("quantity", Numeric(20,8), nullable=False),
+    Column("unit_cost", Numeric(12,4), nullable=False),
+    Column("extended_cost", Numeric(14,4), nullable=False),
+    Column("source", String(32), nullable=False),
+)
@@ -1,7 +1,7 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from pydantic import BaseModel, Field, computed_field
+from typing import Optional, List, Literal
 from uuid import UUID
-from datetime import date
+from datetime import date, datetime
 
 class PriceCalcRequest(BaseModel):
     product_sku: str = Field(..., description="SKU del prodotto da prezzare")
@@ -33,3 +33,127 @@ class PriceCalcResponse(BaseModel):
     currency: str
     validated: bool
     items: List[PriceCalcDetail]
+
+
+class PriceQuoteResponse(BaseModel):
+    product_id: UUID
+    product_sku: str
+    as_of: date
+    requested_qty: float
+    markup_pct: float
+    total_material_cost: float
+    total_operation_cost: float
+    total_other_cost: float
+    total_cost: float
+    price: float
+    currency: str
+    items: List[PriceCalcDetail]
+
+class PriceTimelineSegment(BaseModel):
+    valid_from: date
+    valid_to: date
+    bom_id: Optional[UUID] = None
+    total_material_cost: Optional[float] = None
+    total_operation_cost: Optional[float] = None
+    total_other_cost: Optional[float] = None
+    total_cost: Optional[float] = None
+    price: Optional[float] = None
+    error: Optional[str] = None
+
+class PriceTimelineResponse(BaseModel):
+    product_id: UUID
+    product_sku: str
+    requested_qty: float
+    markup_pct: float
+    currency: str
+    date_from: date
+    date_to: date
+    change_points: int
+    segments: List[PriceTimelineSegment]
+
+class PublishedPriceOut(BaseModel):
+    product_id: UUID
+    sku: str
+    as_of: date
+    bom_id: Optional[UUID] = None
+    markup_pct: float
+    total_material_cost: Optional[float] = None
+    total_operation_cost: Optional[float] = None
+    total_other_cost: Optional[float] = None
+    total_cost: Optional[float] = None
+    price: Optional[float] = None
+    currency: str
+    error: Optional[str] = None
+    computed_at: datetime
+    stale_since: Optional[datetime] = None
+
+    @computed_field
+    @property
+    def stale(self) -> bool:
+        # Ricalcolo in attesa, oppure prezzo di un giorno precedente
+        return self.stale_since is not None or self.as_of < date.today()
+
+    @computed_field
+    @property
+    def age_s(self) -> float:
+        return round((datetime.utcnow() - self.computed_at).total_seconds(), 1)
+
+    class Config:
+        from_attributes = True
+
+class PriceCalcBatchRequest(BaseModel):
+    items: List[PriceCalcRequest] = Field(..., min_length=1, max_length=1000)
+
+class PriceCalcBatchItem(BaseModel):
+    product_sku: str
+    result: Optional[PriceCalcResponse] = None
+    error: Optional[str] = None
+
+class PriceCalcBatchResponse(BaseModel):
+    items: List[PriceCalcBatchItem]
+
+class CostChange(BaseModel):
+    kind: Literal["material", "operation"]
+    ref_id: UUID
+    unit_cost: float
+
+class CostImpactRequest(BaseModel):
+    changes: List[CostChange] = Field(..., min_length=1)
+    as_of: Optional[date] = None
+    requested_qty: float = 1
+
+class CostImpactItem(BaseModel):
+    product_id: UUID
+    sku: str
+    is_sellable: bool
+    old_cost: Optional[float] = None
+    new_cost: Optional[float] = None
+    old_price: Optional[float] = None
+    new_price: Optional[float] = None
+    delta_cost: Optional[float] = None
+    delta_price: Optional[float] = None
+    old_error: Optional[str] = None
+    new_error: Optional[str] = None
+
+class CostImpactResponse(BaseModel):
+    as_of: date
+    items: List[CostImpactItem]
+
+class WhereUsedItem(BaseModel):
+    product_id: UUID
+    sku: str
+
+class PriceRunHistoryItem(BaseModel):
+    run_id: UUID
+    calculated_at: datetime
+    product_id: UUID
+    sku: str
+    bom_id: Optional[UUID] = None
+    requested_qty: float
+    markup_pct: float
+    total_cost: float
+    price: float
+    currency: str
+    validated: bool
+    snapshot_hash: str
+    snapshot: Optional[dict] = None
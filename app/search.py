@@ -0,0 +1,74 @@
+import sys
+from sqlalchemy import func, literal, or_, select
+from sqlalchemy.orm import Session
+
+# Ricerca as-you-type su prodotti (sku, name), materiali e lavorazioni (code, name).
+# 1. prefisso: range lower(col) >= termine AND < termine "successivo", ordinato e limitato sulla
+#    stessa espressione. Su Postgres l'espressione e' in collation "C" (ordine per byte, dove i
+#    valori con lo stesso prefisso sono contigui) con un indice btree dedicato: la query legge
+#    solo le righe restituite. Prima i prefissi di sku/code (la corrispondenza esatta e' la
+#    prima), poi quelli del nome.
+# 2. se non bastano e il termine ha almeno 3 caratteri: trigrammi (pg_trgm, indici GIN), per
+#    similarita' con sku/code e word similarity con il nome, ordinati per punteggio. Fuori da
+#    Postgres: sottostringa, con scansione.
+
+SEARCH_MAX_LIMIT = 100
+FUZZY_MIN_LENGTH = 3
+
+def _folded(col, postgres):
+    expr = func.lower(col)
+    return expr.collate("C") if postgres else expr
+
+def _successor(term):
+    # Il piu' piccolo valore maggiore di tutti quelli che iniziano con term (ordine per code point);
+    # None se non esiste (term fatto solo di U+10FFFF). I surrogati non sono codificabili in UTF-8.
+    term = term.rstrip(chr(sys.maxunicode))
+    if not term:
+        return None
+    code = ord(term[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        code = 0xE000
+    return term[:-1] + chr(code)
+
+def prefix_query(model, col, term, limit, postgres=True):
+    expr = _folded(col, postgres)
+    stmt = select(model).where(expr >= term)
+    upper = _successor(term)
+    if upper is not None:
+        stmt = stmt.where(expr < upper)
+    return stmt.order_by(expr).limit(limit)
+
+def fuzzy_query(model, key_col, term, limit, exclude=(), postgres=True):
+    key_expr, name_expr = func.lower(key_col), func.lower(model.name)
+    if postgres:
+        match = or_(key_expr.op("%")(term), literal(term).op("<%")(name_expr))
+        score = func.greatest(func.similarity(key_expr, term), func.word_similarity(term, name_expr))
+        order = (score.desc(), key_expr)
+    else:
+        match = or_(func.instr(key_expr, term) > 0, func.instr(name_expr, term) > 0)
+        order = (key_expr,)
+    stmt = select(model).where(match)
+    if exclude:
+        stmt = stmt.where(model.__mapper__.primary_key[0].notin_(exclude))
+    return stmt.order_by(*order).limit(limit)
+
+def search(session: Session, model, key_field, term, limit):
+    # -> oggetti del modello, al piu' limit, in ordine di rilevanza
+    term = term.strip().lower()
+    if not term:
+        return []
+    postgres = session.get_bind().dialect.name == "postgresql"
+    id_attr = model.__mapper__.primary_key[0].key
+    key_col = getattr(model, key_field)
+    found = {}
+    for col in (key_col, model.name):
+        for obj in session.execute(prefix_query(model, col, term, limit, postgres)).scalars():
+            found.setdefault(getattr(obj, id_attr), obj)
+        if len(found) >= limit:
+            return list(found.values())[:limit]
+    if len(term) >= FUZZY_MIN_LENGTH:
+        for obj in session.execute(
+            fuzzy_query(model, key_col, term, limit - len(found), list(found), postgres)
+        ).scalars():
+            found.setdefault(getattr(obj, id_attr), obj)
+    return list(found.values())
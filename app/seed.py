@@ -1,9 +1,10 @@
 from datetime import date
 from sqlalchemy.orm import Session
-from app.database import SessionLocal, engine, Base
+from app.database import SessionLocal, engine
+from app.migrations import migrate
 from app.models import (Product, Material, MaterialCost, Operation, OperationCost, BOM, BOMComponent, PricingSettings)
 
-Base.metadata.create_all(bind=engine)
+migrate(engine)
 db: Session = SessionLocal()
 
 # Settings
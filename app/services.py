@@ -1,140 +1,54 @@
+import uuid
 from datetime import date
 from sqlalchemy.orm import Session
 from sqlalchemy import select
-from .models import (
-    Product, BOM, BOMComponent, Material, MaterialCost, Operation, OperationCost,
-    ProductCostOverride, PricingSettings, PriceCalculationRun, PriceCalculationDetail
-)
-
-def _get_cost_from_list(session: Session, table, id_field, ref_id, as_of):
-    stmt = (
-        select(table.unit_cost)
-        .where(getattr(table, id_field) == ref_id)
-        .where(table.valid_from <= as_of)
-        .where((table.valid_to == None) | (table.valid_to >= as_of))
-        .order_by(table.valid_from.desc())
-        .limit(1)
-    )
-    return session.execute(stmt).scalar_one_or_none()
-
-def _get_product_override(session: Session, product_id, kind, ref_id, as_of):
-    stmt = (
-        select(ProductCostOverride.override_unit_cost)
-        .where(ProductCostOverride.product_id == product_id)
-        .where(ProductCostOverride.kind == kind)
-        .where(ProductCostOverride.ref_id == ref_id)
-        .where(ProductCostOverride.valid_from <= as_of)
-        .where((ProductCostOverride.valid_to == None) | (ProductCostOverride.valid_to >= as_of))
-        .order_by(ProductCostOverride.valid_from.desc())
-        .limit(1)
-    )
-    return session.execute(stmt).scalar_one_or_none()
-
-def _active_or_valid_bom(session: Session, product_id, as_of):
-    active = session.execute(
-        select(BOM).where(BOM.product_id == product_id, BOM.is_active == True).order_by(BOM.version.desc()).limit(1)
-    ).scalar_one_or_none()
-    if active:
-        return active
-    latest_valid = session.execute(
-        select(BOM).where(
-            BOM.product_id == product_id,
-            BOM.valid_from <= as_of,
-            (BOM.valid_to == None) | (BOM.valid_to >= as_of)
-        ).order_by(BOM.version.desc()).limit(1)
-    ).scalar_one_or_none()
-    return latest_valid
-
-def _expand_product(session: Session, product_id, qty, as_of, snapshot_items, line_no_start=1):
-    # Recursively expand a product's BOM.
-    bom = _active_or_valid_bom(session, product_id, as_of)
-    if not bom:
-        raise ValueError(f"Nessuna BOM attiva/valida per product_id={product_id}")
-
-    total_mat = 0.0
-    total_op = 0.0
-    cur_line = line_no_start
-
-    for comp in sorted(bom.components, key=lambda c: c.line_no):
-        qty_per_unit = float(comp.quantity) * (1.0 + float(comp.waste_pct or 0)/100.0)
-        eff_qty = qty * qty_per_unit
-
-        if comp.kind == "product":
-            cur_line, sub_mat, sub_op = _expand_product(session, comp.ref_id, eff_qty, as_of, snapshot_items, cur_line)
-            total_mat += sub_mat
-            total_op += sub_op
-            continue
-
-        unit_cost = None
-        source = None
-        if comp.override_unit_cost is not None:
-            unit_cost = float(comp.override_unit_cost)
-            source = "override_bom"
-        else:
-            po = _get_product_override(session, bom.product_id, comp.kind, comp.ref_id, as_of)
-            if po is not None:
-                unit_cost = float(po)
-                source = "override_product"
-            else:
-                if comp.kind == "material":
-                    c = _get_cost_from_list(session, MaterialCost, "material_id", comp.ref_id, as_of)
-                elif comp.kind == "operation":
-                    c = _get_cost_from_list(session, OperationCost, "operation_id", comp.ref_id, as_of)
-                else:
-                    raise ValueError(f"Kind non supportato: {comp.kind}")
-                if c is None:
-                    raise ValueError(f"Nessun costo valido per {comp.kind} {comp.ref_id} alla data {as_of}")
-                unit_cost = float(c)
-                source = "listino"
-
-        extended = eff_qty * unit_cost
-
-        desc, uom = None, None
-        if comp.kind == "material":
-            m = session.get(Material, comp.ref_id)
-            if m: desc, uom = m.name, m.uom
-            total_mat += extended
-        elif comp.kind == "operation":
-            o = session.get(Operation, comp.ref_id)
-            if o: desc, uom = o.name, o.uom
-            total_op += extended
-
-        snapshot_items.append({
-            "line_no": cur_line,
-            "kind": comp.kind,
-            "ref_id": str(comp.ref_id),
-            "description": desc,
-            "uom": uom,
-            "quantity": eff_qty,
-            "unit_cost": unit_cost,
-            "extended_cost": extended,
-            "source": source
-        })
-        cur_line += 1
-
-    return cur_line, total_mat, total_op
-
-def calculate_and_persist(session: Session, product_sku: str, requested_qty: float = 1.0, as_of=None, validate=False):
-    as_of = as_of or date.today()
-
-    product = session.execute(select(Product).where(Product.sku == product_sku)).scalar_one_or_none()
-    if not product:
-        raise ValueError(f"Prodotto con SKU='{product_sku}' non trovato")
-
+from .models import Product, PricingSettings, PriceCalculationRun, PriceSnapshot
+from .database import in_chunks
+from .explosion import BomTree
+from .compiled import compiled_cache
+from .persistence import persist_runs, quantize_run
+from .metrics import stage
+from .singleflight import pricing_flight
+from .admission import check_deadline
+
+_RUN_COPY_COLUMNS = [
+    c.key for c in PriceCalculationRun.__table__.columns if c.key not in ("run_id", "calculated_at", "snapshot_hash")
+]
+
+def _load_settings(session: Session):
     settings = session.get(PricingSettings, True)
     default_markup = float(settings.default_markup_pct) if settings else 15.0
+    default_currency = settings.currency if settings else "EUR"
+    return default_markup, default_currency
+
+def _explode(session: Session, tree: BomTree, product_id, requested_qty):
+    # -> (bom_id, items, total_material, total_operation)
+    check_deadline("esplosione BOM")
+    if compiled_cache.enabled:
+        compiled = compiled_cache.compile(session, tree, product_id)
+        with stage("expand"):
+            items, tot_mat, tot_op = compiled.scale(float(requested_qty))
+        return compiled.bom_id, items, tot_mat, tot_op
+    tree.load(session, [product_id])
+    items = []
+    with stage("expand"):
+        _, tot_mat, tot_op = tree.expand(product_id, float(requested_qty), items, 1)
+    return tree.bom_for(product_id).bom_id, items, tot_mat, tot_op
+
+def _build_run(session: Session, tree: BomTree, product, requested_qty, validate, default_markup, default_currency):
+    as_of = tree.as_of
     markup_pct = float(product.default_markup_pct) if product.default_markup_pct is not None else default_markup
-    currency = product.currency or (settings.currency if settings else "EUR")
+    currency = product.currency or default_currency
 
-    items = []
-    _, tot_mat, tot_op = _expand_product(session, product.product_id, float(requested_qty), as_of, items, 1)
+    bom_id, items, tot_mat, tot_op = _explode(session, tree, product.product_id, requested_qty)
     tot_oth = 0.0
     tot = tot_mat + tot_op + tot_oth
     price = round(tot * (1 + markup_pct/100.0), 4)
 
     run = PriceCalculationRun(
+        run_id=uuid.uuid4(),
         product_id=product.product_id,
-        bom_id=_active_or_valid_bom(session, product.product_id, as_of).bom_id,
+        bom_id=bom_id,
         requested_qty=requested_qty,
         markup_pct=markup_pct,
         total_material_cost=tot_mat,
@@ -144,29 +58,115 @@ def calculate_and_persist(session: Session, product_sku: str, requested_qty: flo
         price=price,
         currency=currency,
         validated=validate,
-        snapshot_json={
+        snapshot=PriceSnapshot(snapshot_json={
             "as_of": as_of.isoformat(),
             "requested_qty": requested_qty,
             "markup_pct": markup_pct,
             "currency": currency,
             "items": items
-        }
+        })
     )
-    session.add(run); session.flush()
-
-    for it in items:
-        det = PriceCalculationDetail(
-            run_id=run.run_id,
-            line_no=it["line_no"],
-            kind=it["kind"],
-            ref_id=it["ref_id"],
-            description=it.get("description"),
-            uom=it.get("uom"),
-            quantity=it["quantity"],
-            unit_cost=it["unit_cost"],
-            extended_cost=it["extended_cost"],
-            source=it["source"]
-        )
-        session.add(det)
-    session.commit()
     return run, items
+
+def price_run(session: Session, product_sku, requested_qty, as_of, validate=False):
+    # -> (run non salvata, items)
+    check_deadline("lookup prodotto")
+    with stage("product_lookup"):
+        product = session.execute(select(Product).where(Product.sku == product_sku)).scalar_one_or_none()
+        if not product:
+            raise ValueError(f"Prodotto con SKU='{product_sku}' non trovato")
+        default_markup, default_currency = _load_settings(session)
+    return _build_run(session, BomTree(as_of), product, requested_qty, validate, default_markup, default_currency)
+
+def calculate_and_persist(session: Session, product_sku: str, requested_qty: float = 1.0, as_of=None, validate=False):
+    as_of = as_of or date.today()
+    run, items = price_run(session, product_sku, requested_qty, as_of, validate)
+    return persist_run(session, run, items)
+
+def persist_run(session: Session, run, items):
+    # Salvataggio di una run calcolata altrove (es. con la sessione di lettura su una replica)
+    persist_runs(session, [(run, items)])
+    return run, items
+
+def persist_copy(session: Session, run, items):
+    # Salva una nuova run (nuovo run_id, stesso contenuto e stesso snapshot) di un calcolo condiviso
+    copy = PriceCalculationRun(
+        **{col: getattr(run, col) for col in _RUN_COPY_COLUMNS},
+        run_id=uuid.uuid4(),
+        snapshot=run.snapshot
+    )
+    persist_runs(session, [(copy, items)])
+    return copy, items
+
+def calculate_coalesced(session: Session, product_sku: str, requested_qty: float = 1.0, as_of=None, validate=False):
+    # Come calculate_and_persist per chiamanti in thread: le chiamate identiche concorrenti
+    # condividono un solo calcolo. Senza validate condividono anche la run salvata; con validate
+    # ognuna salva la propria copia.
+    as_of = as_of or date.today()
+    key = (product_sku, float(requested_qty), as_of, validate)
+    if not validate:
+        return pricing_flight.do(key, lambda: calculate_and_persist(session, product_sku, requested_qty, as_of))[0]
+    run, items = pricing_flight.do(key, lambda: price_run(session, product_sku, requested_qty, as_of, True))[0]
+    return persist_copy(session, run, items)
+
+def quote_price(session: Session, product_sku: str, requested_qty: float = 1.0, as_of=None):
+    # Stesso calcolo di calculate_and_persist, senza salvare nulla: la run resta transiente
+    # (con i valori alla scala delle colonne, quindi identici a quelli di una run salvata).
+    as_of = as_of or date.today()
+    run, items = price_run(session, product_sku, requested_qty, as_of)
+    return quantize_run(run), items
+
+def calculate_batch(session: Session, requests):
+    # Ritorna [(run, items, None) | (None, None, errore)] nello stesso ordine delle richieste;
+    # tutte le run calcolate vengono salvate in un'unica transazione.
+    return persist_batch(session, price_batch(session, requests))
+
+def persist_batch(session: Session, results):
+    runs = [(run, items) for run, items, err in results if err is None]
+    if runs:
+        persist_runs(session, runs)
+    return results
+
+def price_batch(session: Session, requests):
+    # requests: oggetti con product_sku, requested_qty, as_of, validate.
+    # Impostazioni, prodotti, BOM e costi vengono caricati una volta per chiave distinta
+    # (un BomTree per data), poi ogni richiesta viene calcolata in memoria. Nulla viene salvato.
+    check_deadline("lookup prodotti")
+    today = date.today()
+    skus = {r.product_sku for r in requests}
+    products = {}
+    for chunk in in_chunks(skus):
+        for p in session.execute(select(Product).where(Product.sku.in_(chunk))).scalars():
+            products[p.sku] = p
+
+    default_markup, default_currency = _load_settings(session)
+
+    by_date = {}
+    for r in requests:
+        product = products.get(r.product_sku)
+        if product is not None:
+            by_date.setdefault(r.as_of or today, set()).add(product.product_id)
+    trees = {}
+    for as_of, pids in by_date.items():
+        tree = trees[as_of] = BomTree(as_of)
+        if compiled_cache.enabled:
+            skip = lambda pid, as_of=as_of: compiled_cache.is_compiled(pid, as_of)
+            tree.load(session, [pid for pid in pids if not skip(pid)], skip=skip)
+        else:
+            tree.load(session, pids)
+
+    results = []
+    for r in requests:
+        product = products.get(r.product_sku)
+        if product is None:
+            results.append((None, None, f"Prodotto con SKU='{r.product_sku}' non trovato"))
+            continue
+        try:
+            run, items = _build_run(
+                session, trees[r.as_of or today], product, r.requested_qty, r.validate, default_markup, default_currency
+            )
+        except ValueError as e:
+            results.append((None, None, str(e)))
+            continue
+        results.append((run, items, None))
+    return results
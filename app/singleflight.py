@@ -0,0 +1,83 @@
+import asyncio
+import threading
+from .admission import check_deadline, shared_context
+from .metrics import Gauge
+
+# Coalescenza delle richieste identiche concorrenti ("single flight"): la prima richiesta per una
+# chiave esegue il calcolo, quelle che arrivano mentre e' in corso ne attendono il risultato
+# (o l'eccezione) invece di ripeterlo. Nulla viene memorizzato oltre la durata del calcolo.
+# Il calcolo condiviso gira senza la scadenza della richiesta che lo avvia
+# (admission.shared_context): ogni chiamante applica la propria solo prima di avviarlo o di
+# agganciarsi.
+#
+# do()        per chiamanti sincroni (thread): attesa su un Event
+# do_async()  per handler async: attesa su un Task condiviso, protetto con shield, cosi' la
+#             cancellazione del chiamante che l'ha avviato non interrompe gli altri
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self.leaders = 0
+        self.hits = 0
+
+    def do(self, key, fn):
+        # fn() -> risultato. -> (risultato, condiviso)
+        check_deadline("calcolo")
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.hits += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = shared_context().run(fn)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+    async def do_async(self, key, fn):
+        # fn() -> awaitable. -> (risultato, condiviso)
+        check_deadline("calcolo")
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            with self._lock:
+                self.hits += 1
+        else:
+            task = asyncio.get_running_loop().create_task(fn(), context=shared_context())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _, key=key: self._tasks.pop(key, None))
+            with self._lock:
+                self.leaders += 1
+        return await asyncio.shield(task), shared
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls) + len(self._tasks), "leaders": self.leaders, "coalesced": self.hits}
+
+pricing_flight = SingleFlight()
+
+Gauge("priceforge_pricing_coalesced_total", "Richieste di pricing servite dal calcolo di un'altra richiesta",
+      lambda: {(): pricing_flight.stats()["coalesced"]}, kind="counter")
@@ -0,0 +1,125 @@
+import random
+import uuid
+from datetime import date, timedelta
+from sqlalchemy import insert
+from .database import in_chunks
+from .models import (
+    BOM, BOMComponent, Material, MaterialCost, Operation, OperationCost, PricingSettings, Product,
+    ProductCostOverride
+)
+
+# Catalogo sintetico parametrico per benchmark e controlli dei piani di esecuzione.
+# I prodotti sono divisi in `depth` livelli: il livello 0 e' quello vendibile, ogni BOM ha
+# `fanout` righe di cui circa `sub_ratio` sono sottoassiemi del livello inferiore (scelti a caso,
+# quindi condivisi tra piu' padri) e il resto materiali/lavorazioni. Ogni materiale e lavorazione
+# ha `cost_windows` finestre di validita' consecutive che terminano con una aperta che copre oggi.
+# Tutto e' deterministico a parita' di seed e viene inserito con INSERT multi-riga.
+
+INSERT_CHUNK = 10000
+
+def _insert(conn, model, rows):
+    for chunk in in_chunks(rows, INSERT_CHUNK):
+        conn.execute(insert(model), chunk)
+
+def _windows(rnd, n, end, step_days):
+    # n finestre consecutive di step_days giorni; l'ultima e' aperta (valid_to NULL)
+    start = end - timedelta(days=step_days * (n - 1))
+    out = []
+    for k in range(n):
+        valid_from = start + timedelta(days=step_days * k)
+        valid_to = valid_from + timedelta(days=step_days - 1) if k < n - 1 else None
+        out.append((valid_from, valid_to, round(rnd.uniform(1, 100), 4)))
+    return out
+
+def generate_catalog(conn, products=1000, depth=3, fanout=8, sub_ratio=0.3, materials=None, operations=None,
+                     cost_windows=12, window_days=30, override_ratio=0.1, bom_versions=2, seed=42, today=None):
+    # -> riepilogo con i conteggi delle righe inserite e gli sku vendibili
+    rnd = random.Random(seed)
+    today = today or date.today()
+    materials = materials or max(products // 2, 1)
+    operations = operations or max(products // 10, 1)
+
+    def new_id():
+        return uuid.UUID(int=rnd.getrandbits(128), version=4)
+
+    _insert(conn, PricingSettings, [{"settings_id": True, "default_markup_pct": 20.0, "currency": "EUR"}])
+
+    ref_ids = {}
+    for model, cost_model, id_field, prefix, n in (
+        (Material, MaterialCost, "material_id", "M", materials),
+        (Operation, OperationCost, "operation_id", "O", operations),
+    ):
+        ids = [new_id() for _ in range(n)]
+        ref_ids[prefix] = ids
+        _insert(conn, model, [
+            {id_field: rid, "code": f"{prefix}{i:08d}", "name": f"{model.__name__} {i}", "uom": "pz"}
+            for i, rid in enumerate(ids)
+        ])
+        end = today - timedelta(days=rnd.randrange(window_days))
+        cost_rows = []
+        for rid in ids:
+            for valid_from, valid_to, cost in _windows(rnd, cost_windows, end, window_days):
+                cost_rows.append({id_field: rid, "unit_cost": cost, "currency": "EUR",
+                                  "valid_from": valid_from, "valid_to": valid_to})
+            if len(cost_rows) >= INSERT_CHUNK:
+                _insert(conn, cost_model, cost_rows)
+                cost_rows = []
+        _insert(conn, cost_model, cost_rows)
+
+    # Livelli: il primo (vendibile) e' il piu' numeroso, i sottoassiemi si dimezzano scendendo.
+    weights = [2 ** (depth - 1 - lvl) for lvl in range(depth)]
+    sizes = [max(products * w // sum(weights), 1) for w in weights]
+    sizes[0] += products - sum(sizes)
+    levels, product_rows, n = [], [], 0
+    for lvl, size in enumerate(sizes):
+        ids = [new_id() for _ in range(size)]
+        levels.append(ids)
+        for pid in ids:
+            product_rows.append({"product_id": pid, "sku": f"P{n:08d}", "name": f"Prodotto {n}", "currency": "EUR",
+                                 "default_markup_pct": None if n % 3 else 25.0, "is_sellable": lvl == 0})
+            n += 1
+    _insert(conn, Product, product_rows)
+
+    bom_rows, component_rows, override_rows = [], [], []
+    valid_from = today - timedelta(days=window_days * cost_windows)
+    for lvl, ids in enumerate(levels):
+        below = levels[lvl + 1] if lvl + 1 < len(levels) else []
+        for pid in ids:
+            for version in range(1, bom_versions + 1):
+                bom_id = new_id()
+                bom_rows.append({"bom_id": bom_id, "product_id": pid, "version": version,
+                                 "is_active": version == bom_versions, "valid_from": valid_from})
+                lines = []
+                for line_no in range(1, fanout + 1):
+                    if below and rnd.random() < sub_ratio:
+                        kind, ref_id = "product", rnd.choice(below)
+                    elif rnd.random() < 0.75:
+                        kind, ref_id = "material", rnd.choice(ref_ids["M"])
+                    else:
+                        kind, ref_id = "operation", rnd.choice(ref_ids["O"])
+                    lines.append((kind, ref_id))
+                    component_rows.append({
+                        "bom_component_id": new_id(), "bom_id": bom_id, "line_no": line_no, "kind": kind,
+                        "ref_id": ref_id, "quantity": round(rnd.uniform(0.1, 5), 6),
+                        "waste_pct": rnd.choice((0, 0, 2.5, 5)),
+                    })
+            leaf_lines = [ln for ln in lines if ln[0] != "product"]
+            if leaf_lines and rnd.random() < override_ratio:
+                kind, ref_id = rnd.choice(leaf_lines)
+                override_rows.append({"product_id": pid, "kind": kind, "ref_id": ref_id,
+                                      "override_unit_cost": round(rnd.uniform(1, 100), 4), "currency": "EUR",
+                                      "valid_from": valid_from})
+    _insert(conn, BOM, bom_rows)
+    _insert(conn, BOMComponent, component_rows)
+    _insert(conn, ProductCostOverride, override_rows)
+    return {
+        "products": products,
+        "levels": sizes,
+        "materials": materials,
+        "operations": operations,
+        "cost_windows": (materials + operations) * cost_windows,
+        "boms": len(bom_rows),
+        "bom_components": len(component_rows),
+        "product_overrides": len(override_rows),
+        "sellable_skus": [row["sku"] for row in product_rows[:sizes[0]]],
+    }
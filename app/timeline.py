@@ -0,0 +1,213 @@
+from collections import defaultdict
+from datetime import timedelta
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .database import in_chunks
+from .explosion import BomTree, load_components
+from .metrics import stage
+from .models import BOM, MaterialCost, OperationCost, PriceCalculationRun, Product, ProductCostOverride
+from .persistence import quantize_run
+from .services import _load_settings
+
+# Prezzo di un prodotto nel tempo: invece di un calcolo per ogni giorno dell'intervallo, carica
+# una volta tutte le BOM, i componenti, i costi di listino e gli override i cui intervalli di
+# validita' toccano il periodo, e raccoglie le date in cui uno di essi inizia o finisce. Il
+# costo e' costante tra due date consecutive: lo si valuta solo in quei punti, aggiornando in
+# memoria le sole chiavi cambiate, e si uniscono i segmenti adiacenti con lo stesso risultato.
+# Il lavoro cresce con il numero di variazioni, non con il numero di giorni.
+#
+# Selezione della BOM e del costo a una data: stesse regole di BomTree (explosion.py).
+
+TIMELINE_MAX_DAYS = 3660
+
+def _overlaps(table, date_from, date_to):
+    return (table.valid_from <= date_to) & ((table.valid_to == None) | (table.valid_to >= date_from))
+
+def _covers(valid_from, valid_to, as_of):
+    return valid_from <= as_of and (valid_to is None or valid_to >= as_of)
+
+def _value_at(windows, as_of):
+    # windows: [(valore, valid_from, valid_to)] -> valore con valid_from piu' recente alla data
+    best = None
+    for value, valid_from, valid_to in windows:
+        if _covers(valid_from, valid_to, as_of) and (best is None or valid_from > best[1]):
+            best = (value, valid_from)
+    return best[0] if best else None
+
+def _bom_at(boms, as_of):
+    # Come load_boms: l'attiva con versione piu' alta, altrimenti la valida con versione piu' alta
+    active = [b for b in boms if b.is_active]
+    candidates = active or [b for b in boms if _covers(b.valid_from, b.valid_to, as_of)]
+    return max(candidates, key=lambda b: b.version, default=None)
+
+class _Timeline:
+    # Dati del periodo per i prodotti raggiungibili dal prodotto richiesto (con ogni BOM del periodo)
+
+    def __init__(self, date_from, date_to):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.boms = {}                       # product_id -> [BOM]
+        self.components = {}                 # bom_id -> [BOMComponent]
+        self.windows = defaultdict(list)     # ("material"|"operation"|"override", chiave) -> [(costo, dal, al)]
+        self.events = defaultdict(set)       # data -> {chiavi che cambiano quel giorno}
+
+    def _event(self, key, valid_from, valid_to):
+        if self.date_from < valid_from <= self.date_to:
+            self.events[valid_from].add(key)
+        if valid_to is not None and self.date_from <= valid_to < self.date_to:
+            self.events[valid_to + timedelta(days=1)].add(key)
+
+    def load(self, session: Session, product_id):
+        with stage("bom_resolution"):
+            new_products = {product_id}
+            while new_products:
+                found = {pid: [] for pid in new_products}
+                for chunk in in_chunks(new_products):
+                    for bom in session.execute(select(BOM).where(
+                        BOM.product_id.in_(chunk), (BOM.is_active == True) | _overlaps(BOM, self.date_from, self.date_to)
+                    )).scalars():
+                        found[bom.product_id].append(bom)
+                self.boms.update(found)
+                components = load_components(session, [b.bom_id for boms in found.values() for b in boms])
+                self.components.update(components)
+                next_products = {c.ref_id for comps in components.values() for c in comps if c.kind == "product"}
+                new_products = next_products - self.boms.keys()
+        for pid, boms in self.boms.items():
+            # Con una BOM attiva la selezione non dipende dalla data
+            if not any(b.is_active for b in boms):
+                for b in boms:
+                    self._event(("bom", pid), b.valid_from, b.valid_to)
+
+        material_ids, operation_ids, override_keys = set(), set(), set()
+        for pid, boms in self.boms.items():
+            for bom in boms:
+                for comp in self.components[bom.bom_id]:
+                    if comp.kind == "product" or comp.override_unit_cost is not None:
+                        continue
+                    (material_ids if comp.kind == "material" else operation_ids).add(comp.ref_id)
+                    override_keys.add((pid, comp.kind, comp.ref_id))
+        with stage("cost_lookup"):
+            self._load_windows(session, MaterialCost, "material_id", "material", material_ids)
+            self._load_windows(session, OperationCost, "operation_id", "operation", operation_ids)
+            for chunk in in_chunks({k[0] for k in override_keys}):
+                for pid, kind, ref_id, cost, valid_from, valid_to in session.execute(
+                    select(
+                        ProductCostOverride.product_id, ProductCostOverride.kind, ProductCostOverride.ref_id,
+                        ProductCostOverride.override_unit_cost, ProductCostOverride.valid_from,
+                        ProductCostOverride.valid_to
+                    )
+                    .where(ProductCostOverride.product_id.in_(chunk))
+                    .where(_overlaps(ProductCostOverride, self.date_from, self.date_to))
+                ):
+                    if (pid, kind, ref_id) in override_keys:
+                        self._window(("override", (pid, kind, ref_id)), cost, valid_from, valid_to)
+        return self
+
+    def _load_windows(self, session, table, id_field, kind, ref_ids):
+        id_col = getattr(table, id_field)
+        for chunk in in_chunks(ref_ids):
+            for ref_id, cost, valid_from, valid_to in session.execute(
+                select(id_col, table.unit_cost, table.valid_from, table.valid_to)
+                .where(id_col.in_(chunk))
+                .where(_overlaps(table, self.date_from, self.date_to))
+            ):
+                self._window((kind, ref_id), cost, valid_from, valid_to)
+
+    def _window(self, key, cost, valid_from, valid_to):
+        self.windows[key].append((cost, valid_from, valid_to))
+        self._event(key, valid_from, valid_to)
+
+    def _apply(self, tree, keys):
+        # Aggiorna nel BomTree le sole chiavi indicate al valore valido a tree.as_of
+        for key in keys:
+            kind, ref = key
+            if kind == "bom":
+                tree.boms[ref] = _bom_at(self.boms[ref], tree.as_of)
+                continue
+            target = {"material": tree.material_costs, "operation": tree.operation_costs,
+                      "override": tree.overrides}[kind]
+            value = _value_at(self.windows[key], tree.as_of)
+            if value is None:
+                target.pop(ref, None)
+            else:
+                target[ref] = value
+
+    def points(self, product_id, qty):
+        # -> [(data, bom_id, totale materiali, totale lavorazioni) | (data, None, errore, None)]
+        tree = BomTree(self.date_from)
+        tree.components = self.components
+        self._apply(tree, [("bom", pid) for pid in self.boms])
+        self._apply(tree, list(self.windows))
+        out = []
+        for as_of in [self.date_from] + sorted(self.events):
+            if as_of != self.date_from:
+                tree.as_of = as_of
+                self._apply(tree, self.events[as_of])
+            try:
+                with stage("expand"):
+                    _, tot_mat, tot_op = tree.expand(product_id, qty, [], 1)
+            except ValueError as e:
+                out.append((as_of, None, str(e), None))
+                continue
+            out.append((as_of, tree.bom_for(product_id).bom_id, tot_mat, tot_op))
+        return out
+
+def _same_values(a, b):
+    return all(a[k] == b[k] for k in a if k not in ("valid_from", "valid_to"))
+
+def price_timeline(session: Session, product_sku, requested_qty, date_from, date_to):
+    # -> dict con i segmenti [valid_from, valid_to] a prezzo costante
+    if date_to < date_from:
+        raise ValueError("date_to precedente a date_from")
+    if (date_to - date_from).days >= TIMELINE_MAX_DAYS:
+        raise ValueError(f"Intervallo oltre {TIMELINE_MAX_DAYS} giorni")
+    with stage("product_lookup"):
+        product = session.execute(select(Product).where(Product.sku == product_sku)).scalar_one_or_none()
+        if not product:
+            raise ValueError(f"Prodotto con SKU='{product_sku}' non trovato")
+        default_markup, default_currency = _load_settings(session)
+    markup_pct = float(product.default_markup_pct) if product.default_markup_pct is not None else default_markup
+    currency = product.currency or default_currency
+
+    timeline = _Timeline(date_from, date_to).load(session, product.product_id)
+    segments = []
+    points = timeline.points(product.product_id, float(requested_qty))
+    for i, (as_of, bom_id, tot_mat, tot_op) in enumerate(points):
+        if bom_id is None:
+            segment = {"valid_from": as_of, "valid_to": None, "bom_id": None, "error": tot_mat}
+        else:
+            # Stessi valori (e stessa scala) di /pricing/quote alla data
+            tot = tot_mat + tot_op
+            run = quantize_run(PriceCalculationRun(
+                requested_qty=requested_qty, markup_pct=markup_pct, total_material_cost=tot_mat,
+                total_operation_cost=tot_op, total_other_cost=0.0, total_cost=tot,
+                price=round(tot * (1 + markup_pct/100.0), 4),
+            ))
+            segment = {
+                "valid_from": as_of,
+                "valid_to": None,
+                "bom_id": bom_id,
+                "total_material_cost": float(run.total_material_cost),
+                "total_operation_cost": float(run.total_operation_cost),
+                "total_other_cost": float(run.total_other_cost),
+                "total_cost": float(run.total_cost),
+                "price": float(run.price),
+                "error": None,
+            }
+        valid_to = points[i + 1][0] - timedelta(days=1) if i + 1 < len(points) else date_to
+        if segments and _same_values(segments[-1], segment):
+            segments[-1]["valid_to"] = valid_to
+            continue
+        segment["valid_to"] = valid_to
+        segments.append(segment)
+    return {
+        "product_id": product.product_id,
+        "product_sku": product_sku,
+        "requested_qty": float(requested_qty),
+        "markup_pct": markup_pct,
+        "currency": currency,
+        "date_from": date_from,
+        "date_to": date_to,
+        "change_points": len(points),
+        "segments": segments,
+    }
@@ -0,0 +1,29 @@
+import os
+import pytest
+
+# Regressione dei piani delle query calde (app/check_plans.py) su un Postgres di prova: fallisce
+# se una query legge con Seq Scan una tabella grande. Senza un DATABASE_URL Postgres e' saltato.
+# Un DB vuoto viene prima riempito con un catalogo sintetico di CHECK_PLANS_PRODUCTS prodotti.
+#   DATABASE_URL=postgresql://.../priceforge_plans python -m pytest tests/test_query_plans.py
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv("DATABASE_URL", "").startswith("postgresql"), reason="richiede DATABASE_URL su Postgres"
+)
+
+CHECK_PLANS_PRODUCTS = int(os.getenv("CHECK_PLANS_PRODUCTS", "20000"))
+
+@pytest.fixture(scope="module")
+def conn():
+    from sqlalchemy import func, inspect, select
+    from app.check_plans import prepare
+    from app.database import engine
+    from app.models import Product
+    with engine.connect() as c:
+        empty = not inspect(c).has_table("products") or not c.execute(select(func.count()).select_from(Product)).scalar()
+    prepare(engine, CHECK_PLANS_PRODUCTS if empty else 0)
+    with engine.connect() as c:
+        yield c
+
+def test_hot_queries_do_not_seq_scan_large_tables(conn):
+    from app.check_plans import check
+    assert check(conn) == {}